@@ -2,8 +2,10 @@ import json
 import logging
 import logging.config
 import multiprocessing
+import os
 import sys
 from fnmatch import fnmatch
+from itertools import islice
 from logging.handlers import QueueListener
 from pathlib import Path
 from typing import Iterator
@@ -11,19 +13,28 @@ from typing import Iterator
 import click
 import yaml
 
-from .datastore import execute_insertmany, execute_query
+from . import querystats
+from .datastore import execute_insertmany, migrate_table, stream_query, table_exists
 from .edgar import read_master_idx
+from .llm import batch as llm_batch
+from .llm import cache as llm_cache
 from .llm.embedding import GEMINI_EMBEDDING_MODEL, OPENAI_EMBEDDING_MODEL
+from .llm.extraction import set_hedging
 from .processor import (
+    candidate_coverage,
     gather_extractin_result,
     init_worker,
     process_filing,
     process_filing_wrapper,
+    semantic_search,
 )
 from .trustee import (
+    RETRIEVAL_BACKENDS,
     TRUSTEE_COMP_SEARCH_PHRASES,
     create_search_phrase_embeddings,
     delete_search_pharses,
+    ingest_trustee_comp_batch,
+    precompute_relevance,
 )
 
 MAX_ERRORS = 5
@@ -58,21 +69,92 @@ def enumerate_filings(
     tag: str,
     batch_limit: int,
     index_table_name: str,
+    pending_filter: str = "",
+    pending_params: tuple = (),
 ) -> Iterator[tuple[str, str]]:
-    rows = execute_query(
+    rows = stream_query(
         f"""
-        SELECT distinct cik, accession_number FROM {index_table_name}
-        WHERE %s = ANY(tags)
+        SELECT distinct cik, accession_number FROM {index_table_name} idx
+        WHERE %s = ANY(tags) {pending_filter}
         """,
-        (tag,),
+        (tag,) + pending_params,
+        row_mode="tuple",
     )
     n_processed = 0
-    for row in rows:
+    for cik, accession_number in rows:
         if batch_limit and n_processed >= batch_limit:
             break
 
         n_processed += 1
-        yield row["cik"], row["accession_number"]
+        yield cik, accession_number
+
+
+def plan_filings(
+    action: str,
+    tag: str,
+    batch_limit: int,
+    tables_map: dict[str, str],
+    result_tag: str,
+    model: str,
+) -> Iterator[tuple[str, str]]:
+    """
+    Enumerate the filings of a tag that still need processing for the action.
+    Filings already done are excluded by a single anti join, instead of
+    checking each filing with separate queries in the workers.
+    """
+    pending_filter, pending_params = "", ()
+
+    def filing_in(table_name: str, condition: str = "") -> str:
+        return f"""
+            EXISTS (SELECT 1 FROM {table_name} t
+                WHERE t.cik = idx.cik AND t.accession_number = idx.accession_number
+                {condition})"""
+
+    if action == "chunk":
+        if table_exists(tables_map["text"]):
+            pending_filter = f"AND NOT {filing_in(tables_map['text'])}"
+
+    elif action == "embedding":
+        # only filings that have been chunked can be embedded
+        if not table_exists(tables_map["text"]):
+            return
+        pending_filter = f"AND {filing_in(tables_map['text'])}"
+        if table_exists(tables_map["embedding"]):
+            pending_filter += f" AND NOT {filing_in(tables_map['embedding'])}"
+
+    elif action == "extract":
+        if table_exists(tables_map["result"]):
+            result_done = "AND t.model = %s AND %s = ANY(t.tags)"
+            pending_filter = f"AND NOT {filing_in(tables_map['result'], result_done)}"
+            pending_params = (model, result_tag)
+
+    yield from enumerate_filings(
+        tag=tag,
+        batch_limit=batch_limit,
+        index_table_name=tables_map["idx"],
+        pending_filter=pending_filter,
+        pending_params=pending_params,
+    )
+
+
+def print_search_results(rows: list[dict]) -> None:
+    for rank, row in enumerate(rows, start=1):
+        print(
+            f"{rank:>3}. {row['distance']:.4f} {row['company_name']} ({row['date_filed']}) "  # noqa: E501
+            f"Filing({row['cik']},{row['accession_number']}) chunk {row['chunk_num']}"
+        )
+        snippet = " ".join((row.get("chunk_text") or "").split())
+        if snippet:
+            print(f"     {snippet[:200]}")
+
+
+def print_query_stats() -> None:
+    report = querystats.summary()
+    if report:
+        print(f"\nQuery statistics:\n{report}")
+    cache_report = llm_cache.stats_summary()
+    if cache_report:
+        print(cache_report)
 
 
 @click.command()
@@ -85,7 +167,10 @@ def enumerate_filings(
             "chunk",
             "embedding",
             "extract",
+            "ingest",
             "export",
+            "migrate",
+            "search",
         ],
         case_sensitive=False,
     ),
@@ -94,10 +179,37 @@ def enumerate_filings(
     "index-range",
     required=False,
 )
+@click.option(
+    "--query",
+    required=False,
+    help="Free text to search for in search action",
+)
+@click.option(
+    "--top-k",
+    type=int,
+    default=10,
+    help="Number of chunks returned by search action",
+)
+@click.option(
+    "--ef-search",
+    type=int,
+    default=40,
+    help="Size of the HNSW candidate list in search action, higher is slower but more accurate",  # noqa: E501
+)
 @click.option(
     "--output",
     required=False,
-    help="Output file for export action",
+    help="Output file for export action, or the follow-up batch file of ingest action",
+)
+@click.option(
+    "--batch-file",
+    required=False,
+    help="Write the prompts of extract action to this JSONL file for the OpenAI Batch API or Vertex AI batch prediction instead of asking the model",  # noqa: E501
+)
+@click.option(
+    "--batch-output",
+    required=False,
+    help="Output file of the completed batch job of --batch-file, saved by ingest action",  # noqa: E501
 )
 @click.option(
     "--batch-limit",
@@ -139,6 +251,91 @@ def enumerate_filings(
     default=768,
     help="Dimensionality of embeddings. Only applicable when using Gemini API",
 )
+@click.option(
+    "--partition",
+    type=click.Choice(["none", "hash", "year"]),
+    default="none",
+    help="Partitioning of text and embedding tables when they are created, by hash of cik or by filing year",  # noqa: E501
+)
+@click.option(
+    "--vector-index",
+    type=click.Choice(["none", "hnsw", "ivfflat"]),
+    default="none",
+    help="Approximate nearest neighbor index to build on embeddings for migrate action",
+)
+@click.option(
+    "--search-batch-size",
+    type=int,
+    default=100,
+    help="Number of filings to run vector search for in one query in extract action, 0 to search each filing separately",  # noqa: E501
+)
+@click.option(
+    "--retrieval",
+    type=click.Choice(RETRIEVAL_BACKENDS),
+    default="pgvector",
+    help="Compute distances to search phrases in the database or in process with numpy",
+)
+@click.option(
+    "--save-relevance",
+    is_flag=True,
+    default=False,
+    help="Save the vector search result of each filing in extract action and reuse it in later runs. Saved results are deleted when the search phrases of the tag or the embeddings of the filing are replaced",  # noqa: E501
+)
+@click.option(
+    "--embed-candidates",
+    type=int,
+    default=0,
+    help="Embed only this many chunks of a filing that match keywords by full text search, plus their neighbors, 0 to embed all chunks. With extract action, report how often the selection falls outside these candidates",  # noqa: E501
+)
+@click.option(
+    "--save-fingerprints",
+    is_flag=True,
+    default=False,
+    help="Save the MinHash fingerprint of each filing in chunk action even when --near-dup-threshold is 0, so that --near-dup-result-threshold can use them later",  # noqa: E501
+)
+@click.option(
+    "--near-dup-threshold",
+    type=float,
+    default=0.0,
+    help="Copy chunks and embeddings from an earlier filing of the same cik at least this similar, 0 to disable",  # noqa: E501
+)
+@click.option(
+    "--near-dup-result-threshold",
+    type=float,
+    default=0.0,
+    help="Copy the extraction result from an earlier filing of the same cik at least this similar, 0 to disable",  # noqa: E501
+)
+@click.option(
+    "--speculation",
+    type=int,
+    default=1,
+    help="Number of chunk selections of a filing sent to the model at once in extract action, more uses extra tokens to finish each filing sooner",  # noqa: E501
+)
+@click.option(
+    "--hedge-model",
+    type=str,
+    default=os.environ.get("HEDGE_MODEL", ""),
+    help="Also ask this model when the model is slower than usual, the first JSON answer is used",  # noqa: E501
+)
+@click.option(
+    "--hedge-percentile",
+    type=float,
+    default=90.0,
+    help="Ask the hedge model once the model takes longer than this percentile of its latencies",  # noqa: E501
+)
+@click.option(
+    "--llm-cache",
+    "llm_cache_mode",
+    type=click.Choice(llm_cache.CACHE_MODES),
+    default=os.environ.get("LLM_CACHE", "readwrite"),
+    help="Reuse model responses saved under the cache path. replay never calls the model",  # noqa: E501
+)
+@click.option(
+    "--slow-query-ms",
+    type=float,
+    default=querystats.slow_query_threshold(),
+    help="Capture the plan of queries slower than this many milliseconds, 0 to disable",
+)
 @click.option(
     "--workers",
     type=int,
@@ -158,8 +355,34 @@ def main(
     workers: int,
     index_range: str,
     output: str,
+    vector_index: str,
+    partition: str,
+    slow_query_ms: float,
+    search_batch_size: int,
+    retrieval: str,
+    save_relevance: bool,
+    embed_candidates: int,
+    save_fingerprints: bool,
+    near_dup_threshold: float,
+    near_dup_result_threshold: float,
+    speculation: int,
+    hedge_model: str,
+    hedge_percentile: float,
+    llm_cache_mode: str,
+    batch_file: str,
+    batch_output: str,
+    query: str,
+    top_k: int,
+    ef_search: int,
 ) -> None:
-    if action not in ["load-index", "init-search-phrases"] and not tag:
+    untagged_actions = [
+        "load-index",
+        "init-search-phrases",
+        "migrate",
+        "search",
+        "ingest",
+    ]
+    if action not in untagged_actions and not tag:
         raise click.UsageError(f"--tag is required for {action}")
 
     if action in ["extract", "init-search-phrases"] and not search_tag:
@@ -168,11 +391,24 @@ def main(
     if action in ["extract", "export"] and not result_tag:
         raise click.UsageError(f"--result-tag is required for {action}")
 
+    if action == "ingest" and not (batch_file and batch_output):
+        raise click.UsageError(
+            f"--batch-file and --batch-output are required for {action}"
+        )
+
+    if action == "search" and not query:
+        raise click.UsageError(f"--query is required for {action}")
+
     if action == "load-index" and not index_range:
         raise click.UsageError(f"index-range is required for {action}")
 
     form_type = "485BPOS"
 
+    querystats.set_slow_query_threshold(slow_query_ms)
+    llm_cache.set_mode(llm_cache_mode)
+    set_hedging(hedge_model, hedge_percentile)
+    click.get_current_context().call_on_close(print_query_stats)
+
     # default table names
     tables_map = {
         "full-idx": "master_idx",
@@ -181,6 +417,8 @@ def main(
         "embedding": "filing_chunks_embeddings",
         "result": "trustee_comp_results",
         "search": "search_phrase_embeddings",
+        "relevance": "filing_chunks_relevance",
+        "fingerprint": "filing_fingerprints",
     }
 
     # use command line options to override table names
@@ -212,7 +450,11 @@ def main(
 
     if action == "init-search-phrases":
         print("Initializing search phrase embeddings...")
-        delete_search_pharses(table_name=tables_map["search"], search_tag=search_tag)
+        delete_search_pharses(
+            table_name=tables_map["search"],
+            search_tag=search_tag,
+            relevance_table_name=tables_map["relevance"],
+        )
         create_search_phrase_embeddings(
             table_name=tables_map["search"],
             phrases=TRUSTEE_COMP_SEARCH_PHRASES,
@@ -222,6 +464,52 @@ def main(
         )
         return
 
+    if action == "migrate":
+        for table_name in sorted(set(tables_map.values())):
+            version = migrate_table(
+                table_name,
+                vector_index="" if vector_index == "none" else vector_index,
+            )
+            if version is None:
+                print(f"{table_name} does not exist, skipped")
+            else:
+                print(f"{table_name} migrated to schema version {version}")
+        return
+
+    if action == "search":
+        rows = semantic_search(
+            query=query,
+            tables_map=tables_map,
+            model=model,
+            dimension=dimension,
+            limit=top_k,
+            ef_search=ef_search,
+        )
+        if output:
+            with open(output, "w") as f:
+                for row in rows:
+                    f.write(json.dumps(row))
+                    f.write("\n")
+            print(f"Saved {len(rows)} search results to {output}")
+        else:
+            print_search_results(rows)
+        return
+
+    if action == "ingest":
+        followup_file = output or str(
+            Path(batch_file).with_name(f"{Path(batch_file).stem}-followup.jsonl")
+        )
+        n_results, n_followups = ingest_trustee_comp_batch(
+            batch_file=batch_file,
+            output_file=batch_output,
+            result_table_name=tables_map["result"],
+            followup_file=followup_file,
+        )
+        print(f"Saved {n_results} results from {batch_output}")
+        if n_followups:
+            print(f"Wrote {n_followups} requests to try next to {followup_file}")
+        return
+
     if action == "export":
         result = gather_extractin_result(
             idx_table_name=tables_map["idx"],
@@ -229,18 +517,50 @@ def main(
             idx_tag=tag,
             result_tag=result_tag,
         )
+        n_exported = 0
         with open(output, "w") as f:
             for row in result:
                 jsonl = json.dumps(row)
                 f.write(jsonl)
                 f.write("\n")
-        print(f"Exported {len(result)} records to {output}")
+                n_exported += 1
+        print(f"Exported {n_exported} records to {output}")
         return
 
     print(f"Running {action}")
 
-    # list of arguments to pass to process_filing
-    args = [
+    if action == "extract" and not save_relevance:
+        # relevance saved by earlier runs is neither used nor written
+        tables_map["relevance"] = ""
+
+    if action == "chunk" and not (save_fingerprints or near_dup_threshold > 0):
+        # fingerprints are only needed to find near duplicates
+        tables_map["fingerprint"] = ""
+
+    filings = plan_filings(
+        action=action,
+        tag=tag,
+        batch_limit=batch_limit,
+        tables_map=tables_map,
+        result_tag=result_tag,
+        model=model,
+    )
+    if action == "extract" and search_batch_size > 0:
+        filings = precompute_relevance(
+            filings,
+            batch_size=search_batch_size,
+            embedding_table_name=tables_map["embedding"],
+            search_phrase_table_name=tables_map["search"],
+            search_phrase_tag=search_tag,
+            relevance_table_name=tables_map["relevance"],
+            retrieval=retrieval,
+        )
+    else:
+        filings = ((cik, accession_number, None) for cik, accession_number in filings)
+
+    # arguments to pass to process_filing, generated lazily
+    # so that filings are enumerated as they are processed
+    args = (
         {
             "action": action,
             "tables_map": tables_map,
@@ -252,17 +572,29 @@ def main(
             "model": model,
             "dimension": dimension,
             "form_type": form_type,
+            "partition": "" if partition == "none" else partition,
+            # filings already processed are excluded by the planner
+            "check_existing": False,
+            "relevance": relevance,
+            "retrieval": retrieval,
+            "n_candidates": embed_candidates,
+            "near_dup_threshold": near_dup_threshold,
+            "near_dup_result_threshold": near_dup_result_threshold,
+            "speculation": speculation,
+            "batch": bool(batch_file),
         }
-        for cik, accession_number in list(
-            enumerate_filings(
-                tag=tag, batch_limit=batch_limit, index_table_name=tables_map["idx"]
-            )
-        )
-    ]
+        for cik, accession_number, relevance in filings
+    )
+
+    if batch_file and action == "extract":
+        # start with an empty batch, requests are added as filings are processed
+        llm_batch.write_batch(batch_file, [], append=False)
 
     if workers == 1:
         for arg in args:
             process_filing(**arg)
+            if batch_file:
+                llm_batch.write_batch(batch_file, llm_batch.take())
     else:
         # create a queue to receive log messages from worker processes
         # https://stackoverflow.com/questions/641420/how-should-i-log-while-using-multiprocessing-in-python
@@ -279,9 +611,24 @@ def main(
                 (
                     logging_q,
                     logging.DEBUG,
+                    slow_query_ms,
+                    (tables_map["search"], search_tag) if action == "extract" else None,
+                    llm_cache_mode,
+                    (hedge_model, hedge_percentile),
                 ),
             ) as pool:
-                pool.map(process_filing_wrapper, args)
+                # the pool drains whatever iterable it is given in a background
+                # thread, which would run the queries that enumerate filings on
+                # the shared connection while this thread uses it. feed it a
+                # few filings per worker at a time from this thread instead
+                while chunk := list(islice(args, workers * 4)):
+                    for worker_stats in pool.imap_unordered(
+                        process_filing_wrapper, chunk
+                    ):
+                        querystats.merge(worker_stats["queries"])
+                        llm_cache.merge_stats(worker_stats["llm_cache"])
+                        if batch_file:
+                            llm_batch.write_batch(batch_file, worker_stats["batch"])
 
         finally:
             if q_listener:
@@ -290,6 +637,22 @@ def main(
                 logging_q.close()
                 logging_q.join_thread()
 
+    if action == "extract" and embed_candidates > 0:
+        coverage = candidate_coverage(
+            text_table_name=tables_map["text"],
+            extraction_result_table_name=tables_map["result"],
+            result_tag=result_tag,
+            n_candidates=embed_candidates,
+        )
+        print(
+            f"{coverage['n_outside']} of {coverage['n_filings']} filings selected "
+            f"chunks outside the {embed_candidates} candidate chunks"
+        )
+
+    if batch_file and action == "extract":
+        n_requests = len(llm_batch.read_pending(batch_file))
+        print(f"Wrote {n_requests} requests to {batch_file}, ingest its output when done")
+
     print("Done")
 
 
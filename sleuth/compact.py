@@ -0,0 +1,83 @@
+"""
+Compaction of the chunk text put into prompts.
+
+Chunks are markdown converted from html by html2text. Tables in them carry a
+lot of tokens the model does not need: columns left empty by spacer cells,
+"---|---" separator rows, rows of empty cells, and the header row repeated
+after every page break. Links keep their long URL targets. compact_text
+removes all of these and squeezes whitespace, leaving the text of every
+non empty cell in place. Columns are dropped only when empty in the whole
+table, so the text of a table split across chunks is compacted together.
+"""
+
+import re
+
+# both OpenAI and Gemini tokenizers average about 4 characters per token on
+# filing text, close enough for a budget without loading a tokenizer
+CHARS_PER_TOKEN = 4
+
+_link_regex = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+_spaces_regex = re.compile(r"[ \t ]+")
+_separator_regex = re.compile(r"^[\s|:-]*-{3,}[\s|:-]*$")
+_blank_lines_regex = re.compile(r"\n{3,}")
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def compact_text(text: str) -> str:
+    """
+    text with links reduced to their text, whitespace normalized and tables
+    compacted. a table header seen before in the text is dropped
+    """
+    seen_headers: set[str] = set()
+    text = _link_regex.sub(r"\1", text)
+    lines, block = [], []
+    for line in text.split("\n"):
+        line = _spaces_regex.sub(" ", line).strip()
+        if "|" in line or _separator_regex.match(line):
+            block.append(line)
+            continue
+        lines.extend(_compact_block(block, seen_headers))
+        block = []
+        lines.append(line)
+    lines.extend(_compact_block(block, seen_headers))
+
+    return _blank_lines_regex.sub("\n\n", "\n".join(lines)).strip()
+
+
+def _compact_block(lines: list[str], seen_headers: set[str]) -> list[str]:
+    """
+    consecutive lines with a "|" or a separator. they are a table when there
+    is a "---|---" separator or at least two rows starting or ending with "|",
+    otherwise they are text that happens to contain a "|"
+    """
+    separators = [line for line in lines if _separator_regex.match(line)]
+    rows = [line for line in lines if line not in separators]
+    has_separator = any("|" in line for line in separators)
+    n_piped = sum(1 for row in rows if row.startswith("|") or row.endswith("|"))
+    if has_separator or n_piped >= 2:
+        return _compact_table(rows, seen_headers)
+    return rows
+
+
+def _compact_table(rows: list[str], seen_headers: set[str]) -> list[str]:
+    """rows of a table without empty columns, empty rows and a repeated header"""
+    cells = [[cell.strip() for cell in row.split("|")] for row in rows]
+    cells = [row for row in cells if any(row)]
+    if not cells:
+        return []
+
+    n_columns = max(len(row) for row in cells)
+    cells = [row + [""] * (n_columns - len(row)) for row in cells]
+    kept = [i for i in range(n_columns) if any(row[i] for row in cells)]
+    # trailing empty cells of a row carry nothing either
+    compacted = [" | ".join(row[i] for i in kept).rstrip(" |") for row in cells]
+
+    header = compacted[0]
+    body = [row for row in compacted[1:] if row != header]
+    if header in seen_headers:
+        return body
+    seen_headers.add(header)
+    return [header] + body
@@ -1,29 +1,270 @@
+import asyncio
 import logging
 import os
 import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
 from functools import lru_cache
-from typing import Any
+from itertools import count
+from typing import Any, Iterator, NamedTuple, Sequence
 
 import psycopg
+from psycopg.adapt import Dumper
+from psycopg.pq import Format
+from psycopg.types import TypeInfo
+from psycopg_pool import AsyncConnectionPool
+
+from . import querystats
 
 logger = logging.getLogger(__name__)
 
 _sql_select_regex = re.compile(r"\bSELECT\b.*?\b", re.DOTALL | re.IGNORECASE)
+# queries that are safe to run again under EXPLAIN ANALYZE
+_sql_read_only_regex = re.compile(
+    r"^\s*(SELECT|WITH)\b(?!.*\b(INSERT|UPDATE|DELETE|MERGE)\b)",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# number of rows fetched from a server side cursor in one round trip
+DEFAULT_FETCH_SIZE = 2000
+
+# used to generate unique names for server side cursors
+_cursor_seq = count()
+
+# connection pools used by the async API, one per event loop
+_async_pools: dict[asyncio.AbstractEventLoop, AsyncConnectionPool] = {}
+
+SCHEMA_VERSION_TABLE = "sleuth_schema_version"
+
+# natural key of each kind of table, keyed by table name prefix.
+# a unique index on it is created by schema version 2
+_NATURAL_KEYS = {
+    "filing_text_chunks": ["cik", "accession_number", "chunk_num"],
+    "filing_chunks_embeddings": ["cik", "accession_number", "chunk_num"],
+    "search_phrase_embeddings": ["phrase", "tags"],
+    "trustee_comp_results": ["cik", "accession_number", "model", "tags"],
+    "master_idx": ["cik", "accession_number"],
+    "filing_chunks_relevance": ["cik", "accession_number", "tags", "phrase", "chunk_num"],
+    "filing_fingerprints": ["cik", "accession_number"],
+}
+_NATURAL_KEY_VERSION = 2
+
+# full text search document of a text chunk. chunks are only ranked within
+# a filing, found with the natural key index, so it is computed in the query
+TEXT_SEARCH_VECTOR = "to_tsvector('english', chunk_text)"
+
+
+def _natural_key_migration(prefix: str, merge_tags: bool = False) -> list[str]:
+    # remove existing duplicates, keeping the row written last,
+    # then replace the plain filing index with a unique index on the natural key.
+    # with merge_tags the row kept gets the tags of all its duplicates first
+    keys = _NATURAL_KEYS[prefix]
+    match = " AND ".join(f"a.{key} = b.{key}" for key in keys)
+    key_list = ", ".join(keys)
+    merge = [
+        "UPDATE {table} a SET tags = b.tags FROM ("
+        f" SELECT {key_list}, array_agg(DISTINCT tag ORDER BY tag) AS tags"
+        " FROM {table}, unnest(tags) AS tag"
+        f" GROUP BY {key_list} HAVING count(DISTINCT ctid) > 1"
+        f") b WHERE {match}",
+    ]
+    return (merge if merge_tags else []) + [
+        "DELETE FROM {table} a USING {table} b"
+        f" WHERE a.tableoid = b.tableoid AND a.ctid < b.ctid AND {match}",
+        "CREATE UNIQUE INDEX {concurrently} IF NOT EXISTS {table}_key"
+        f" ON {{table}} ({', '.join(keys)}{{partition_key}})",
+        "DROP INDEX {concurrently} IF EXISTS {table}_filing_idx",
+    ]
+
+
+# chunks copied from a near duplicate filing record the accession number
+# of the filing they were copied from
+_REUSED_FROM_MIGRATION = [
+    "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS reused_from VARCHAR(20)",
+]
+
+
+# schema migrations for each kind of table, keyed by table name prefix.
+# applying the n-th entry of the list brings the table to version n + 1.
+# {table} is replaced by the table name and {concurrently} by CONCURRENTLY
+# when migrating existing tables, so that writes are not blocked.
+# {partition_key} adds the partition column that unique indexes must include
+_SCHEMA_MIGRATIONS: dict[str, list[list[str]]] = {
+    "filing_text_chunks": [
+        [
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_filing_idx"
+            " ON {table} (cik, accession_number, chunk_num)",
+        ],
+        _natural_key_migration("filing_text_chunks"),
+        _REUSED_FROM_MIGRATION,
+    ],
+    "filing_chunks_embeddings": [
+        [
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_filing_idx"
+            " ON {table} (cik, accession_number, chunk_num)",
+        ],
+        _natural_key_migration("filing_chunks_embeddings"),
+        _REUSED_FROM_MIGRATION,
+    ],
+    "search_phrase_embeddings": [
+        [
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_tags_idx"
+            " ON {table} USING GIN (tags)",
+        ],
+        _natural_key_migration("search_phrase_embeddings"),
+    ],
+    "trustee_comp_results": [
+        [
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_filing_idx"
+            " ON {table} (cik, accession_number)",
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_tags_idx"
+            " ON {table} USING GIN (tags)",
+        ],
+        _natural_key_migration("trustee_comp_results"),
+        [
+            # results are reused across filings with the same selected text,
+            # reused_from is the accession number of the filing reused
+            "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS text_sha256 CHAR(64)",
+            "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS reused_from VARCHAR(20)",
+            "UPDATE {table} SET text_sha256 ="
+            " encode(sha256(convert_to(selected_text, 'UTF8')), 'hex')"
+            " WHERE text_sha256 IS NULL",
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_text_idx"
+            " ON {table} (text_sha256, model)",
+        ],
+        # model that answered when the request was hedged with another model
+        ["ALTER TABLE {table} ADD COLUMN IF NOT EXISTS answered_by VARCHAR(32)"],
+    ],
+    "master_idx": [
+        [
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_filing_idx"
+            " ON {table} (cik, accession_number)",
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_tags_idx"
+            " ON {table} USING GIN (tags)",
+        ],
+        # tags are not part of the key, rows of a filing tagged
+        # separately are merged into one row with all the tags
+        _natural_key_migration("master_idx", merge_tags=True),
+    ],
+    "filing_chunks_relevance": [
+        [
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_filing_idx"
+            " ON {table} (cik, accession_number)",
+        ],
+        _natural_key_migration("filing_chunks_relevance"),
+    ],
+    "filing_fingerprints": [
+        [
+            "CREATE INDEX {concurrently} IF NOT EXISTS {table}_filing_idx"
+            " ON {table} (cik, accession_number)",
+        ],
+        _natural_key_migration("filing_fingerprints"),
+        # a filing is only compared with the filings of its cik filed before it
+        ["ALTER TABLE {table} ADD COLUMN IF NOT EXISTS date_filed DATE"],
+    ],
+}
+
+# migration statements adding a plain nullable column, as opposed to
+# a generated column, which rewrites the whole table
+_nullable_column_regex = re.compile(
+    r"ALTER TABLE \{table\} ADD COLUMN IF NOT EXISTS \w+ [\w()]+$"
+)
+
+# optional approximate nearest neighbor indexes on embeddings
+_VECTOR_INDEXES = {
+    "hnsw": "CREATE INDEX {concurrently} IF NOT EXISTS {table}_embedding_hnsw_idx"
+    " ON {table} USING hnsw (embedding vector_cosine_ops)",
+    "ivfflat": "CREATE INDEX {concurrently} IF NOT EXISTS {table}_embedding_ivfflat_idx"
+    " ON {table} USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100)",
+}
+
+# tables whose schema version has been checked by this process
+_tables_checked: set[str] = set()
+
+# natural key of tables seen by this process, None when the table
+# has no unique index on it yet, see _natural_key
+_table_keys: dict[str, list[str] | None] = {}
+
+# number of partitions of hash partitioned tables, fixed when the table is created
+HASH_PARTITIONS = 32
+
+# chunk and embedding tables can optionally be partitioned by hash of cik
+# or by the filing year, which is derived from the accession number
+_PARTITION_CLAUSES = {
+    "": ")",
+    "hash": ") PARTITION BY HASH (cik)",
+    "year": """,
+            filing_year SMALLINT NOT NULL) PARTITION BY RANGE (filing_year)""",
+}
+
+# partitioning of tables seen by this process, "" when not partitioned
+_table_partitioning: dict[str, str] = {}
+
+# partitions known to exist, see _ensure_partition
+_partitions_created: set[str] = set()
+
+# the async API runs table and partition setup on the shared connection in
+# worker threads, one at a time so that their transactions do not interleave
+_committed_lock = threading.Lock()
+
+
+# errors that indicate COPY cannot be used on this connection,
+# e.g. when going through a proxy that does not support the COPY protocol
+_COPY_UNAVAILABLE_ERRORS = (
+    psycopg.NotSupportedError,
+    psycopg.errors.FeatureNotSupported,
+)
 
 
 class DatabaseException(Exception):
     pass
 
 
+class _VectorBinaryDumper(Dumper):
+    """
+    dump a list of floats in pgvector binary format, i.e.
+    int16 dimension, int16 unused, followed by float4 values
+    the oid is filled in at runtime once the vector type is looked up
+    """
+
+    format = Format.BINARY
+
+    def dump(self, obj) -> bytes:
+        return struct.pack(f">HH{len(obj)}f", len(obj), 0, *obj)
+
+
 # use lru_cache to make a singleton
 @lru_cache(maxsize=1)
 def _conn() -> psycopg.Connection:
+    return _connect()
+
+
+def _connect() -> psycopg.Connection:
     database_url = os.environ.get("DATABASE_URL", "")
     if database_url:
         return psycopg.connect(database_url)
     raise ValueError("DATABASE_URL is not set")
 
 
+@lru_cache(maxsize=1)
+def _vector_type_registered() -> bool:
+    """
+    register the pgvector type and binary dumper with the connection
+    so that embeddings can be written using binary COPY
+    return False if the vector extension is not installed
+    """
+    info = TypeInfo.fetch(_conn(), "vector")
+    if info is None:
+        return False
+
+    info.register(_conn())
+    dumper = type("VectorBinaryDumper", (_VectorBinaryDumper,), {"oid": info.oid})
+    _conn().adapters.register_dumper(None, dumper)
+    return True
+
+
 def relevant_chunks_with_distances(
     cik: str,
     accession_number: str,
@@ -36,6 +277,33 @@ def relevant_chunks_with_distances(
     Perform a vector search and return the most relevent chunks numbers
     along with their distance
     """
+    query, params = relevant_chunks_query(
+        cik=cik,
+        accession_number=accession_number,
+        embedding_table_name=embedding_table_name,
+        search_phrase_table_name=search_phrase_table_name,
+        search_phrase_tag=search_phrase_tag,
+        limit=limit,
+    )
+    result = execute_query(query, params, prepare=True)
+    return result
+
+
+def relevant_chunks_query(
+    cik: str,
+    accession_number: str,
+    embedding_table_name: str,
+    search_phrase_table_name: str,
+    search_phrase_tag: str,
+    limit: int = 1000,
+) -> tuple[str, tuple]:
+    """SQL and parameters used by relevant_chunks_with_distances"""
+    params = (cik, accession_number, search_phrase_tag)
+    partition_filter = ""
+    if _partitioning(embedding_table_name) == "year":
+        partition_filter = "AND filing_year = %s"
+        params += (_filing_year(accession_number),)
+
     query = f"""
         SELECT
             cik, accession_number, phrase, chunk_num,
@@ -46,15 +314,211 @@ def relevant_chunks_with_distances(
         WHERE
             cik = %s AND accession_number = %s
             AND %s = ANY(phrases.tags)
+            {partition_filter}
         ORDER BY
             embedding <=> phrase_embedding
         LIMIT {limit};
     """
-    result = execute_query(
-        query,
-        (cik, accession_number, search_phrase_tag),
+    return query, params
+
+
+def relevant_chunks_for_filings(
+    filings: Sequence[tuple[str, str]],
+    embedding_table_name: str,
+    search_phrase_table_name: str,
+    search_phrase_tag: str,
+    top_k: int = 20,
+    phrases: Sequence[tuple[str, list[float]]] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Vector search for a batch of filings in one query, returning the top_k
+    chunks of each filing for each search phrase, ordered by filing and distance.
+
+    phrases are (phrase, embedding) pairs already loaded by the caller, they
+    are sent as parameters instead of reading the search phrase table.
+    """
+    if not filings:
+        return []
+
+    query, params = relevant_chunks_batch_query(
+        filings=filings,
+        embedding_table_name=embedding_table_name,
+        search_phrase_table_name=search_phrase_table_name,
+        search_phrase_tag=search_phrase_tag,
+        top_k=top_k,
+        phrases=phrases,
     )
-    return result
+    return execute_query(query, params, prepare=True)
+
+
+def relevant_chunks_batch_query(
+    filings: Sequence[tuple[str, str]],
+    embedding_table_name: str,
+    search_phrase_table_name: str,
+    search_phrase_tag: str,
+    top_k: int = 20,
+    phrases: Sequence[tuple[str, list[float]]] | None = None,
+) -> tuple[str, tuple]:
+    """
+    SQL and parameters used by relevant_chunks_for_filings. The filings are
+    passed as arrays, so the statement has the same shape for any batch size
+    and the LATERAL subquery is an index scan on the filing's chunks.
+    """
+    ciks = [cik for cik, _ in filings]
+    accession_numbers = [accession_number for _, accession_number in filings]
+    filing_columns = "%s::text[], %s::text[]"
+    filing_names = "cik, accession_number"
+    partition_filter = ""
+    params: tuple = (ciks, accession_numbers)
+    if _partitioning(embedding_table_name) == "year":
+        filing_columns += ", %s::int2[]"
+        filing_names += ", filing_year"
+        partition_filter = "AND e.filing_year = f.filing_year"
+        params += (
+            [_filing_year(accession_number) for accession_number in accession_numbers],
+        )
+
+    if phrases is None:
+        phrase_source = f"""(
+            SELECT phrase, phrase_embedding FROM {search_phrase_table_name}
+            WHERE %s = ANY(tags)) phrases"""
+        params += (search_phrase_tag,)
+    else:
+        phrase_source = """unnest(%s::text[], %s::text[]::vector[])
+            AS phrases(phrase, phrase_embedding)"""
+        params += (
+            [phrase for phrase, _ in phrases],
+            [_vector_literal(embedding) for _, embedding in phrases],
+        )
+
+    query = f"""
+        SELECT
+            f.cik, f.accession_number, phrases.phrase, c.chunk_num, c.distance
+        FROM
+            unnest({filing_columns}) AS f({filing_names})
+            CROSS JOIN {phrase_source}
+            CROSS JOIN LATERAL (
+                SELECT
+                    e.chunk_num,
+                    e.embedding <=> phrases.phrase_embedding AS distance
+                FROM {embedding_table_name} e
+                WHERE
+                    e.cik = f.cik AND e.accession_number = f.accession_number
+                    {partition_filter}
+                ORDER BY e.embedding <=> phrases.phrase_embedding
+                LIMIT %s
+            ) c
+        ORDER BY
+            f.cik, f.accession_number, c.distance
+    """
+    return query, params + (top_k,)
+
+
+def get_embeddings(
+    filings: Sequence[tuple[str, str]],
+    table_name: str,
+) -> list[dict[str, Any]]:
+    """
+    Embeddings of a batch of filings as lists of floats, ordered by
+    filing and chunk number, for computing distances outside the database.
+    """
+    if not filings:
+        return []
+
+    filing_columns = "%s::text[], %s::text[]"
+    filing_names = "cik, accession_number"
+    partition_filter = ""
+    params: tuple = (
+        [cik for cik, _ in filings],
+        [accession_number for _, accession_number in filings],
+    )
+    if _partitioning(table_name) == "year":
+        filing_columns += ", %s::int2[]"
+        filing_names += ", filing_year"
+        partition_filter = "AND e.filing_year = f.filing_year"
+        params += ([_filing_year(accession_number) for _, accession_number in filings],)
+
+    query = f"""
+        SELECT e.cik, e.accession_number, e.chunk_num, e.embedding::real[] AS embedding
+        FROM {table_name} e
+        JOIN unnest({filing_columns}) AS f({filing_names})
+            ON e.cik = f.cik AND e.accession_number = f.accession_number
+            {partition_filter}
+        ORDER BY e.cik, e.accession_number, e.chunk_num
+    """
+    return execute_query(query, params, prepare=True)
+
+
+def search_chunks(
+    query_embedding: list[float],
+    embedding_table_name: str,
+    index_table_name: str,
+    text_table_name: str = "",
+    limit: int = 10,
+    ef_search: int = 40,
+    exact: bool = False,
+) -> list[dict[str, Any]]:
+    """
+    Nearest neighbor search for the chunks closest to query_embedding across
+    all filings in the embedding table, with company name and filing date
+    from the index table and the chunk text when text_table_name is given.
+
+    With an HNSW index on the table, created by migrate --vector-index=hnsw,
+    the search is approximate and ef_search trades speed for recall.
+    exact=True disables index scans to get the exact nearest chunks.
+    """
+    text_column, text_join = "", ""
+    if text_table_name:
+        text_column = ", t.chunk_text"
+        text_join = f"""
+            LEFT JOIN {text_table_name} t ON t.cik = n.cik
+                AND t.accession_number = n.accession_number
+                AND t.chunk_num = n.chunk_num"""
+
+    query = f"""
+        WITH nearest AS (
+            SELECT
+                cik, accession_number, chunk_num,
+                embedding <=> %s::vector AS distance
+            FROM {embedding_table_name}
+            ORDER BY embedding <=> %s::vector
+            LIMIT %s
+        )
+        SELECT
+            n.cik, n.accession_number, n.chunk_num, n.distance,
+            idx.company_name, TO_CHAR(idx.date_filed, 'YYYY-MM-DD') AS date_filed
+            {text_column}
+        FROM nearest n
+        LEFT JOIN LATERAL (
+            SELECT company_name, date_filed FROM {index_table_name} i
+            WHERE i.cik = n.cik AND i.accession_number = n.accession_number
+            LIMIT 1
+        ) idx ON true
+        {text_join}
+        ORDER BY n.distance
+    """
+    vector = _vector_literal(query_embedding)
+    params = (vector, vector, limit)
+
+    # the settings only apply to this transaction, so the search runs on its
+    # own connection instead of leaving them on the shared one
+    with _connect() as conn:
+        try:
+            with conn.transaction():
+                conn.execute(
+                    "SELECT set_config('hnsw.ef_search', %s, true)", (str(ef_search),)
+                )
+                if exact:
+                    conn.execute("SELECT set_config('enable_indexscan', 'off', true)")
+
+                start = time.perf_counter()
+                cur = conn.execute(query, params)  # pyright: ignore
+                result = _as_dicts(cur.fetchall(), cur.description)
+                querystats.record(query, _elapsed_ms(start), rows=len(result))
+                return result
+        except psycopg.Error as e:
+            logger.info(f"Database error: {e} when searching {embedding_table_name}")
+            raise DatabaseException(str(e)) from e
 
 
 def get_chunks(
@@ -63,6 +527,29 @@ def get_chunks(
     table_name: str,
     chunk_nums: list[int] = [],
 ) -> list[dict[str, Any]]:
+    query, params = get_chunks_query(cik, accession_number, table_name, chunk_nums)
+    return execute_query(query, params, prepare=True)
+
+
+def count_chunks(cik: str, accession_number: str, table_name: str) -> int:
+    query = f"""
+        SELECT COUNT(*) AS count FROM {table_name}
+        WHERE cik = %s AND accession_number = %s
+    """
+    params: tuple = (cik, accession_number)
+    if _partitioning(table_name) == "year":
+        query += " AND filing_year = %s"
+        params += (_filing_year(accession_number),)
+    return execute_query(query, params, prepare=True)[0]["count"]
+
+
+def get_chunks_query(
+    cik: str,
+    accession_number: str,
+    table_name: str,
+    chunk_nums: list[int] = [],
+) -> tuple[str, tuple]:
+    """SQL and parameters used by get_chunks"""
     col = "embedding" if "embedding" in table_name else "chunk_text"
 
     query = f"""
@@ -71,11 +558,41 @@ def get_chunks(
         WHERE cik = %s AND accession_number = %s
     """
     params = (cik, accession_number)
+    if _partitioning(table_name) == "year":
+        query += " AND filing_year = %s"
+        params += (_filing_year(accession_number),)
     if chunk_nums:
         query += " AND chunk_num = ANY(%s)"
         params += (chunk_nums,)
 
-    return execute_query(query + " ORDER BY chunk_num", params)
+    return query + " ORDER BY chunk_num", params
+
+
+def rank_chunks_by_text(
+    cik: str,
+    accession_number: str,
+    table_name: str,
+    tsquery: str,
+    limit: int,
+) -> list[dict[str, Any]]:
+    """
+    Rank the text chunks of a filing against a full text search query
+    in to_tsquery syntax, e.g. "trustee | compensation", and return
+    the chunk_num and rank of the top limit chunks, best first.
+    Chunks that do not match the query are left out.
+    """
+    query = f"""
+        SELECT chunk_num, ts_rank_cd({TEXT_SEARCH_VECTOR}, q) AS rank
+        FROM {table_name}, to_tsquery('english', %s) AS q
+        WHERE cik = %s AND accession_number = %s AND {TEXT_SEARCH_VECTOR} @@ q
+    """
+    params: tuple = (tsquery, cik, accession_number)
+    if _partitioning(table_name) == "year":
+        query += " AND filing_year = %s"
+        params += (_filing_year(accession_number),)
+
+    query += " ORDER BY rank DESC, chunk_num LIMIT %s"
+    return execute_query(query, params + (limit,), prepare=True)
 
 
 def save_chunks(
@@ -84,15 +601,121 @@ def save_chunks(
     chunks: list[str] | list[list[float]],
     table_name: str,
     create_table: bool = False,
+    partition: str = "",
+    chunk_nums: list[int] | None = None,
 ) -> None:
+    """
+    Save the text chunks or embeddings of a filing, replacing the chunks
+    saved earlier for the same filing in a single transaction, so that
+    a rerun never leaves duplicate or partial chunk sets behind.
+
+    partition only applies when the table is created, it can be "hash" to
+    partition by hash of cik or "year" to partition by filing year.
+    partitions are created on demand.
+
+    chunks are numbered by their position in the list, unless chunk_nums
+    is given, e.g. when only some of the chunks of a filing are embedded.
+    """
     if len(chunks) == 0:
         return
 
+    write = _prepare_chunk_write(
+        cik, accession_number, chunks, table_name, create_table, partition, chunk_nums
+    )
+    try:
+        start = time.perf_counter()
+        _conn().execute(write.delete_query, write.delete_params)  # pyright: ignore
+        querystats.record(write.delete_query, _elapsed_ms(start))
+        _write_rows(table_name, write.columns, write.rows, types=write.types)
+        _conn().commit()
+    except psycopg.Error as e:
+        logger.info(f"Database error: {e} when writing to {table_name}")
+        _conn().rollback()
+        raise DatabaseException(str(e)) from e
+
+
+def copy_chunks(
+    cik: str,
+    accession_number: str,
+    source_accession_number: str,
+    table_name: str,
+) -> int:
+    """
+    Replace the chunks of a filing with a copy of the chunks of another
+    filing of the same cik, e.g. a near duplicate filed earlier. the copied
+    rows record the source accession number in reused_from.
+    Returns the number of chunks copied.
+    """
+    col = "embedding" if "embedding" in table_name else "chunk_text"
+    columns = ["cik", "accession_number", "chunk_num", col, "reused_from"]
+    values = ["%s", "%s", "chunk_num", col, "%s"]
+    params: tuple = (cik, accession_number, source_accession_number)
+    source = "cik = %s AND accession_number = %s"
+    source_params: tuple = (cik, source_accession_number)
+    delete_query = f"DELETE FROM {table_name} WHERE cik = %s AND accession_number = %s"
+    delete_params: tuple = (cik, accession_number)
+
+    partitioning = _partitioning(table_name)
+    if partitioning:
+        _ensure_partition(table_name, partitioning, cik, accession_number)
+    if partitioning == "year":
+        columns.append("filing_year")
+        values.append("%s")
+        params += (_filing_year(accession_number),)
+        source += " AND filing_year = %s"
+        source_params += (_filing_year(source_accession_number),)
+        delete_query += " AND filing_year = %s"
+        delete_params += (_filing_year(accession_number),)
+
+    query = f"""
+        INSERT INTO {table_name} ({", ".join(columns)})
+        SELECT {", ".join(values)} FROM {table_name} WHERE {source}
+    """
+    try:
+        start = time.perf_counter()
+        _conn().execute(delete_query, delete_params)  # pyright: ignore
+        querystats.record(delete_query, _elapsed_ms(start))
+        start = time.perf_counter()
+        n_copied = _conn().execute(query, params + source_params).rowcount  # pyright: ignore
+        querystats.record(query, _elapsed_ms(start), rows=n_copied)
+        _conn().commit()
+        return n_copied
+    except psycopg.Error as e:
+        logger.info(f"Database error: {e} when copying chunks in {table_name}")
+        _conn().rollback()
+        raise DatabaseException(str(e)) from e
+
+
+class _ChunkWrite(NamedTuple):
+    columns: list[str]
+    rows: list[tuple]
+    types: list[str] | None
+    delete_query: str
+    delete_params: tuple
+
+
+def _prepare_chunk_write(
+    cik: str,
+    accession_number: str,
+    chunks: list[str] | list[list[float]],
+    table_name: str,
+    create_table: bool,
+    partition: str,
+    chunk_nums: list[int] | None = None,
+) -> _ChunkWrite:
+    """
+    create the table and partition if needed, and build the rows and statements
+    used by save_chunks and asave_chunks to replace the chunks of a filing
+    """
     # dimenion only matters when saving embeddings
     dimension = len(chunks[0]) if isinstance(chunks[0], list) else 0
 
     if create_table:
-        _create_table(table_name, dimension=dimension)
+        _create_table(table_name, dimension=dimension, partition=partition)
+
+    partitioning = _partitioning(table_name)
+    if partitioning:
+        _ensure_partition(table_name, partitioning, cik, accession_number)
 
     data = [
         (
@@ -101,36 +724,72 @@ def save_chunks(
             chunk_num,
             text_or_embedding,
         )
-        for chunk_num, text_or_embedding in enumerate(chunks)
-    ]
-    with _conn().cursor() as cur:
-        col = "embedding" if dimension > 10 else "chunk_text"
-        cur.executemany(
-            f"""
-            INSERT INTO {table_name} (cik, accession_number, chunk_num, {col})
-            VALUES (%s, %s, %s, %s)
-            """,  # pyright: ignore
-            data,
+        for chunk_num, text_or_embedding in zip(
+            chunk_nums if chunk_nums is not None else range(len(chunks)), chunks
         )
-    _conn().commit()
+    ]
+    col = "embedding" if dimension > 10 else "chunk_text"
+    columns = ["cik", "accession_number", "chunk_num", col]
+    # embeddings are sent using binary COPY, text chunks using text COPY
+    types = ["varchar", "varchar", "int4", "vector"] if dimension > 10 else None
+
+    delete_query = f"DELETE FROM {table_name} WHERE cik = %s AND accession_number = %s"
+    delete_params = (cik, accession_number)
 
+    if partitioning == "year":
+        filing_year = _filing_year(accession_number)
+        data = [row + (filing_year,) for row in data]
+        columns.append("filing_year")
+        if types:
+            types.append("int2")
+        delete_query += " AND filing_year = %s"
+        delete_params += (filing_year,)
 
-def execute_query(query: str, params: tuple | None = None) -> list[dict[str, Any]]:
+    return _ChunkWrite(columns, data, types, delete_query, delete_params)
+
+
+def execute_query(
+    query: str,
+    params: tuple | None = None,
+    prepare: bool | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Execute a query and return the rows as a list of dicts.
+    Use prepare=True for queries with a fixed shape that are executed
+    many times, so that the server parses and plans them only once
+    per connection. By default psycopg prepares a query after it has
+    been executed a few times.
+    """
     result = []
     with _conn().cursor() as cur:
-        logger.debug(f"Executing query: {query}\nwith parameters: {params}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Executing query: {_query_summary(query, params)}")
 
         try:
-            if _sql_select_regex.search(query):
+            start = time.perf_counter()
+            if _is_select(query):
                 # it's a select
-                cur.execute(query, params)  # pyright: ignore
-                rows = cur.fetchall()
-                column_names = [desc[0] for desc in cur.description]  # pyright: ignore
-                return [dict(zip(column_names, row)) for row in rows]
+                cur.execute(query, params, prepare=prepare)  # pyright: ignore
+                result = _as_dicts(cur.fetchall(), cur.description)
+                elapsed_ms = _elapsed_ms(start)
+                querystats.record(
+                    query,
+                    elapsed_ms,
+                    rows=len(result),
+                    nbytes=querystats.estimate_size(params, result),
+                )
+                _explain_slow(cur, query, params, elapsed_ms)
+                return result
             else:
                 # it's not a select
-                cur.execute(query, params)  # pyright: ignore
+                cur.execute(query, params, prepare=prepare)  # pyright: ignore
                 _conn().commit()
+                querystats.record(
+                    query,
+                    _elapsed_ms(start),
+                    rows=max(cur.rowcount, 0),
+                    nbytes=querystats.estimate_size(params),
+                )
                 return []  # empty list means success
 
         except psycopg.errors.SyntaxError as e:
@@ -147,52 +806,675 @@ def execute_query(query: str, params: tuple | None = None) -> list[dict[str, Any
     return result
 
 
+class QueryBatch:
+    """
+    Collect independent queries and send them to the server together using
+    psycopg pipeline mode, so that the whole batch costs a single round trip
+    instead of one per query. Queries are prepared on the server so repeated
+    batches with the same shapes skip parsing and planning.
+
+        with query_batch() as batch:
+            first = batch.add(*get_chunks_query(cik, accession_1, table_name))
+            second = batch.add(*get_chunks_query(cik, accession_2, table_name))
+        first_chunks = batch.results[first]
+    """
+
+    def __init__(self) -> None:
+        self.queries: list[tuple[str, tuple | None]] = []
+        self.results: list[list[dict[str, Any]]] = []
+
+    def add(self, query: str, params: tuple | None = None) -> int:
+        """queue a query, return the index of its result in results"""
+        self.queries.append((query, params))
+        return len(self.queries) - 1
+
+    def execute(self) -> list[list[dict[str, Any]]]:
+        if not self.queries:
+            return []
+
+        conn = _conn()
+        try:
+            cursors = []
+            start = time.perf_counter()
+            with conn.pipeline():
+                for query, params in self.queries:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Queueing query: {_query_summary(query, params)}")
+                    cur = conn.cursor()
+                    cur.execute(query, params, prepare=True)  # pyright: ignore
+                    cursors.append(cur)
+
+            # leaving the pipeline block has synced all results
+            self.results = [
+                _as_dicts(cur.fetchall(), cur.description) if cur.description else []
+                for cur in cursors
+            ]
+            if not all(_is_select(query) for query, _ in self.queries):
+                conn.commit()
+
+            # the queries share one round trip, so the time is split evenly
+            elapsed_ms = _elapsed_ms(start) / len(self.queries)
+            for (query, params), cur, rows in zip(self.queries, cursors, self.results):
+                querystats.record(
+                    query,
+                    elapsed_ms,
+                    rows=len(rows) if cur.description else max(cur.rowcount, 0),
+                    nbytes=querystats.estimate_size(params, rows),
+                )
+            return self.results
+
+        except psycopg.Error as e:
+            logger.info(f"Database error: {e} when executing batch")
+            conn.rollback()
+            raise DatabaseException(str(e)) from e
+
+
+@contextmanager
+def query_batch() -> Iterator[QueryBatch]:
+    """queue queries in a QueryBatch and execute them on exit"""
+    batch = QueryBatch()
+    yield batch
+    batch.execute()
+
+
+@lru_cache(maxsize=256)
+def _is_select(query: str) -> bool:
+    return _sql_select_regex.search(query) is not None
+
+
+def _as_dicts(rows: list[tuple], description) -> list[dict[str, Any]]:
+    column_names = [desc[0] for desc in description]
+    return [dict(zip(column_names, row)) for row in rows]
+
+
+def _elapsed_ms(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+def _query_summary(query: str, params: tuple | None) -> str:
+    # embeddings make the parameters several KB long, only log their size
+    return f"{querystats.normalize_query(query)} with {len(params or ())} parameters, {querystats.estimate_size(params)} bytes"  # noqa: E501
+
+
+def _explain_query(query: str, params: tuple | None, elapsed_ms: float) -> str | None:
+    """
+    return the EXPLAIN statement to capture the plan of a slow query,
+    or None if the plan is not wanted or running the query again is not safe
+    """
+    if not querystats.wants_plan(query, elapsed_ms):
+        return None
+    if not _sql_read_only_regex.search(query):
+        return None
+    return f"EXPLAIN (ANALYZE, BUFFERS) {query}"
+
+
+def _explain_slow(
+    cur: psycopg.Cursor, query: str, params: tuple | None, elapsed_ms: float
+) -> None:
+    if explain := _explain_query(query, params, elapsed_ms):
+        try:
+            # savepoint, so that a failure does not abort the caller's transaction
+            with cur.connection.transaction():
+                cur.execute(explain, params)  # pyright: ignore
+                plan = "\n".join(row[0] for row in cur.fetchall())
+            querystats.record_plan(query, elapsed_ms, plan)
+        except psycopg.Error as e:
+            logger.info(f"Unable to explain slow query: {e}")
+
+
+def stream_query(
+    query: str,
+    params: tuple | None = None,
+    fetch_size: int = DEFAULT_FETCH_SIZE,
+    row_mode: str = "dict",
+) -> Iterator[Any]:
+    """
+    Execute a SELECT using a server side cursor and yield the result
+    as it arrives, fetch_size rows per round trip, so that memory usage
+    stays constant regardless of the size of the result.
+
+    row_mode controls what is yielded:
+        dict:     one dict per row, same as execute_query
+        tuple:    one tuple per row
+        columnar: one dict of column name to list of values per fetch
+
+    The cursor runs on its own connection, so that commits on the shared
+    connection while the result is being consumed do not close the cursor.
+    """
+    if row_mode not in ("dict", "tuple", "columnar"):
+        raise ValueError(f"Unknown row_mode {row_mode}")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Streaming query: {_query_summary(query, params)}")
+
+    conn = _connect()
+    # only time spent waiting on the server counts, not the time
+    # the caller takes to consume the rows
+    elapsed_ms, n_rows, n_bytes = 0.0, 0, querystats.estimate_size(params)
+    try:
+        with conn.cursor(name=f"sleuth_stream_{next(_cursor_seq)}") as cur:
+            cur.itersize = fetch_size
+            start = time.perf_counter()
+            cur.execute(query, params)  # pyright: ignore
+            column_names = [desc[0] for desc in cur.description]  # pyright: ignore
+            elapsed_ms += _elapsed_ms(start)
+
+            while True:
+                start = time.perf_counter()
+                rows = cur.fetchmany(fetch_size)
+                elapsed_ms += _elapsed_ms(start)
+                if not rows:
+                    break
+                n_rows += len(rows)
+                n_bytes += querystats.estimate_size(rows=rows)
+
+                if row_mode == "dict":
+                    yield from (dict(zip(column_names, row)) for row in rows)
+                elif row_mode == "tuple":
+                    yield from rows
+                else:
+                    yield dict(zip(column_names, map(list, zip(*rows))))
+
+    except psycopg.Error as e:
+        logger.info(f"Database error: {e} when streaming {query}")
+        raise DatabaseException(str(e)) from e
+    finally:
+        querystats.record(query, elapsed_ms, rows=n_rows, nbytes=n_bytes)
+        conn.close()
+
+
 def execute_insertmany(
     table_name: str, data: list[dict[str, Any]], create_table: bool
 ) -> bool:
+    """
+    Write rows into a table. When the table has a unique index on its
+    natural key, rows with an existing key update the existing row
+    instead of adding a duplicate.
+    """
     if len(data) == 0:
         return False
 
-    dimension = 0
-    for _, value in data[0].items():
-        if isinstance(value, list):
-            if len(value) > 0 and isinstance(value[0], float):
-                dimension = len(value)
-                break
-
-    if create_table:
-        _create_table(table_name, dimension)
-
-    columns = ", ".join(data[0].keys())
-    placeholders = ", ".join(["%s"] * len(data[0]))
-    bindings = [tuple(item.values()) for item in data]
-    query = f" INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
+    columns, bindings, keys = _prepare_insert(table_name, data, create_table)
     try:
-        with _conn().cursor() as cur:
-            cur.executemany(query, bindings)  # pyright: ignore
+        if keys:
+            _upsert_rows(table_name, columns, bindings, keys)
+        else:
+            _write_rows(table_name, columns, bindings)
         _conn().commit()
         logger.debug(f"Inserted {len(data)} rows into {table_name}")
         return True
     except psycopg.errors.SyntaxError as e:
-        logger.info(f"Syntax error: {str(e)} {query}")
+        logger.info(f"Syntax error: {str(e)} when writing to {table_name}")
         raise DatabaseException from e
     except psycopg.Error as e:
         if isinstance(e, psycopg.errors.UndefinedTable):
             logger.info(f"Table does not exist: {str(e)}")
         else:
-            logger.info(f"Database error: {e} when executing {query}")
+            logger.info(f"Database error: {e} when writing to {table_name}")
         _conn().rollback()
         raise DatabaseException(str(e)) from e
 
 
-def _create_table(table_name: str, dimension: int = 0):
+async def aexecute_query(
+    query: str,
+    params: tuple | None = None,
+    prepare: bool | None = None,
+) -> list[dict[str, Any]]:
+    """async version of execute_query, using a connection from the async pool"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Executing query: {_query_summary(query, params)}")
+    try:
+        pool = await _async_pool()
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                start = time.perf_counter()
+                await cur.execute(query, params, prepare=prepare)  # pyright: ignore
+                result = []
+                if _is_select(query):
+                    result = _as_dicts(await cur.fetchall(), cur.description)
+                elapsed_ms = _elapsed_ms(start)
+                querystats.record(
+                    query,
+                    elapsed_ms,
+                    rows=len(result) if cur.description else max(cur.rowcount, 0),
+                    nbytes=querystats.estimate_size(params, result),
+                )
+                if explain := _explain_query(query, params, elapsed_ms):
+                    await _aexplain_slow(cur, explain, query, params, elapsed_ms)
+                return result  # empty list means success for non select
+    except psycopg.Error as e:
+        logger.info(f"Database error: {e} when executing {query}")
+        raise DatabaseException(str(e)) from e
+
+
+async def aexecute_insertmany(
+    table_name: str, data: list[dict[str, Any]], create_table: bool
+) -> bool:
+    """async version of execute_insertmany"""
+    if len(data) == 0:
+        return False
+
+    columns, bindings, keys = await asyncio.to_thread(
+        _committed, _prepare_insert, table_name, data, create_table
+    )
+    try:
+        pool = await _async_pool()
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                if keys:
+                    stage_name = f"{table_name}_stage"
+                    await conn.execute(_stage_sql(table_name, stage_name))  # pyright: ignore
+                    await _awrite_rows(conn, stage_name, columns, bindings)
+                    merge = _merge_sql(table_name, stage_name, columns, keys)
+                    start = time.perf_counter()
+                    cur = await conn.execute(merge)  # pyright: ignore
+                    querystats.record(
+                        merge, _elapsed_ms(start), rows=max(cur.rowcount, 0)
+                    )
+                else:
+                    await _awrite_rows(conn, table_name, columns, bindings)
+        logger.debug(f"Inserted {len(data)} rows into {table_name}")
+        return True
+    except psycopg.Error as e:
+        logger.info(f"Database error: {e} when writing to {table_name}")
+        raise DatabaseException(str(e)) from e
+
+
+async def aget_chunks(
+    cik: str,
+    accession_number: str,
+    table_name: str,
+    chunk_nums: list[int] = [],
+) -> list[dict[str, Any]]:
+    """async version of get_chunks"""
+    await _alookup_partitioning(table_name)
+    query, params = get_chunks_query(cik, accession_number, table_name, chunk_nums)
+    return await aexecute_query(query, params, prepare=True)
+
+
+async def asave_chunks(
+    cik: str,
+    accession_number: str,
+    chunks: list[str] | list[list[float]],
+    table_name: str,
+    create_table: bool = False,
+    partition: str = "",
+    chunk_nums: list[int] | None = None,
+) -> None:
+    """async version of save_chunks"""
+    if len(chunks) == 0:
+        return
+
+    write = await asyncio.to_thread(
+        _committed,
+        _prepare_chunk_write,
+        cik,
+        accession_number,
+        chunks,
+        table_name,
+        create_table,
+        partition,
+        chunk_nums,
+    )
+    try:
+        pool = await _async_pool()
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                start = time.perf_counter()
+                await conn.execute(write.delete_query, write.delete_params)  # pyright: ignore
+                querystats.record(write.delete_query, _elapsed_ms(start))
+                await _awrite_rows(
+                    conn, table_name, write.columns, write.rows, write.types
+                )
+    except psycopg.Error as e:
+        logger.info(f"Database error: {e} when writing to {table_name}")
+        raise DatabaseException(str(e)) from e
+
+
+async def arelevant_chunks_with_distances(
+    cik: str,
+    accession_number: str,
+    embedding_table_name: str,
+    search_phrase_table_name: str,
+    search_phrase_tag: str,
+    limit: int = 1000,
+) -> list[dict[str, Any]]:
+    """async version of relevant_chunks_with_distances"""
+    await _alookup_partitioning(embedding_table_name)
+    query, params = relevant_chunks_query(
+        cik=cik,
+        accession_number=accession_number,
+        embedding_table_name=embedding_table_name,
+        search_phrase_table_name=search_phrase_table_name,
+        search_phrase_tag=search_phrase_tag,
+        limit=limit,
+    )
+    return await aexecute_query(query, params, prepare=True)
+
+
+async def aclose_pool() -> None:
+    """close the async connection pool of the running event loop"""
+    pool = _async_pools.pop(asyncio.get_running_loop(), None)
+    if pool:
+        await pool.close()
+
+
+async def _async_pool() -> AsyncConnectionPool:
+    loop = asyncio.get_running_loop()
+    if loop not in _async_pools:
+        database_url = os.environ.get("DATABASE_URL", "")
+        if not database_url:
+            raise ValueError("DATABASE_URL is not set")
+
+        pool = AsyncConnectionPool(
+            database_url,
+            min_size=1,
+            max_size=int(os.environ.get("DATABASE_POOL_SIZE", "10")),
+            configure=_aconfigure_connection,
+            open=False,
+        )
+        await pool.open()
+        _async_pools[loop] = pool
+
+    return _async_pools[loop]
+
+
+async def _aconfigure_connection(conn: psycopg.AsyncConnection) -> None:
+    # same as _vector_type_registered, for connections in the async pool
+    info = await TypeInfo.fetch(conn, "vector")
+    if info is not None:
+        info.register(conn)
+        dumper = type("VectorBinaryDumper", (_VectorBinaryDumper,), {"oid": info.oid})
+        conn.adapters.register_dumper(None, dumper)
+    await conn.commit()
+
+
+async def _alookup_partitioning(table_name: str) -> None:
+    # the sync lookup is cached, run it once off the event loop
+    if table_name not in _table_partitioning:
+        await asyncio.to_thread(_committed, _partitioning, table_name)
+
+
+async def _aexplain_slow(
+    cur: psycopg.AsyncCursor,
+    explain: str,
+    query: str,
+    params: tuple | None,
+    elapsed_ms: float,
+) -> None:
+    try:
+        async with cur.connection.transaction():
+            await cur.execute(explain, params)  # pyright: ignore
+            plan = "\n".join(row[0] for row in await cur.fetchall())
+        querystats.record_plan(query, elapsed_ms, plan)
+    except psycopg.Error as e:
+        logger.info(f"Unable to explain slow query: {e}")
+
+
+async def _awrite_rows(
+    conn: psycopg.AsyncConnection,
+    table_name: str,
+    columns: list[str],
+    rows: Sequence[tuple],
+    types: list[str] | None = None,
+) -> None:
+    """async version of _write_rows"""
+    can_copy = not (
+        types and "vector" in types and conn.adapters.types.get("vector") is None
+    )
+    start = time.perf_counter()
+    if can_copy:
+        try:
+            async with conn.transaction():
+                async with conn.cursor() as cur:
+                    async with cur.copy(_copy_sql(table_name, columns, types)) as copy:  # pyright: ignore
+                        if types:
+                            copy.set_types(types)
+                        for row in rows:
+                            await copy.write_row(row)
+            _record_write(table_name, columns, rows, start)
+            return
+        except _COPY_UNAVAILABLE_ERRORS as e:
+            logger.info(f"COPY not available ({e}), falling back to INSERT")
+
+    async with conn.cursor() as cur:
+        await cur.executemany(_insert_sql(table_name, columns), rows)  # pyright: ignore
+    _record_write(table_name, columns, rows, start)
+
+
+def _committed(func, *args):
+    """
+    run a function that uses the shared connection, e.g. to create tables,
+    and commit, so that its changes are visible to connections in the async pool
+    """
+    with _committed_lock:
+        try:
+            result = func(*args)
+            _conn().commit()
+            return result
+        except psycopg.Error as e:
+            _conn().rollback()
+            raise DatabaseException(str(e)) from e
+
+
+def _prepare_insert(
+    table_name: str, data: list[dict[str, Any]], create_table: bool
+) -> tuple[list[str], list[tuple], list[str] | None]:
+    """
+    create the table if needed and build the rows used by execute_insertmany
+    and aexecute_insertmany, along with the natural key to upsert on, if any
+    """
+    dimension = 0
+    for _, value in data[0].items():
+        if isinstance(value, list):
+            if len(value) > 0 and isinstance(value[0], float):
+                dimension = len(value)
+                break
+
+    if create_table:
+        _create_table(table_name, dimension)
+
+    columns = list(data[0].keys())
+    bindings = [
+        tuple(
+            _vector_literal(v) if dimension and _is_vector(v) else v
+            for v in item.values()
+        )
+        for item in data
+    ]
+    keys = _natural_key(table_name)
+    if keys and not all(key in columns for key in keys):
+        keys = None
+
+    return columns, bindings, keys
+
+
+def _write_rows(
+    table_name: str,
+    columns: list[str],
+    rows: Sequence[tuple],
+    types: list[str] | None = None,
+) -> None:
+    """
+    write rows into a table using COPY, the entire batch is sent to the server
+    in a single COPY operation. falls back to INSERT when COPY is not available.
+    when types is given the data is sent using binary COPY.
+    caller is responsible for committing the transaction
+    """
+    start = time.perf_counter()
+    if types and "vector" in types and not _vector_type_registered():
+        _insert_rows(table_name, columns, rows)
+    else:
+        try:
+            # use a savepoint so that a failed COPY does not
+            # roll back table creation done earlier in the same transaction
+            with _conn().transaction():
+                _copy_rows(table_name, columns, rows, types)
+        except _COPY_UNAVAILABLE_ERRORS as e:
+            logger.info(f"COPY not available ({e}), falling back to INSERT")
+            _insert_rows(table_name, columns, rows)
+
+    _record_write(table_name, columns, rows, start)
+
+
+def _record_write(
+    table_name: str, columns: list[str], rows: Sequence[tuple], start: float
+) -> None:
+    querystats.record(
+        f"COPY {table_name} ({', '.join(columns)})",
+        _elapsed_ms(start),
+        rows=len(rows),
+        nbytes=querystats.estimate_size(rows=rows),
+    )
+
+
+def _upsert_rows(
+    table_name: str,
+    columns: list[str],
+    rows: Sequence[tuple],
+    keys: list[str],
+) -> None:
+    """
+    COPY the rows into a staging table then merge them into the table
+    with INSERT ... ON CONFLICT, since COPY itself cannot handle conflicts.
+    caller is responsible for committing the transaction
+    """
+    stage_name = f"{table_name}_stage"
+    _conn().execute(_stage_sql(table_name, stage_name))  # pyright: ignore
+    _write_rows(stage_name, columns, rows)
+    merge = _merge_sql(table_name, stage_name, columns, keys)
+    start = time.perf_counter()
+    cur = _conn().execute(merge)  # pyright: ignore
+    querystats.record(merge, _elapsed_ms(start), rows=max(cur.rowcount, 0))
+
+
+def _stage_sql(table_name: str, stage_name: str) -> str:
+    # stage_seq numbers the rows in the order they are written
+    return f"""
+        CREATE TEMP TABLE {stage_name} (
+            LIKE {table_name},
+            stage_seq BIGINT GENERATED ALWAYS AS IDENTITY
+        ) ON COMMIT DROP
+        """
+
+
+def _merge_sql(
+    table_name: str, stage_name: str, columns: list[str], keys: list[str]
+) -> str:
+    column_list, key_list = ", ".join(columns), ", ".join(keys)
+    updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in columns if col not in keys)
+    action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    # of the rows in a batch with the same key, the last one written wins
+    return f"""
+        INSERT INTO {table_name} ({column_list})
+        SELECT DISTINCT ON ({key_list}) {column_list} FROM {stage_name}
+        ORDER BY {key_list}, stage_seq DESC
+        ON CONFLICT ({key_list}) {action}
+        """
+
+
+def _natural_key(table_name: str) -> list[str] | None:
+    """
+    return the natural key of the table if the unique index on it exists
+    """
+    if table_name not in _table_keys:
+        keys = None
+        for prefix, natural_key in _NATURAL_KEYS.items():
+            if table_name.startswith(prefix):
+                version = _schema_version(_conn(), table_name)
+                keys = natural_key if version >= _NATURAL_KEY_VERSION else None
+                break
+        _table_keys[table_name] = keys
+
+    return _table_keys[table_name]
+
+
+def _copy_rows(
+    table_name: str,
+    columns: list[str],
+    rows: Sequence[tuple],
+    types: list[str] | None = None,
+) -> None:
+    with _conn().cursor() as cur:
+        with cur.copy(_copy_sql(table_name, columns, types)) as copy:  # pyright: ignore
+            if types:
+                copy.set_types(types)
+            for row in rows:
+                copy.write_row(row)
+
+
+def _insert_rows(table_name: str, columns: list[str], rows: Sequence[tuple]) -> None:
+    with _conn().cursor() as cur:
+        cur.executemany(_insert_sql(table_name, columns), rows)  # pyright: ignore
+
+
+def _copy_sql(table_name: str, columns: list[str], types: list[str] | None) -> str:
+    statement = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN"
+    if types:
+        statement += " (FORMAT BINARY)"
+    return statement
+
+
+def _insert_sql(table_name: str, columns: list[str]) -> str:
+    placeholders = ", ".join(["%s"] * len(columns))
+    return f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+
+
+def _is_vector(value: Any) -> bool:
+    return isinstance(value, list) and len(value) > 0 and isinstance(value[0], float)
+
+
+def _vector_literal(value: list[float]) -> str:
+    # pgvector text representation, used with text COPY
+    return "[" + ",".join(str(v) for v in value) + "]"
+
+
+def _create_table(table_name: str, dimension: int = 0, partition: str = ""):
+    statement = _create_table_sql(table_name, dimension, partition)
+
+    if table_name in _tables_checked:
+        return _conn().execute(statement)  # pyright: ignore
+
+    is_new = not _table_exists(_conn(), table_name)
+    cursor = _conn().execute(statement)  # pyright: ignore
+    _table_partitioning.pop(table_name, None)
+    _table_keys.pop(table_name, None)
+    if is_new:
+        # indexes on an empty table are cheap to build in the same transaction
+        _apply_migrations(_conn(), table_name, concurrently=False)
+    elif _schema_version(_conn(), table_name) < len(_schema_migrations(table_name)):
+        # rows written by this version of the code need the new columns,
+        # indexes and backfills are left to migrate
+        _add_missing_columns(_conn(), table_name)
+        logger.warning(
+            f"Schema of {table_name} is outdated, run migrate to create missing indexes"
+        )
+    _tables_checked.add(table_name)
+
+    return cursor
+
+
+def _add_missing_columns(conn: psycopg.Connection, table_name: str) -> None:
+    """
+    add the nullable columns of the pending migrations. they only change the
+    catalog and are safe to add while other processes use the table.
+    the schema version is not changed, migrate applies the rest
+    """
+    migrations = _schema_migrations(table_name)
+    for migration in migrations[_schema_version(conn, table_name) :]:
+        for statement in migration:
+            if _nullable_column_regex.match(statement):
+                _execute_migration(conn, statement, table_name, concurrently=False)
+
+
+def _create_table_sql(table_name: str, dimension: int, partition: str) -> str:
     if table_name.startswith("filing_text_chunks"):
         statement = f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
             cik VARCHAR(10) NOT NULL,
             accession_number VARCHAR(20) NOT NULL,
             chunk_num INTEGER NOT NULL,
-            chunk_text TEXT NOT NULL)
+            chunk_text TEXT NOT NULL{_PARTITION_CLAUSES[partition]}
         """
     elif table_name.startswith("filing_chunks_embeddings"):
         statement = f"""
@@ -200,8 +1482,10 @@ def _create_table(table_name: str, dimension: int = 0):
             cik VARCHAR(10) NOT NULL,
             accession_number VARCHAR(20) NOT NULL,
             chunk_num INTEGER NOT NULL,
-            embedding VECTOR ({dimension}) NOT NULL)
+            embedding VECTOR ({dimension}) NOT NULL{_PARTITION_CLAUSES[partition]}
         """
+    elif partition:
+        raise ValueError(f"Partitioning is not supported for table {table_name}")
     elif table_name.startswith("search_phrase_embeddings"):
         statement = f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
@@ -222,6 +1506,25 @@ def _create_table(table_name: str, dimension: int = 0):
             n_trustee INTEGER,
             tags TEXT[]
         )"""
+    elif table_name.startswith("filing_chunks_relevance"):
+        statement = f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            cik VARCHAR(10) NOT NULL,
+            accession_number VARCHAR(20) NOT NULL,
+            phrase VARCHAR(255) NOT NULL,
+            chunk_num INTEGER NOT NULL,
+            distance FLOAT NOT NULL,
+            tags TEXT[] NOT NULL
+        )"""
+    elif table_name.startswith("filing_fingerprints"):
+        statement = f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            cik VARCHAR(10) NOT NULL,
+            accession_number VARCHAR(20) NOT NULL,
+            minhash BIGINT[] NOT NULL,
+            similar_to VARCHAR(20),
+            similarity FLOAT
+        )"""
     elif table_name.startswith("master_idx"):
         statement = f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
@@ -236,4 +1539,222 @@ def _create_table(table_name: str, dimension: int = 0):
     else:
         raise ValueError(f"Do not know how to create table {table_name}")
 
-    return _conn().execute(statement)  # pyright: ignore
+    return statement
+
+
+def migrate_table(
+    table_name: str,
+    vector_index: str = "",
+    concurrently: bool = True,
+) -> int | None:
+    """
+    Bring an existing table to the latest schema version by applying
+    the pending migrations. Indexes are built with CREATE INDEX CONCURRENTLY
+    by default so that the table stays writable during the migration.
+
+    vector_index can be "hnsw" or "ivfflat" to also build an approximate
+    nearest neighbor index on embedding tables.
+
+    Returns the schema version of the table, or None if the table does not exist
+    """
+    migrations = _schema_migrations(table_name)
+    if vector_index and vector_index not in _VECTOR_INDEXES:
+        raise ValueError(f"Unknown vector index type {vector_index}")
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with _connect() as conn:
+        conn.autocommit = True
+        if not _table_exists(conn, table_name):
+            logger.info(f"Table {table_name} does not exist, skipping migration")
+            return None
+
+        if concurrently and _partition_strategy(conn, table_name):
+            # postgres does not support building indexes on a partitioned
+            # table concurrently, each partition is locked while it is indexed
+            logger.info(
+                f"{table_name} is partitioned, building indexes without CONCURRENTLY"
+            )
+            concurrently = False
+
+        _drop_invalid_indexes(conn, table_name)
+        _apply_migrations(conn, table_name, concurrently=concurrently)
+        _table_keys.pop(table_name, None)
+
+        if vector_index and "embedding" in table_name:
+            _execute_migration(
+                conn, _VECTOR_INDEXES[vector_index], table_name, concurrently
+            )
+
+    return len(migrations)
+
+
+def table_exists(table_name: str) -> bool:
+    return _table_exists(_conn(), table_name)
+
+
+def _schema_migrations(table_name: str) -> list[list[str]]:
+    for prefix, migrations in _SCHEMA_MIGRATIONS.items():
+        if table_name.startswith(prefix):
+            return migrations
+    raise ValueError(f"Do not know how to migrate table {table_name}")
+
+
+def _apply_migrations(
+    conn: psycopg.Connection, table_name: str, concurrently: bool
+) -> None:
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+            table_name VARCHAR(255) PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        )""")  # pyright: ignore
+
+    migrations = _schema_migrations(table_name)
+    current_version = _schema_version(conn, table_name)
+    for version in range(current_version + 1, len(migrations) + 1):
+        for statement in migrations[version - 1]:
+            _execute_migration(conn, statement, table_name, concurrently)
+
+        conn.execute(
+            f"""
+            INSERT INTO {SCHEMA_VERSION_TABLE} (table_name, version) VALUES (%s, %s)
+            ON CONFLICT (table_name)
+            DO UPDATE SET version = EXCLUDED.version, updated_at = now()
+            """,  # pyright: ignore
+            (table_name, version),
+        )
+        logger.info(f"Migrated {table_name} to schema version {version}")
+
+
+def _execute_migration(
+    conn: psycopg.Connection, statement: str, table_name: str, concurrently: bool
+) -> None:
+    partition_key = ""
+    if "{partition_key}" in statement and _partition_strategy(conn, table_name) == "r":
+        partition_key = ", filing_year"
+
+    statement = statement.format(
+        table=table_name,
+        concurrently="CONCURRENTLY" if concurrently else "",
+        partition_key=partition_key,
+    )
+    logger.info(f"Executing {statement}")
+    conn.execute(statement)  # pyright: ignore
+
+
+def _schema_version(conn: psycopg.Connection, table_name: str) -> int:
+    if not _table_exists(conn, SCHEMA_VERSION_TABLE):
+        return 0
+
+    row = conn.execute(
+        f"SELECT version FROM {SCHEMA_VERSION_TABLE} WHERE table_name = %s",  # pyright: ignore
+        (table_name,),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def _table_exists(conn: psycopg.Connection, table_name: str) -> bool:
+    row = conn.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,)).fetchone()
+    return bool(row and row[0])
+
+
+def _drop_invalid_indexes(conn: psycopg.Connection, table_name: str) -> None:
+    # a failed CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+    # which IF NOT EXISTS would then treat as already built
+    rows = conn.execute(
+        """
+        SELECT indexrelid::regclass::text FROM pg_index
+        WHERE indrelid = %s::regclass AND NOT indisvalid
+        """,
+        (table_name,),
+    ).fetchall()
+    for (index_name,) in rows:
+        logger.info(f"Dropping invalid index {index_name}")
+        conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")  # pyright: ignore
+
+
+def drop_filing_year(table_name: str, year: int) -> None:
+    """
+    Drop all chunks of a year from a table partitioned by filing year.
+    Dropping the partition is instant compared with a bulk DELETE
+    """
+    if _partitioning(table_name) != "year":
+        raise ValueError(f"{table_name} is not partitioned by filing year")
+
+    execute_query(f"DROP TABLE IF EXISTS {table_name}_y{year}")
+    _partitions_created.discard(f"{table_name}_y{year}")
+
+
+def _filing_year(accession_number: str) -> int:
+    # accession number is in the format of 0001133228-24-004879,
+    # where the middle part is the 2 digit year of the filing
+    year = int(accession_number[11:13])
+    return 1900 + year if year >= 90 else 2000 + year
+
+
+def _partitioning(table_name: str) -> str:
+    """
+    return "hash", "year" or "" if the table is not partitioned
+    the result is cached once the table exists
+    """
+    if table_name in _table_partitioning:
+        return _table_partitioning[table_name]
+
+    if not _table_exists(_conn(), table_name):
+        return ""
+
+    strategy = _partition_strategy(_conn(), table_name)
+    partitioning = {"h": "hash", "r": "year"}.get(strategy or "", "")
+    _table_partitioning[table_name] = partitioning
+    return partitioning
+
+
+def _partition_strategy(conn: psycopg.Connection, table_name: str) -> str | None:
+    row = conn.execute(
+        "SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+        (table_name,),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def _ensure_partition(
+    table_name: str, partitioning: str, cik: str, accession_number: str
+) -> None:
+    """create the partition for a filing if it does not exist yet"""
+    if partitioning == "hash":
+        if f"{table_name}:{cik}" in _partitions_created:
+            return
+
+        cur = _conn().execute(
+            """
+            SELECT r FROM generate_series(0, %s - 1) r
+            WHERE satisfies_hash_partition(%s::regclass::oid, %s, r, %s::varchar)
+            """,
+            (HASH_PARTITIONS, table_name, HASH_PARTITIONS, cik),
+        )
+        remainder = cur.fetchone()[0]  # pyright: ignore
+        partition_name = f"{table_name}_h{remainder}"
+        bounds = f"WITH (MODULUS {HASH_PARTITIONS}, REMAINDER {remainder})"
+        cache_keys = [f"{table_name}:{cik}", partition_name]
+    else:
+        year = _filing_year(accession_number)
+        partition_name = f"{table_name}_y{year}"
+        bounds = f"FROM ({year}) TO ({year + 1})"
+        cache_keys = [partition_name]
+
+    if partition_name not in _partitions_created:
+        try:
+            # use a savepoint so that losing a race against another worker
+            # creating the same partition does not abort the transaction
+            with _conn().transaction():
+                _conn().execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {partition_name}
+                    PARTITION OF {table_name} FOR VALUES {bounds}
+                    """  # pyright: ignore
+                )
+            logger.debug(f"Created partition {partition_name}")
+        except (psycopg.errors.DuplicateTable, psycopg.errors.UniqueViolation):
+            pass
+
+    _partitions_created.update(cache_keys)
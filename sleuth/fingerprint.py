@@ -0,0 +1,61 @@
+"""
+MinHash signatures of filing documents, used to find near duplicate filings.
+
+The document is reduced to the set of its word 5-grams, markup ignored, and
+each of NUM_PERMUTATIONS hash functions keeps the minimum hash over the set.
+The fraction of equal values in two signatures estimates the Jaccard
+similarity of the two 5-gram sets, e.g. 0.95 for an amendment that changes
+a few paragraphs of a long document.
+"""
+
+import re
+import zlib
+
+import numpy as np
+
+NUM_PERMUTATIONS = 128
+SHINGLE_SIZE = 5
+
+# hash functions are (a * x + b) mod _PRIME over 32 bit shingle hashes,
+# the coefficients must never change or saved signatures become useless
+_PRIME = 4294967311  # smallest prime above 2**32
+_rng = np.random.default_rng(485)
+_A = _rng.integers(1, 2**32, NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.integers(0, 2**32, NUM_PERMUTATIONS, dtype=np.uint64)
+
+_tag_regex = re.compile(r"<[^>]*>")
+_word_regex = re.compile(r"\w+")
+
+# shingles hashed at once, bounds the size of the intermediate matrix
+_BLOCK_SIZE = 4096
+
+
+def minhash(text: str) -> list[int]:
+    """MinHash signature of a text or html document"""
+    words = _word_regex.findall(_tag_regex.sub(" ", text).lower())
+    n_shingles = max(len(words) - SHINGLE_SIZE + 1, 1)
+    hashes = np.unique(
+        np.fromiter(
+            (
+                zlib.crc32(" ".join(words[i : i + SHINGLE_SIZE]).encode())
+                for i in range(n_shingles)
+            ),
+            dtype=np.uint64,
+            count=n_shingles,
+        )
+    )
+
+    signature = np.full(NUM_PERMUTATIONS, _PRIME, dtype=np.uint64)
+    for start in range(0, len(hashes), _BLOCK_SIZE):
+        block = hashes[start : start + _BLOCK_SIZE, np.newaxis]
+        # a * x + b stays below 2**64 since a, b and x are below 2**32
+        permuted = (block * _A + _B) % _PRIME
+        signature = np.minimum(signature, permuted.min(axis=0))
+    return signature.tolist()
+
+
+def similarity(signature: list[int], other: list[int]) -> float:
+    """estimated Jaccard similarity of the documents of two signatures"""
+    if len(signature) != len(other) or not signature:
+        return 0.0
+    return float(np.mean(np.asarray(signature) == np.asarray(other)))
@@ -1,3 +1,22 @@
+from typing import NamedTuple
+
+import numpy as np
+
+
+class ChunkScores(NamedTuple):
+    """
+    relevance of chunks as parallel arrays, one element per (filing, chunk),
+    ordered by filing then by rank within the filing
+    """
+
+    filing_id: np.ndarray
+    chunk_num: np.ndarray
+    frequency: np.ndarray
+    avg_distance: np.ndarray
+    min_distance: np.ndarray
+    score: np.ndarray
+
+
 def top_adjacent_chunks(relevance_scores) -> list[str]:
     """
     select top 3 chunks, return the adjacent chunks
@@ -66,19 +85,15 @@ def relevance_by_distance(chunk_distances):
             (444, 0.751, 0.3135, 0.311),
         ]
     """  # noqa E501
-    # Calculate metrics for each chunk
-    scores = []
-    for chunk_num, distances in chunk_distances.items():
-        avg_distance = sum(distances) / len(distances)
-        min_distance = min(distances)  # For tie-breaking
-        score = 1 / (1 + avg_distance)  # Modified scoring function
-        scores.append((chunk_num, score, avg_distance, min_distance))
-
-    # Rank by score (descending), then by min_distance (ascending)
-    scores.sort(key=lambda x: (-x[1], x[3]))
-
-    # Return the ranked chunks
-    return scores
+    scores = score_chunks(*_flatten(chunk_distances), method="distance")
+    return list(
+        zip(
+            scores.chunk_num.tolist(),
+            scores.score.tolist(),
+            scores.avg_distance.tolist(),
+            scores.min_distance.tolist(),
+        )
+    )
 
 
 def relevance_by_appearance(chunk_distances):
@@ -118,16 +133,54 @@ def relevance_by_appearance(chunk_distances):
             (158, 1, 0.291, 0.774),
         ]
     """  # noqa E501
-    relevance_scores = []
-    for chunk_num, distances in chunk_distances.items():
-        frequency = len(distances)  # Number of distances for the chunk
-        avg_distance = sum(distances) / frequency  # Average distance
-        score = frequency / (1 + avg_distance)  # Relevance score
-        relevance_scores.append((chunk_num, frequency, avg_distance, score))
+    scores = score_chunks(*_flatten(chunk_distances), method="appearance")
+    return list(
+        zip(
+            scores.chunk_num.tolist(),
+            scores.frequency.tolist(),
+            scores.avg_distance.tolist(),
+            scores.score.tolist(),
+        )
+    )
+
+
+def relevance_by_rank_fusion(rankings: list[list[int]], k: int = 60):
+    """
+    Fuse several rankings of chunks with reciprocal rank fusion.
 
-    # Sort by score in descending order
-    relevance_scores.sort(key=lambda x: x[3], reverse=True)
-    return relevance_scores
+    Each ranking lists chunk numbers best first. A chunk scores 1 / (k + rank)
+    for every ranking it appears in, with rank starting at 1, so chunks ranked
+    well by more than one ranking come first. k damps the weight of the very
+    top ranks, 60 is the value commonly used.
+
+    Args:
+        rankings (list[list[int]]): chunk numbers of each ranking, best first.
+        k (int): rank offset.
+
+    Returns:
+        list[tuple[int, float, int, int]]: (chunk_num, score, number of rankings
+        the chunk appears in, best rank) sorted by score in descending order,
+        ties keep the order in which chunks first appear.
+
+    Example:
+        >>> relevance_by_rank_fusion([[158, 159, 444], [159, 12]])
+        [(159, 0.0325..., 2, 1), (158, 0.0163..., 1, 1), (12, 0.0161..., 1, 2),
+        (444, 0.0158..., 1, 3)]
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, chunk_num in enumerate(ranking, start=1):
+            score, appearances, best_rank = fused.get(chunk_num, (0.0, 0, rank))
+            fused[chunk_num] = (
+                score + 1 / (k + rank),
+                appearances + 1,
+                min(best_rank, rank),
+            )
+
+    return sorted(
+        ((chunk_num, *values) for chunk_num, values in fused.items()),
+        key=lambda item: -item[1],
+    )
 
 
 def gather_chunk_distances(results: list[dict]) -> dict:
@@ -140,3 +193,145 @@ def gather_chunk_distances(results: list[dict]) -> dict:
         chunk_distances[chunk_num].append(distance)
 
     return chunk_distances
+
+
+def score_chunks(
+    chunk_nums,
+    distances,
+    method: str = "distance",
+    filing_ids=None,
+) -> ChunkScores:
+    """
+    Array version of relevance_by_distance and relevance_by_appearance.
+    Distances are grouped by filing and chunk number and each group is
+    reduced to its frequency, average and minimum distance in one pass,
+    so a batch of many filings is scored with a single call.
+
+    Args:
+        chunk_nums: chunk number of each distance
+        distances: distance between a chunk and a search phrase
+        method: "distance" scores 1 / (1 + avg_distance), ties broken by
+            min_distance, "appearance" scores frequency / (1 + avg_distance)
+        filing_ids: filing of each distance, e.g. accession numbers,
+            all distances belong to one filing when omitted
+
+    Returns:
+        ChunkScores ordered by filing then by score, ties are kept in the
+        order the chunks first appear in the input, like the tuple versions.
+    """
+    if method not in ("distance", "appearance"):
+        raise ValueError(f"Unknown scoring method {method}")
+
+    chunk_nums = np.asarray(chunk_nums, dtype=np.int64)
+    distances = np.asarray(distances, dtype=np.float64)
+    if filing_ids is None:
+        filing_ids = np.zeros(len(chunk_nums), dtype=np.int64)
+    filing_ids = np.asarray(filing_ids)
+
+    if len(chunk_nums) == 0:
+        return ChunkScores(
+            filing_ids, chunk_nums, chunk_nums, distances, distances, distances
+        )
+
+    # lexsort is stable, so the first element of each group is
+    # the first time the chunk appears in the input
+    order = np.lexsort((chunk_nums, filing_ids))
+    filing_ids, chunk_nums, distances = (
+        filing_ids[order],
+        chunk_nums[order],
+        distances[order],
+    )
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (filing_ids[1:] != filing_ids[:-1]) | (
+        chunk_nums[1:] != chunk_nums[:-1]
+    )
+    starts = np.flatnonzero(new_group)
+
+    frequency = np.diff(np.append(starts, len(order)))
+    avg_distance = np.add.reduceat(distances, starts) / frequency
+    min_distance = np.minimum.reduceat(distances, starts)
+    first_seen = order[starts]
+    filing_ids, chunk_nums = filing_ids[starts], chunk_nums[starts]
+
+    if method == "distance":
+        score = 1 / (1 + avg_distance)
+        rank = np.lexsort((first_seen, min_distance, -score, filing_ids))
+    else:
+        score = frequency / (1 + avg_distance)
+        rank = np.lexsort((first_seen, -score, filing_ids))
+
+    return ChunkScores(
+        filing_ids[rank],
+        chunk_nums[rank],
+        frequency[rank],
+        avg_distance[rank],
+        min_distance[rank],
+        score[rank],
+    )
+
+
+def top_ranked(scores: ChunkScores, n: int = 3) -> ChunkScores:
+    """the first n chunks of each filing in scores"""
+    filing_ids = scores.filing_id
+    if len(filing_ids) == 0:
+        return scores
+
+    positions = np.arange(len(filing_ids))
+    new_filing = np.ones(len(filing_ids), dtype=bool)
+    new_filing[1:] = filing_ids[1:] != filing_ids[:-1]
+    filing_start = np.maximum.accumulate(np.where(new_filing, positions, 0))
+    keep = positions - filing_start < n
+    return ChunkScores(*(column[keep] for column in scores))
+
+
+def _flatten(chunk_distances: dict) -> tuple[list[int], list[float]]:
+    # dict of chunk_num -> distances into parallel lists, in insertion order
+    chunk_nums = [
+        chunk_num for chunk_num, distances in chunk_distances.items() for _ in distances
+    ]
+    distances = [
+        distance for distances in chunk_distances.values() for distance in distances
+    ]
+    return chunk_nums, distances
+
+
+def normalize_vectors(vectors) -> np.ndarray:
+    """rows of vectors scaled to unit length, as a float32 matrix"""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def nearest_chunks(
+    embeddings: np.ndarray,
+    phrase_vectors: np.ndarray,
+    limit: int,
+) -> list[tuple[int, int, float]]:
+    """
+    Cosine distances between the chunk embeddings of a filing and normalized
+    search phrase vectors, computed with a single matrix multiply.
+    Same as ordering by embedding <=> phrase_embedding with a LIMIT in pgvector.
+
+    Args:
+        embeddings: float32 matrix with one row per chunk
+        phrase_vectors: float32 matrix with one normalized row per phrase
+        limit: number of closest (chunk, phrase) pairs to return
+
+    Returns:
+        list of tuple (chunk index, phrase index, distance), ordered by distance
+    """
+    if len(embeddings) == 0 or len(phrase_vectors) == 0:
+        return []
+
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    distances = (1.0 - (embeddings @ phrase_vectors.T) / norms).ravel()
+
+    n = min(limit, distances.size)
+    closest = np.argpartition(distances, n - 1)[:n]
+    closest = closest[np.argsort(distances[closest], kind="stable")]
+    chunk_idx, phrase_idx = np.unravel_index(
+        closest, (len(embeddings), len(phrase_vectors))
+    )
+    return [
+        (int(c), int(p), float(d))
+        for c, p, d in zip(chunk_idx, phrase_idx, distances[closest])
+    ]
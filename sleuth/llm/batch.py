@@ -0,0 +1,138 @@
+"""
+Offline batch prediction files.
+
+Instead of asking the model one prompt at a time, the requests are written to
+a JSONL file in the batch format of the provider of the model, to be submitted
+as a single batch job:
+    gpt-*       OpenAI Batch API, one chat completion request per line
+    gemini-*    Vertex AI batch prediction, one GenerateContentRequest per line
+Every request has a custom id, used to match the lines in the output file of
+the completed job with the requests. Vertex AI output lines carry the request
+they answer, so there the custom id is a label of the request.
+
+Along with each request the caller keeps some state, written to the pending
+file next to the batch file, so that the output can be processed later in
+another run.
+
+Requests prepared by worker processes are queued in the process and handed
+over with take(), the main process writes them with write_batch().
+"""
+
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from .extraction import GEMINI_GENERATION_CONFIG, GPT_GENERATION_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# (request line, state) pairs queued by this process
+_queue: list[tuple[dict[str, Any], dict[str, Any]]] = []
+_lock = threading.Lock()
+
+
+def batch_request(custom_id: str, model: str, prompt: str) -> dict[str, Any]:
+    """a line of the batch file asking model with prompt"""
+    if model.startswith("gpt"):
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [{"role": "user", "content": prompt}],
+                **GPT_GENERATION_CONFIG,
+            },
+        }
+    elif model.startswith("gemini"):
+        return {
+            "request": {
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "generationConfig": {
+                    "maxOutputTokens": GEMINI_GENERATION_CONFIG["max_output_tokens"],
+                    "temperature": GEMINI_GENERATION_CONFIG["temperature"],
+                    "topP": GEMINI_GENERATION_CONFIG["top_p"],
+                },
+                "labels": {"custom_id": custom_id},
+            },
+        }
+    raise ValueError(f"Unknown model: {model}")
+
+
+def queue(custom_id: str, model: str, prompt: str, state: dict[str, Any]) -> None:
+    """add a request to the batch, state is returned by read_pending"""
+    item = (batch_request(custom_id, model, prompt), {"custom_id": custom_id} | state)
+    with _lock:
+        _queue.append(item)
+
+
+def take() -> list[tuple[dict[str, Any], dict[str, Any]]]:
+    """return the requests queued so far and start over"""
+    with _lock:
+        items = list(_queue)
+        _queue.clear()
+    return items
+
+
+def pending_file(batch_file: str) -> Path:
+    return Path(batch_file).with_suffix(".pending.jsonl")
+
+
+def write_batch(
+    batch_file: str,
+    items: Iterable[tuple[dict[str, Any], dict[str, Any]]],
+    append: bool = True,
+) -> int:
+    """write requests to the batch file and their state to the pending file"""
+    mode = "a" if append else "w"
+    n_requests = 0
+    with open(batch_file, mode) as f, open(pending_file(batch_file), mode) as p:
+        for request, state in items:
+            f.write(json.dumps(request))
+            f.write("\n")
+            p.write(json.dumps(state))
+            p.write("\n")
+            n_requests += 1
+    return n_requests
+
+
+def read_pending(batch_file: str) -> list[dict[str, Any]]:
+    """state of each request in the batch file"""
+    with open(pending_file(batch_file)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_responses(output_file: str) -> dict[str, Optional[str]]:
+    """
+    response text of each custom id in the output file of a completed batch.
+    a request that failed gets None
+    """
+    responses = {}
+    with open(output_file) as f:
+        for line in f:
+            if line.strip():
+                custom_id, text = _response_text(json.loads(line))
+                responses[custom_id] = text
+    return responses
+
+
+def _response_text(line: dict[str, Any]) -> tuple[str, Optional[str]]:
+    try:
+        if "custom_id" in line:
+            if line.get("error") or line["response"]["status_code"] != 200:
+                logger.info(f"batch request {line['custom_id']} failed: {line}")
+                return line["custom_id"], None
+            body = line["response"]["body"]
+            return line["custom_id"], body["choices"][0]["message"]["content"]
+
+        custom_id = line["request"]["labels"]["custom_id"]
+        if line.get("status") or "response" not in line:
+            logger.info(f"batch request {custom_id} failed: {line.get('status')}")
+            return custom_id, None
+        parts = line["response"]["candidates"][0]["content"]["parts"]
+        return custom_id, "".join(part.get("text", "") for part in parts)
+    except (KeyError, IndexError, TypeError) as e:
+        logger.info(f"Unexpected batch output line {str(line)[:200]}: {e}")
+        return line.get("custom_id", ""), None
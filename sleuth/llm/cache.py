@@ -0,0 +1,250 @@
+"""
+Persistent cache of model responses.
+
+Responses are keyed by (model, generation config, sha256 of the prompt) and
+kept in a sqlite database, by default llm_responses.sqlite under
+config.cache_path, so that rerunning extraction on the same selected text
+does not call the model again. The database can be shared by worker processes.
+
+The cache has 3 modes:
+    readwrite   look up responses and save new ones, the default
+    replay      only look up responses, a miss returns None instead of
+                calling the model and nothing is written
+    off         always call the model
+
+When the responses saved take more than the size limit, the least recently
+used ones are removed. The size is counted as responses are written, and only
+summed from the database when the count goes over the limit. Hits and misses
+are counted per process, worker processes hand theirs over with take_stats()
+and the main process combines them with merge_stats().
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = ["readwrite", "replay", "off"]
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS responses (
+        model TEXT NOT NULL,
+        generation_config TEXT NOT NULL,
+        prompt_sha256 TEXT NOT NULL,
+        response TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (model, generation_config, prompt_sha256)
+    )
+"""
+
+# after eviction the cache is this fraction of the size limit,
+# so that eviction does not run again on the next few writes
+_EVICT_TO = 0.9
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+_cache: "ResponseCache | None" = None
+_mode = os.environ.get("LLM_CACHE", "readwrite")
+
+
+class ResponseCache:
+    def __init__(self, path: str, read_only: bool = False, max_mb: float = 1024):
+        self.path = path
+        self.read_only = read_only
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._local = threading.local()
+        # bytes taken by the responses, loaded on the first write and kept
+        # up to date by put and _evict instead of summing the table each time
+        self._size: int | None = None
+        self._size_lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared across threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if self.read_only:
+                db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30)
+            else:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                db = sqlite3.connect(self.path, timeout=30)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(_SCHEMA)
+                db.commit()
+            self._local.db = db
+        return db
+
+    def get(self, model: str, generation_config: dict, prompt: str) -> str | None:
+        key = _key(model, generation_config, prompt)
+        try:
+            row = (
+                self._db()
+                .execute(
+                    "SELECT response FROM responses WHERE model = ?"
+                    " AND generation_config = ? AND prompt_sha256 = ?",
+                    key,
+                )
+                .fetchone()
+            )
+        except sqlite3.OperationalError as e:
+            # replay mode with no cache database yet
+            logger.info(f"Unable to read response cache {self.path}: {e}")
+            row = None
+
+        if row is None:
+            _count("misses")
+            return None
+
+        _count("hits")
+        if not self.read_only:
+            with self._db() as db:
+                db.execute(
+                    "UPDATE responses SET last_used = ? WHERE model = ?"
+                    " AND generation_config = ? AND prompt_sha256 = ?",
+                    (time.time(), *key),
+                )
+        return row[0]
+
+    def put(self, model: str, generation_config: dict, prompt: str, response: str):
+        if self.read_only:
+            return
+
+        key = _key(model, generation_config, prompt)
+        size, now = len(response.encode()), time.time()
+        with self._db() as db:
+            replaced = db.execute(
+                "SELECT size FROM responses WHERE model = ?"
+                " AND generation_config = ? AND prompt_sha256 = ?",
+                key,
+            ).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, response, size, now, now),
+            )
+        _count("writes")
+        self._add_size(size - (replaced[0] if replaced else 0))
+        self._evict()
+
+    def size(self) -> int:
+        """bytes taken by the responses saved"""
+        return (
+            self._db()
+            .execute("SELECT COALESCE(SUM(size), 0) FROM responses")
+            .fetchone()[0]
+        )
+
+    def _add_size(self, n: int) -> None:
+        with self._size_lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += n
+
+    def _evict(self) -> None:
+        if (self._size or 0) <= self.max_bytes:
+            return
+
+        # other processes sharing the database write to it too,
+        # check the actual size before removing anything
+        with self._size_lock:
+            self._size = self.size()
+        excess = self._size - self.max_bytes
+        if excess <= 0:
+            return
+
+        # free enough to bring the cache down to _EVICT_TO of the limit
+        to_free, freed, rowids = excess + self.max_bytes * (1 - _EVICT_TO), 0, []
+        with self._db() as db:
+            for rowid, size in db.execute(
+                "SELECT rowid, size FROM responses ORDER BY last_used"
+            ):
+                if freed >= to_free:
+                    break
+                rowids.append((rowid,))
+                freed += size
+            db.executemany("DELETE FROM responses WHERE rowid = ?", rowids)
+        self._add_size(-freed)
+        _count("evictions", len(rowids))
+        logger.info(f"Evicted {len(rowids)} responses ({freed} bytes) from {self.path}")
+
+
+def _key(model: str, generation_config: dict, prompt: str) -> tuple[str, str, str]:
+    return (
+        model,
+        json.dumps(generation_config, sort_keys=True),
+        hashlib.sha256(prompt.encode()).hexdigest(),
+    )
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _lock:
+        _stats[name] += n
+
+
+def set_mode(mode: str) -> None:
+    """one of CACHE_MODES, takes effect on the next call to response_cache"""
+    global _mode, _cache
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown response cache mode {mode}")
+    _mode, _cache = mode, None
+
+
+def response_cache() -> ResponseCache | None:
+    """the cache of this process, None when the cache is off"""
+    global _cache
+    if _mode == "off":
+        return None
+
+    if _cache is None:
+        path = os.environ.get("LLM_CACHE_PATH") or str(
+            Path(config.cache_path) / "llm_responses.sqlite"
+        )
+        if path.startswith("gs://"):
+            logger.info("Response cache is not supported on cloud storage, disabled")
+            return None
+        _cache = ResponseCache(
+            path,
+            read_only=_mode == "replay",
+            max_mb=float(os.environ.get("LLM_CACHE_MAX_MB", "1024")),
+        )
+    return _cache
+
+
+def take_stats() -> dict[str, int]:
+    """return the hit and miss counts so far and start over"""
+    with _lock:
+        snapshot = dict(_stats)
+        for name in _stats:
+            _stats[name] = 0
+    return snapshot
+
+
+def merge_stats(snapshot: dict[str, int] | None) -> None:
+    """add counts taken in another process"""
+    if not snapshot:
+        return
+    with _lock:
+        for name, n in snapshot.items():
+            _stats[name] = _stats.get(name, 0) + n
+
+
+def stats_summary() -> str:
+    with _lock:
+        hits, misses = _stats["hits"], _stats["misses"]
+        writes, evictions = _stats["writes"], _stats["evictions"]
+    if hits + misses == 0:
+        return ""
+    return (
+        f"response cache: {hits} hits, {misses} misses, "
+        f"hit rate {hits / (hits + misses):.1%}, "
+        f"{writes} saved, {evictions} evicted"
+    )
@@ -1,12 +1,19 @@
 import json
 import logging
 import os
-from typing import Optional
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from typing import Iterable, Optional
 
+import numpy as np
 from google.api_core.exceptions import ResourceExhausted
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from vertexai.generative_models import GenerativeModel
 
+from .cache import response_cache
 from .util import init_vertaxai, openai_client
 
 logger = logging.getLogger(__name__)
@@ -20,20 +27,179 @@ _DUMMY_RESPONSE = """```json
 ```
 """
 
+# generation parameters sent with every request, part of the response cache key
+GEMINI_GENERATION_CONFIG = {
+    "max_output_tokens": 4096,
+    "temperature": 0,
+    "top_p": 0.95,
+}
+GPT_GENERATION_CONFIG = {
+    "temperature": 0,
+    "max_tokens": 8192,
+}
 
-def ask_model(model: str, prompt: str) -> Optional[str]:
+
+# first key of the JSON object in a response, once its boolean value is complete
+_first_key_regex = re.compile(
+    r'^\s*(?:```(?:json)?)?\s*\{\s*"([^"]+)"\s*:\s*(true|false)\b'
+)
+
+
+# when the primary model has not answered within this percentile of its latencies
+# seen so far, the same prompt is sent to the hedge model as well.
+# until enough latencies are seen HEDGE_DEFAULT_DELAY seconds is used
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 30.0
+_hedge_model = os.environ.get("HEDGE_MODEL", "")
+_hedge_percentile = 90.0
+
+# latencies in seconds of the most recent calls to each model in this process
+_latencies: dict[str, deque[float]] = {}
+_latencies_lock = threading.Lock()
+
+
+def generation_config(model: str) -> dict:
+    return (
+        GEMINI_GENERATION_CONFIG if model.startswith("gemini") else GPT_GENERATION_CONFIG
+    )
+
+
+def cache_config(model: str, stop_on_false: str | None = None) -> dict:
+    """
+    generation config a response is cached with. a response cut short by
+    stop_on_false is not what the model says without it, and is kept apart
+    """
+    config = generation_config(model)
+    if stop_on_false:
+        return config | {"stop_on_false": stop_on_false}
+    return config
+
+
+def ask_model(model: str, prompt: str, stop_on_false: str | None = None) -> Optional[str]:
+    """
+    ask the model and return its response text.
+
+    with stop_on_false the response is streamed, and when the JSON object in it
+    starts with that key set to false, generation is stopped right there and
+    {stop_on_false: false} is returned instead of waiting for the rest of it
+    """
     # provides a mechanism to skip asking the model
     # in case it's not need for testing and saves cost
     if os.environ.get("SKIP_ASK_MODEL", "0") == "1":
         return _DUMMY_RESPONSE
 
+    start = time.perf_counter()
     if model.startswith("gemini"):
-        return _chat_with_gemini(model, prompt)
+        response = _chat_with_gemini(model, prompt, stop_on_false)
     elif model.startswith("gpt"):
-        return _chat_with_gpt(model, prompt)
+        response = _chat_with_gpt(model, prompt, stop_on_false)
     else:
         raise ValueError(f"Unknown model: {model}")
 
+    if response:
+        with _latencies_lock:
+            _latencies.setdefault(model, deque(maxlen=1000)).append(
+                time.perf_counter() - start
+            )
+    return response
+
+
+def set_hedging(hedge_model: str, percentile: float = 90.0) -> None:
+    """hedge calls to other models with hedge_model, empty to disable"""
+    global _hedge_model, _hedge_percentile
+    _hedge_model, _hedge_percentile = hedge_model, percentile
+
+
+def hedge_delay(model: str) -> float:
+    """seconds to wait for model before asking the hedge model too"""
+    with _latencies_lock:
+        latencies = list(_latencies.get(model, []))
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return float(np.percentile(latencies, _hedge_percentile))
+
+
+def ask_model_hedged(
+    model: str, prompt: str, stop_on_false: str | None = None
+) -> tuple[Optional[str], str]:
+    """
+    ask_model_cached, and when the model is slower than usual or does not
+    give a JSON answer, ask the hedge model too. the first JSON answer wins.
+    returns the response and the model that gave it
+    """
+    if not _hedge_model or _hedge_model == model:
+        return ask_model_cached(model, prompt, stop_on_false), model
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = {executor.submit(ask_model_cached, model, prompt, stop_on_false): model}
+        done, _ = wait(futures, timeout=hedge_delay(model))
+        if done and _is_json(response := _result(next(iter(done)))):
+            return response, model
+
+        logger.info(f"{model} is slow or failed, asking {_hedge_model} as well")
+        hedge = executor.submit(ask_model_cached, _hedge_model, prompt, stop_on_false)
+        futures[hedge] = _hedge_model
+        response, answered_by = None, model
+        for future in as_completed(futures):
+            response, answered_by = _result(future), futures[future]
+            if _is_json(response):
+                break
+        return response, answered_by
+    finally:
+        # the slower call can not be stopped, its response is ignored
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _result(future: Future) -> Optional[str]:
+    try:
+        return future.result()
+    except Exception as e:
+        logger.warning(f"Error when asking model: {type(e)},{str(e)}")
+        return None
+
+
+def _is_json(response: Optional[str]) -> bool:
+    if not response:
+        return False
+    try:
+        json.loads(remove_md_json_wrapper(response) or "")
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+def ask_model_cached(
+    model: str, prompt: str, stop_on_false: str | None = None
+) -> Optional[str]:
+    """
+    ask_model through the response cache. in replay mode a prompt
+    not found in the cache gets None without calling the model
+    """
+    cache = response_cache()
+    if cache is None or os.environ.get("SKIP_ASK_MODEL", "0") == "1":
+        return ask_model(model, prompt, stop_on_false)
+
+    config = cache_config(model, stop_on_false)
+    response = cache.get(model, config, prompt)
+    if response is not None or cache.read_only:
+        return response
+
+    response = ask_model(model, prompt, stop_on_false)
+    if response:
+        cache.put(model, config, prompt, response)
+    return response
+
+
+def cached_response(
+    model: str, prompt: str, stop_on_false: str | None = None
+) -> Optional[str]:
+    """the response to prompt in the response cache, without asking the model"""
+    cache = response_cache()
+    if cache is None:
+        return None
+    return cache.get(model, cache_config(model, stop_on_false), prompt)
+
 
 def remove_md_json_wrapper(response: str) -> str | None:
     # the response should be a JSON
@@ -55,15 +221,51 @@ def remove_md_json_wrapper(response: str) -> str | None:
     return response
 
 
-def _chat_with_gpt(model_name: str, prompt: str) -> Optional[str]:
+def read_stream(fragments: Iterable[str], stop_on_false: str) -> str:
+    """
+    join the text fragments of a streamed response. stops reading as soon as
+    the JSON object in the response starts with stop_on_false set to false
+    """
+    text = ""
+    for fragment in fragments:
+        text += fragment
+        match = _first_key_regex.match(text)
+        if match and match.group(1) == stop_on_false and match.group(2) == "false":
+            logger.debug(f"stopped generation after {len(text)} chars, {stop_on_false}")
+            return json.dumps({stop_on_false: False})
+    return text
+
+
+def _chat_with_gpt(
+    model_name: str, prompt: str, stop_on_false: str | None = None
+) -> Optional[str]:
     client = openai_client()
 
     try:
+        if stop_on_false:
+            stream = client.chat.completions.create(
+                model=model_name,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True,
+                **GPT_GENERATION_CONFIG,
+            )
+            try:
+                return read_stream(
+                    (
+                        chunk.choices[0].delta.content or ""
+                        for chunk in stream
+                        if chunk.choices
+                    ),
+                    stop_on_false,
+                )
+            finally:
+                # closing the connection stops the generation
+                stream.close()
+
         response = client.chat.completions.create(
             model=model_name,
-            temperature=0,
             messages=[{"role": "user", "content": prompt}],
-            max_tokens=8192,
+            **GPT_GENERATION_CONFIG,
         )
 
         return response.choices[0].message.content
@@ -73,22 +275,39 @@ def _chat_with_gpt(model_name: str, prompt: str) -> Optional[str]:
         return None
 
 
+def _chunk_text(chunk) -> str:
+    # the last chunk of a Gemini stream may only carry the finish reason
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
 @retry(
     stop=stop_after_attempt(6),
     wait=wait_exponential(multiplier=1, min=4, max=120),
     retry=retry_if_exception_type(ResourceExhausted),
 )
-def _chat_with_gemini(model_name: str, prompt: str) -> Optional[str]:
+def _chat_with_gemini(
+    model_name: str, prompt: str, stop_on_false: str | None = None
+) -> Optional[str]:
     try:
         init_vertaxai()
         model = GenerativeModel(model_name)
+        if stop_on_false:
+            stream = model.generate_content(
+                prompt, generation_config=GEMINI_GENERATION_CONFIG, stream=True
+            )
+            try:
+                return read_stream(
+                    (_chunk_text(chunk) for chunk in stream), stop_on_false
+                )
+            finally:
+                stream.close()  # pyright: ignore
+
         response = model.generate_content(
             prompt,
-            generation_config={
-                "max_output_tokens": 4096,
-                "temperature": 0,
-                "top_p": 0.95,
-            },
+            generation_config=GEMINI_GENERATION_CONFIG,
         )
         return response.text
     except ResourceExhausted:
@@ -1,19 +1,38 @@
 import logging
 from datetime import datetime
 from logging.handlers import QueueHandler
-from typing import Any
+from typing import Any, Iterator
 
+from . import querystats
 from .datastore import (
+    TEXT_SEARCH_VECTOR,
     DatabaseException,
+    copy_chunks,
+    count_chunks,
     execute_insertmany,
     execute_query,
     get_chunks,
     save_chunks,
+    search_chunks,
+    stream_query,
+    table_exists,
 )
 from .edgar import SECFiling
+from .fingerprint import minhash, similarity
+from .llm import batch as llm_batch
+from .llm import cache as llm_cache
 from .llm.embedding import GEMINI_EMBEDDING_MODEL, batch_embedding
+from .llm.extraction import set_hedging
 from .splitter import chunk_text, trim_html_content
-from .trustee import extract_trustee_comp
+from .trustee import (
+    TRUSTEE_COMP_KEYWORDS,
+    candidate_chunks,
+    extract_trustee_comp,
+    forget_relevance,
+    queue_trustee_comp_batch,
+    search_phrases,
+    trustee_comp_candidates,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -30,28 +49,48 @@ def save_filing_embeddings(
     dimension: int,
     embedding_table_name: str = "",  # leave empty to skip saving to database
     model: str = GEMINI_EMBEDDING_MODEL,
+    partition: str = "",
+    check_existing: bool = True,
+    n_candidates: int = 0,
+    reuse_near_duplicates: bool = False,
+    relevance_table_name: str = "",
 ) -> int | None:
+    """
+    embed the text chunks of a filing. when n_candidates is > 0 only the
+    chunks ranked best by full text search and their neighbors are embedded,
+    see candidate_chunks. all chunks are embedded if none of them matches.
+
+    with reuse_near_duplicates, text chunks copied from a near duplicate
+    filing get the embeddings of that filing copied as well.
+
+    relevance saved in relevance_table_name for the old embeddings of the
+    filing is deleted once they are replaced.
+    """
     logger.debug(
         f"save_filing_embeddings for {cik},{accession_number} with dimension {dimension}, model={model}"  # noqa E501
     )
 
     # check if embeddings already exist
-    if embedding_table_name:
+    if embedding_table_name and check_existing:
         try:
-            query = f"""
-                SELECT COUNT(*) AS COUNT FROM {embedding_table_name}
-                WHERE cik = %s AND accession_number = %s
-            """
-            result = execute_query(query, (cik, accession_number))
-            if result and result[0]["count"] > 0:
+            n_existing = count_chunks(cik, accession_number, embedding_table_name)
+            if n_existing > 0:
                 logger.debug(
                     f"{cik} {accession_number} already has embeddings, skipping calling embedding API"  # noqa E501
                 )
-                return result[0]["count"]
+                return n_existing
         except DatabaseException as e:
             if "does not exist" not in str(e):
                 raise e
 
+    if reuse_near_duplicates and embedding_table_name:
+        n_copied = _reuse_near_duplicate_embeddings(
+            cik, accession_number, text_table_name, embedding_table_name
+        )
+        if n_copied:
+            forget_relevance(cik, accession_number, relevance_table_name)
+            return n_copied
+
     text_chunks_records = get_chunks(
         cik=cik,
         accession_number=accession_number,
@@ -60,6 +99,11 @@ def save_filing_embeddings(
     logger.debug(
         f"Retrieved {len(text_chunks_records)} text chunks for {cik} {accession_number}"
     )
+    if n_candidates > 0 and text_chunks_records:
+        text_chunks_records = _candidate_records(
+            text_chunks_records, text_table_name, n_candidates
+        )
+    chunk_nums = [record["chunk_num"] for record in text_chunks_records]
     chunks = [record["chunk_text"] for record in text_chunks_records]
 
     start_t = datetime.now()
@@ -78,18 +122,54 @@ def save_filing_embeddings(
                 chunks=embeddings,
                 table_name=embedding_table_name,
                 create_table=True,
+                partition=partition,
+                chunk_nums=chunk_nums,
             )
+            forget_relevance(cik, accession_number, relevance_table_name)
         return len(embeddings)
 
     return None
 
 
+def _candidate_records(
+    text_chunks_records: list[dict[str, Any]],
+    text_table_name: str,
+    n_candidates: int,
+) -> list[dict[str, Any]]:
+    # the text chunks worth embedding, see candidate_chunks
+    cik = text_chunks_records[0]["cik"]
+    accession_number = text_chunks_records[0]["accession_number"]
+    candidates = candidate_chunks(cik, accession_number, text_table_name, n_candidates)
+    if candidates is None:
+        logger.info(f"No candidate chunks for {cik} {accession_number}, embed all")
+        return text_chunks_records
+
+    candidates = set(candidates)
+    records = [
+        record for record in text_chunks_records if record["chunk_num"] in candidates
+    ]
+    logger.debug(f"Embedding {len(records)} candidate chunks of {cik} {accession_number}")
+    return records
+
+
 def chunk_filing(
     filing: SECFiling,
     form_type: str,
     method: str = "spacy",
     table_name: str = "",  # leave empty if dryrun
+    partition: str = "",
+    check_existing: bool = True,
+    fingerprint_table_name: str = "",
+    near_dup_threshold: float = 0.0,
 ) -> tuple[int, list[str]] | tuple[None, None]:
+    """
+    split the main document of a filing into text chunks.
+
+    when fingerprint_table_name and table_name are given the MinHash signature
+    of the document is saved with the most similar filing of the same cik filed before it.
+    if that filing is at least near_dup_threshold similar, its chunks are
+    copied instead of chunking the document again.
+    """
     logger.debug(f"chunk_filing form {form_type} of {filing}")
 
     if filing:
@@ -100,7 +180,7 @@ def chunk_filing(
             return None, None
 
         # check if the filing is already chunk
-        if table_name:
+        if table_name and check_existing:
             try:
                 existing_chunks = get_chunks(
                     cik=filing.cik,
@@ -119,6 +199,18 @@ def chunk_filing(
         trimmed_html = trim_html_content(filing_content)
         logger.debug(f"Trimmed HTML content size {len(trimmed_html)}")
 
+        reused_chunks = _reuse_near_duplicate_chunks(
+            cik=filing.cik,
+            accession_number=filing.accession_number,
+            date_filed=filing.date_filed,
+            document=trimmed_html,
+            table_name=table_name,
+            fingerprint_table_name=fingerprint_table_name,
+            near_dup_threshold=near_dup_threshold,
+        )
+        if reused_chunks:
+            return len(reused_chunks), reused_chunks
+
         start_t = datetime.now()
         chunks = chunk_text(trimmed_html, method=method)
         elapsed_t = datetime.now() - start_t
@@ -135,18 +227,182 @@ def chunk_filing(
                     chunks=chunks,
                     table_name=table_name,
                     create_table=True,
+                    partition=partition,
                 )
             return len(chunks), chunks
 
     return None, None
 
 
+def save_fingerprint(
+    cik: str,
+    accession_number: str,
+    date_filed: str,
+    document: str,
+    table_name: str,
+) -> tuple[str | None, float]:
+    """
+    save the MinHash signature of a filing document, along with the filing
+    of the same cik filed before it that is the most similar to it.
+    returns the accession number of that filing and the similarity.
+    a filing without date_filed is not compared with any other
+    """
+    signature = minhash(document)
+    similar_to, best = None, 0.0
+    try:
+        # filings of the same day are ordered by accession number
+        for row in execute_query(
+            f"""
+            SELECT accession_number, minhash FROM {table_name}
+            WHERE cik = %s AND (date_filed, accession_number) < (%s::DATE, %s)
+            """,
+            (cik, date_filed or None, accession_number),
+        ):
+            score = similarity(signature, row["minhash"])
+            if score > best:
+                similar_to, best = row["accession_number"], score
+    except DatabaseException as e:
+        if "does not exist" not in str(e):
+            raise e
+
+    execute_insertmany(
+        table_name=table_name,
+        data=[
+            {
+                "cik": cik,
+                "accession_number": accession_number,
+                "date_filed": date_filed or None,
+                "minhash": signature,
+                "similar_to": similar_to,
+                "similarity": best if similar_to else None,
+            }
+        ],
+        create_table=True,
+    )
+    return similar_to, best
+
+
+def near_duplicate_of(
+    cik: str, accession_number: str, table_name: str
+) -> tuple[str | None, float]:
+    """the most similar filing found by save_fingerprint and its similarity"""
+    try:
+        rows = execute_query(
+            f"""
+            SELECT similar_to, similarity FROM {table_name}
+            WHERE cik = %s AND accession_number = %s
+            """,
+            (cik, accession_number),
+        )
+    except DatabaseException as e:
+        if "does not exist" not in str(e):
+            raise e
+        return None, 0.0
+
+    if rows and rows[0]["similar_to"]:
+        return rows[0]["similar_to"], rows[0]["similarity"]
+    return None, 0.0
+
+
+def _reuse_near_duplicate_chunks(
+    cik: str,
+    accession_number: str,
+    date_filed: str,
+    document: str,
+    table_name: str,
+    fingerprint_table_name: str,
+    near_dup_threshold: float,
+) -> list[str] | None:
+    if not fingerprint_table_name or not table_name:
+        return None
+
+    similar_to, score = save_fingerprint(
+        cik, accession_number, date_filed, document, fingerprint_table_name
+    )
+    if not table_name or not similar_to or not 0 < near_dup_threshold <= score:
+        return None
+
+    n_copied = copy_chunks(cik, accession_number, similar_to, table_name)
+    if n_copied <= 1:
+        return None
+
+    log_n_print(
+        f"Filing({cik},{accession_number}) is {score:.0%} similar to {similar_to},"
+        f" copied {n_copied} chunks"
+    )
+    return [
+        record["chunk_text"] for record in get_chunks(cik, accession_number, table_name)
+    ]
+
+
+def _reuse_near_duplicate_embeddings(
+    cik: str,
+    accession_number: str,
+    text_table_name: str,
+    embedding_table_name: str,
+) -> int:
+    # embeddings of the filing the text chunks were copied from, if any
+    rows = execute_query(
+        f"""
+        SELECT reused_from FROM {text_table_name}
+        WHERE cik = %s AND accession_number = %s
+        LIMIT 1
+        """,
+        (cik, accession_number),
+    )
+    similar_to = rows[0]["reused_from"] if rows else None
+    if not similar_to or not table_exists(embedding_table_name):
+        return 0
+
+    n_copied = copy_chunks(cik, accession_number, similar_to, embedding_table_name)
+    if n_copied:
+        logger.info(f"copied {n_copied} embeddings of {similar_to} to {accession_number}")
+    return n_copied
+
+
+def reuse_near_duplicate_result(
+    cik: str,
+    accession_number: str,
+    model: str,
+    fingerprint_table_name: str,
+    result_table_name: str,
+    near_dup_threshold: float,
+) -> dict[str, Any] | None:
+    """
+    the extraction result of the most similar filing of the same cik, when it
+    is at least near_dup_threshold similar, as the result of this filing.
+    the text sent to the model and who answered it are not copied.
+    0 disables reuse
+    """
+    if near_dup_threshold <= 0:
+        return None
+
+    similar_to, score = near_duplicate_of(cik, accession_number, fingerprint_table_name)
+    if not similar_to or score < near_dup_threshold:
+        return None
+
+    rows = execute_query(
+        f"""
+        SELECT cik, model, selected_chunks, response, n_trustee
+        FROM {result_table_name}
+        WHERE cik = %s AND accession_number = %s AND model = %s AND n_trustee > 1
+        LIMIT 1
+        """,
+        (cik, similar_to, model),
+    )
+    if not rows:
+        return None
+
+    logger.info(f"reusing result of {similar_to} for {cik},{accession_number}")
+    return rows[0] | {"accession_number": accession_number, "reused_from": similar_to}
+
+
 def gather_extractin_result(
     idx_table_name: str,
     extraction_result_table_name: str,
     idx_tag: str,
     result_tag: str,
-) -> list[dict[str, Any]]:
+) -> Iterator[dict[str, Any]]:
     query = f"""
         SELECT DISTINCT
             idx.cik,
@@ -165,10 +421,131 @@ def gather_extractin_result(
             AND res.accession_number = idx.accession_number
             AND %s = ANY(res.tags)
         WHERE %s = ANY(idx.tags)
-        LIMIT 10000
     """
 
-    return execute_query(query, (result_tag, idx_tag))
+    return stream_query(query, (result_tag, idx_tag))
+
+
+def candidate_coverage(
+    text_table_name: str,
+    extraction_result_table_name: str,
+    result_tag: str,
+    n_candidates: int,
+) -> dict[str, int]:
+    """
+    count the extraction results whose selected chunks are not all among
+    the candidate chunks picked by candidate_chunks with n_candidates.
+    with all chunks embedded, this tells how much embedding only
+    the candidate chunks would change the selection.
+    """
+    query = f"""
+        WITH results AS (
+            SELECT DISTINCT ON (cik, accession_number)
+                cik, accession_number, selected_chunks
+            FROM {extraction_result_table_name}
+            WHERE %s = ANY(tags) AND cardinality(selected_chunks) > 0
+        ),
+        ranked AS (
+            -- only chunks that match, like rank_chunks_by_text
+            SELECT t.cik, t.accession_number, t.chunk_num,
+                row_number() OVER (
+                    PARTITION BY t.cik, t.accession_number
+                    ORDER BY ts_rank_cd({TEXT_SEARCH_VECTOR}, q) DESC, t.chunk_num
+                ) AS pos
+            FROM {text_table_name} t
+            JOIN results USING (cik, accession_number),
+            to_tsquery('english', %s) AS q
+            WHERE {TEXT_SEARCH_VECTOR} @@ q
+        ),
+        candidates AS (
+            SELECT cik, accession_number,
+                array_agg(chunk_num + offsets.n) AS chunk_nums
+            FROM ranked, (VALUES (-1), (0), (1)) AS offsets(n)
+            WHERE pos <= %s
+            GROUP BY cik, accession_number
+        )
+        -- filings without any matching chunk have all chunks embedded
+        SELECT
+            count(*) AS n_filings,
+            count(*) FILTER (
+                WHERE chunk_nums IS NOT NULL AND NOT selected_chunks <@ chunk_nums
+            ) AS n_outside
+        FROM results
+        LEFT JOIN candidates USING (cik, accession_number)
+    """
+    rows = execute_query(query, (result_tag, TRUSTEE_COMP_KEYWORDS, n_candidates))
+    return rows[0] if rows else {"n_filings": 0, "n_outside": 0}
+
+
+def semantic_search(
+    query: str,
+    tables_map: dict[str, str],
+    model: str,
+    dimension: int,
+    limit: int = 10,
+    ef_search: int = 40,
+) -> list[dict[str, Any]]:
+    """
+    find the chunks closest to a free text query across all filings,
+    with the company name and filing date of each chunk
+    """
+    query_embedding = batch_embedding(
+        [query], model=model, dimension=dimension, task_type="RETRIEVAL_QUERY"
+    )[0]
+    return search_chunks(
+        query_embedding=query_embedding,
+        embedding_table_name=tables_map["embedding"],
+        index_table_name=tables_map["idx"],
+        text_table_name=tables_map["text"],
+        limit=limit,
+        ef_search=ef_search,
+    )
+
+
+def queue_batch_extraction(
+    cik: str,
+    accession_number: str,
+    tables_map: dict[str, str],
+    search_tag: str,
+    result_tag: str,
+    model: str,
+    relevance: list[dict[str, Any]] | None = None,
+    retrieval: str = "pgvector",
+) -> bool:
+    """
+    queue the prompt of the first candidate selection of a filing for a batch.
+    a filing answered from earlier results or the response cache is saved now
+    """
+    candidates = trustee_comp_candidates(
+        cik=cik,
+        accession_number=accession_number,
+        text_table_name=tables_map["text"],
+        embedding_table_name=tables_map["embedding"],
+        search_phrase_table_name=tables_map["search"],
+        search_phrase_tag=search_tag,
+        relevance_result=relevance,
+        relevance_table_name=tables_map.get("relevance", ""),
+        retrieval=retrieval,
+    )
+    key = f"Filing({cik},{accession_number})"
+    if not candidates:
+        log_n_print(f"No relevant text found in {key}")
+        return False
+
+    result = queue_trustee_comp_batch(
+        cik,
+        accession_number,
+        model,
+        candidates,
+        tags=[result_tag],
+        result_table_name=tables_map["result"],
+    )
+    if result is None:
+        log_n_print(f"Queued {key} for batch extraction")
+        return True
+
+    log_n_print(f"Extracted {result['n_trustee']} from {key} without the batch")
+    return bool(execute_insertmany(tables_map["result"], [result], create_table=True))
 
 
 def process_filing(
@@ -182,6 +559,15 @@ def process_filing(
     model: str,
     dimension: int,
     form_type: str,
+    partition: str = "",
+    check_existing: bool = True,
+    relevance: list[dict[str, Any]] | None = None,
+    retrieval: str = "pgvector",
+    n_candidates: int = 0,
+    near_dup_threshold: float = 0.0,
+    near_dup_result_threshold: float = 0.0,
+    speculation: int = 1,
+    batch: bool = False,
 ) -> bool:
     key = f"Filing({cik},{accession_number})"
     log_n_print(f"Processing {key} for {action} with idx_tag={idx_tag}")
@@ -192,6 +578,10 @@ def process_filing(
             filing=filing,
             form_type=form_type,
             table_name=tables_map["text"],
+            partition=partition,
+            check_existing=check_existing,
+            fingerprint_table_name=tables_map.get("fingerprint", ""),
+            near_dup_threshold=near_dup_threshold,
         )
         if n_chunks:
             log_n_print(f"{key} {form_type} splitted into {n_chunks} chunks")
@@ -207,6 +597,11 @@ def process_filing(
             accession_number=accession_number,
             embedding_table_name=tables_map["embedding"],
             dimension=dimension,
+            partition=partition,
+            check_existing=check_existing,
+            n_candidates=n_candidates,
+            reuse_near_duplicates=near_dup_threshold > 0,
+            relevance_table_name=tables_map.get("relevance", ""),
         )
         if n_embeddings:
             log_n_print(f"Saved {n_embeddings} embeddings for {key} {form_type}")
@@ -216,16 +611,45 @@ def process_filing(
             return False
 
     if action == "extract":
-        extraction_result = extract_trustee_comp(
+        extraction_result = reuse_near_duplicate_result(
             cik=cik,
             accession_number=accession_number,
-            text_table_name=tables_map["text"],
-            embedding_table_name=tables_map["embedding"],
-            search_phrase_table_name=tables_map["search"],
-            search_phrase_tag=search_tag,
             model=model,
+            fingerprint_table_name=tables_map.get("fingerprint", ""),
+            result_table_name=tables_map["result"],
+            near_dup_threshold=near_dup_result_threshold,
         )
 
+        if extraction_result is None and batch:
+            # the prompt goes into the batch file written by the main process,
+            # the result is saved when the completed batch is ingested
+            return queue_batch_extraction(
+                cik=cik,
+                accession_number=accession_number,
+                tables_map=tables_map,
+                search_tag=search_tag,
+                result_tag=result_tag,
+                model=model,
+                relevance=relevance,
+                retrieval=retrieval,
+            )
+
+        if extraction_result is None:
+            extraction_result = extract_trustee_comp(
+                cik=cik,
+                accession_number=accession_number,
+                text_table_name=tables_map["text"],
+                embedding_table_name=tables_map["embedding"],
+                search_phrase_table_name=tables_map["search"],
+                search_phrase_tag=search_tag,
+                model=model,
+                relevance_result=relevance,
+                relevance_table_name=tables_map.get("relevance", ""),
+                retrieval=retrieval,
+                result_table_name=tables_map["result"],
+                speculation=speculation,
+            )
+
         if extraction_result:
             # logger.debug(f"{model} response:{response}")
             log_n_print(f"Extracted {extraction_result["n_trustee"]} from {key}")
@@ -248,7 +672,7 @@ def process_filing(
         return False
 
 
-def process_filing_wrapper(args: dict):
+def process_filing_wrapper(args: dict) -> dict:
     # wrapper for multiprocessing
     # init logging for each worker to use QueueHandler that sends the logs
     # to the main process
@@ -259,8 +683,27 @@ def process_filing_wrapper(args: dict):
             f"Error {str(e)} in process_filing: Filing({args["cik"]},{args["accession_number"]})"  # noqa E501
         )
 
+    # query and response cache statistics of this filing, merged by the main process,
+    # along with the batch requests queued for it
+    return {
+        "queries": querystats.take(),
+        "llm_cache": llm_cache.take_stats(),
+        "batch": llm_batch.take(),
+    }
+
+
+def init_worker(
+    logging_q,
+    log_level=logging.DEBUG,
+    slow_query_ms: float = 0,
+    search_phrase_key: tuple[str, str] | None = None,
+    llm_cache_mode: str = "readwrite",
+    hedging: tuple[str, float] = ("", 90.0),
+):
+    querystats.set_slow_query_threshold(slow_query_ms)
+    llm_cache.set_mode(llm_cache_mode)
+    set_hedging(*hedging)
 
-def init_worker(logging_q, log_level=logging.DEBUG):
     # remove exsiting handlers with QueueHandler
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -269,3 +712,10 @@ def init_worker(logging_q, log_level=logging.DEBUG):
     for handler in logger.handlers:
         logger.removeHandler(handler)
     logger.addHandler(QueueHandler(logging_q))
+
+    # search phrases do not change during a run, load them once per worker
+    if search_phrase_key:
+        try:
+            search_phrases(*search_phrase_key)
+        except DatabaseException as e:
+            logger.warning(f"Unable to load search phrases {search_phrase_key}: {e}")
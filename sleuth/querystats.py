@@ -0,0 +1,203 @@
+"""
+Per-query statistics for the datastore.
+
+Queries are grouped by a normalized template, i.e. the query text with
+whitespace collapsed and literals replaced by ?, so that the same statement
+issued for different filings or tables partitions is counted together.
+
+For each template the number of calls, latency histogram, rows returned or
+written and the approximate number of bytes moved are recorded. Queries slower
+than the slow query threshold get their EXPLAIN (ANALYZE, BUFFERS) output
+captured by the datastore, only the plan of the slowest call is kept.
+
+Statistics are kept per process. Worker processes hand theirs over with take()
+and the main process combines them with merge().
+"""
+
+import logging
+import os
+import re
+import threading
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from typing import Any, Sequence
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of latency histogram buckets in milliseconds,
+# the last bucket counts everything slower than the last bound
+HISTOGRAM_BOUNDS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+_whitespace_regex = re.compile(r"\s+")
+_literal_regex = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_list_regex = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+_lock = threading.Lock()
+
+
+@dataclass
+class TemplateStats:
+    calls: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+    histogram: list[int] = field(
+        default_factory=lambda: [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    )
+    slow_calls: int = 0
+    slow_plan: str = ""
+    slow_plan_ms: float = 0.0
+
+    def percentile_ms(self, pct: float) -> float:
+        """approximate percentile, as the upper bound of the bucket it falls in"""
+        target, seen = self.calls * pct / 100, 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return (
+                    HISTOGRAM_BOUNDS_MS[i]
+                    if i < len(HISTOGRAM_BOUNDS_MS)
+                    else self.max_ms
+                )
+        return self.max_ms
+
+
+_stats: dict[str, TemplateStats] = {}
+_slow_query_ms = float(os.environ.get("SLOW_QUERY_MS", "0"))
+
+
+@lru_cache(maxsize=1024)
+def normalize_query(query: str) -> str:
+    template = _whitespace_regex.sub(" ", query).strip()
+    template = _literal_regex.sub("?", template)
+    return _in_list_regex.sub("(?, ...)", template)
+
+
+def set_slow_query_threshold(ms: float) -> None:
+    """queries slower than ms milliseconds get their plan captured, 0 disables"""
+    global _slow_query_ms
+    _slow_query_ms = float(ms)
+
+
+def slow_query_threshold() -> float:
+    return _slow_query_ms
+
+
+def record(query: str, elapsed_ms: float, rows: int = 0, nbytes: int = 0) -> None:
+    template = normalize_query(query)
+    bucket = next(
+        (i for i, bound in enumerate(HISTOGRAM_BOUNDS_MS) if elapsed_ms <= bound),
+        len(HISTOGRAM_BOUNDS_MS),
+    )
+    with _lock:
+        stats = _stats.setdefault(template, TemplateStats())
+        stats.calls += 1
+        stats.total_ms += elapsed_ms
+        stats.max_ms = max(stats.max_ms, elapsed_ms)
+        stats.rows += rows
+        stats.bytes += nbytes
+        stats.histogram[bucket] += 1
+        if _slow_query_ms and elapsed_ms >= _slow_query_ms:
+            stats.slow_calls += 1
+
+
+def wants_plan(query: str, elapsed_ms: float) -> bool:
+    """true if the call is slow and slower than the call whose plan was kept"""
+    if not _slow_query_ms or elapsed_ms < _slow_query_ms:
+        return False
+    stats = _stats.get(normalize_query(query))
+    return stats is None or elapsed_ms > stats.slow_plan_ms
+
+
+def record_plan(query: str, elapsed_ms: float, plan: str) -> None:
+    template = normalize_query(query)
+    logger.warning(f"Slow query took {elapsed_ms:.0f} ms: {template}\n{plan}")
+    with _lock:
+        stats = _stats.setdefault(template, TemplateStats())
+        stats.slow_plan, stats.slow_plan_ms = plan, elapsed_ms
+
+
+def estimate_size(params: Any = None, rows: Sequence = ()) -> int:
+    """
+    approximate number of bytes the parameters and rows of a query take
+    on the wire. only the values of each row are looked at, a list value
+    such as an embedding counts 8 bytes per element without visiting them
+    """
+    return _row_size(params) + sum(_row_size(row) for row in rows)
+
+
+def _row_size(row: Any) -> int:
+    if row is None:
+        return 0
+    values = row.values() if isinstance(row, dict) else row
+    return sum(_value_size(value) for value in values)
+
+
+def _value_size(value: Any) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return 8 * len(value)
+    return 8
+
+
+def take() -> dict[str, dict]:
+    """return the statistics collected so far and start over"""
+    with _lock:
+        snapshot = {template: asdict(stats) for template, stats in _stats.items()}
+        _stats.clear()
+    return snapshot
+
+
+def merge(snapshot: dict[str, dict] | None) -> None:
+    """add statistics taken in another process"""
+    if not snapshot:
+        return
+
+    with _lock:
+        for template, other in snapshot.items():
+            stats = _stats.setdefault(template, TemplateStats())
+            stats.calls += other["calls"]
+            stats.total_ms += other["total_ms"]
+            stats.max_ms = max(stats.max_ms, other["max_ms"])
+            stats.rows += other["rows"]
+            stats.bytes += other["bytes"]
+            stats.slow_calls += other["slow_calls"]
+            stats.histogram = [a + b for a, b in zip(stats.histogram, other["histogram"])]
+            if other["slow_plan_ms"] > stats.slow_plan_ms:
+                stats.slow_plan = other["slow_plan"]
+                stats.slow_plan_ms = other["slow_plan_ms"]
+
+
+def summary(limit: int = 20) -> str:
+    """text report of the templates that took the most time in total"""
+    with _lock:
+        ranked = sorted(_stats.items(), key=lambda item: item[1].total_ms, reverse=True)
+
+    if not ranked:
+        return ""
+
+    lines = [
+        f"{'calls':>8} {'total ms':>10} {'mean':>8} {'p50':>6} {'p95':>6} "
+        f"{'max':>8} {'rows':>9} {'bytes':>11}  query"
+    ]
+    for template, stats in ranked[:limit]:
+        mean_ms = stats.total_ms / max(stats.calls, 1)
+        lines.append(
+            f"{stats.calls:>8} {stats.total_ms:>10.1f} {mean_ms:>8.1f} "
+            f"{stats.percentile_ms(50):>6.0f} {stats.percentile_ms(95):>6.0f} "
+            f"{stats.max_ms:>8.1f} {stats.rows:>9} {stats.bytes:>11}  {template[:120]}"
+        )
+        if stats.slow_plan:
+            lines.append(
+                f"{'':>8} {stats.slow_calls} slow call(s), plan of slowest "
+                f"({stats.slow_plan_ms:.0f} ms):"
+            )
+            lines.extend(f"{'':>10}{line}" for line in stats.slow_plan.splitlines())
+
+    if len(ranked) > limit:
+        lines.append(f"... and {len(ranked) - limit} more query templates")
+    return "\n".join(lines)
@@ -1,24 +1,43 @@
+import hashlib
 import json
 import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
-from typing import Any
+from itertools import batched, chain, groupby, islice
+from typing import Any, Iterable, Iterator, NamedTuple
 
+import numpy as np
+
+from .compact import compact_text, estimate_tokens
 from .datastore import (
     DatabaseException,
     execute_insertmany,
     execute_query,
     get_chunks,
-    relevant_chunks_with_distances,
+    get_embeddings,
+    rank_chunks_by_text,
+    relevant_chunks_for_filings,
+    table_exists,
 )
+from .llm import batch as llm_batch
 from .llm.algo import (
     gather_chunk_distances,
+    nearest_chunks,
+    normalize_vectors,
     relevance_by_appearance,
     relevance_by_distance,
+    relevance_by_rank_fusion,
     top_3_chunks,
     top_adjacent_chunks,
 )
 from .llm.embedding import batch_embedding
-from .llm.extraction import ask_model, remove_md_json_wrapper
+from .llm.extraction import (
+    ask_model_hedged,
+    cached_response,
+    remove_md_json_wrapper,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +48,46 @@ TRUSTEE_COMP_SEARCH_PHRASES = [
     "Interested Person Compensation Remuneration Detailed Amount",
 ]
 
+# full text search query, in to_tsquery syntax, used to pick the chunks
+# worth embedding when only candidate chunks of a filing are embedded
+TRUSTEE_COMP_KEYWORDS = (
+    "trustee | director | compensation | remuneration | aggregate | pension | deferred"
+)
+
+# number of closest chunks of a filing used to select the relevant text
+SEARCH_LIMIT = 20
+
+# most tokens of selected text put into a prompt, after compaction
+PROMPT_TOKEN_BUDGET = 6000
+
+# most selections tried after the first have no compensation table,
+# the model says so with this key in the first few tokens of its response
+STOP_ON_FALSE = "compensation_info_present"
+
+# ways to select the relevant chunks from the search result, in the order tried.
+# hybrid fuses the vector search result with full text search ranks of the
+# chunks of the filing, it is tried when the closest chunks by distance fail
+SELECTION_METHODS = [
+    "distance",
+    "hybrid",
+    "appearance",
+    "distance-any3",
+    "appearance-any3",
+]
+
+# where distances between chunks and search phrases are computed,
+# in the database with pgvector or in process with numpy
+RETRIEVAL_BACKENDS = ["pgvector", "numpy"]
+
+
+class SearchPhrases(NamedTuple):
+    phrases: list[str]
+    vectors: np.ndarray  # one normalized float32 row per phrase
+
+
+# search phrases loaded by this process, keyed by (table name, tag)
+_search_phrases: dict[tuple[str, str], SearchPhrases] = {}
+
 
 TRUSTEE_COMP_PROMPT = """
 You are tasked with extracting compensation information for Trustees from a snippet
@@ -85,9 +144,18 @@ Please remove the leading $ sign and comma from compensation Amount.
 """  # noqa: E501
 
 
-def delete_search_pharses(table_name: str, search_tag: str) -> None:
+def delete_search_pharses(
+    table_name: str, search_tag: str, relevance_table_name: str = ""
+) -> None:
+    """delete the search phrases of a tag and the relevance saved with them"""
+    forget_search_phrases(table_name, search_tag)
     try:
         execute_query(f"DELETE FROM {table_name} WHERE tags = %s", ([search_tag],))
+        if relevance_table_name and table_exists(relevance_table_name):
+            execute_query(
+                f"DELETE FROM {relevance_table_name} WHERE %s = ANY(tags)",
+                (search_tag,),
+            )
     except DatabaseException as e:
         if "does not exist" not in str(e):
             raise e
@@ -114,11 +182,252 @@ def create_search_phrase_embeddings(
         item["tags"] = [search_tag]
 
     execute_insertmany(table_name=table_name, data=data, create_table=True)
+    forget_search_phrases(table_name, search_tag)
     logger.info(
         f"Initialized {len(data)} search phrases in {table_name} with size {dimension}"
     )
 
 
+def relevance_for_filings(
+    filings: list[tuple[str, str]],
+    embedding_table_name: str,
+    search_phrase_table_name: str,
+    search_phrase_tag: str,
+    limit: int = SEARCH_LIMIT,
+    relevance_table_name: str = "",
+    retrieval: str = "pgvector",
+) -> dict[tuple[str, str], list[dict[str, Any]]]:
+    """
+    Run the vector search for a batch of filings with a single query.
+    Returns for each filing the same rows relevant_chunks_with_distances
+    returns with the same limit, filings without embeddings get no rows.
+
+    When relevance_table_name is given, results saved there by an earlier
+    run are used and only the other filings are searched, and their
+    results are saved for the next run.
+    """
+    relevance = {filing: [] for filing in filings}
+    if relevance_table_name:
+        for row in _saved_relevance(filings, relevance_table_name, search_phrase_tag):
+            relevance[(row["cik"], row["accession_number"])].append(row)
+
+    to_search = [filing for filing, rows in relevance.items() if not rows]
+    if not to_search:
+        return relevance
+
+    phrases = search_phrases(search_phrase_table_name, search_phrase_tag)
+    # the closest chunks of a filing overall are among the closest chunks
+    # for each phrase, so top `limit` per phrase is enough
+    if retrieval == "numpy":
+        rows = _numpy_relevance(to_search, embedding_table_name, phrases, limit)
+    else:
+        rows = relevant_chunks_for_filings(
+            filings=to_search,
+            embedding_table_name=embedding_table_name,
+            search_phrase_table_name=search_phrase_table_name,
+            search_phrase_tag=search_phrase_tag,
+            top_k=limit,
+            phrases=list(zip(phrases.phrases, phrases.vectors.tolist())),
+        )
+    for row in rows:
+        relevance[(row["cik"], row["accession_number"])].append(row)
+
+    # rows of a filing are ordered by distance
+    searched = {filing: relevance[filing][:limit] for filing in to_search}
+    relevance.update(searched)
+    if relevance_table_name:
+        _save_relevance(
+            list(chain.from_iterable(searched.values())),
+            relevance_table_name,
+            search_phrase_tag,
+        )
+
+    return relevance
+
+
+def search_phrases(table_name: str, search_phrase_tag: str) -> SearchPhrases:
+    """
+    search phrases with a tag and their normalized embeddings, loaded from
+    the database once per process. init_worker loads them ahead of time.
+    """
+    key = (table_name, search_phrase_tag)
+    if key not in _search_phrases:
+        rows = execute_query(
+            f"""
+            SELECT phrase, phrase_embedding::real[] AS embedding FROM {table_name}
+            WHERE %s = ANY(tags) ORDER BY phrase
+            """,
+            (search_phrase_tag,),
+        )
+        if not rows:
+            # not cached, the phrases may not have been created yet
+            return SearchPhrases([], np.empty((0, 0), dtype=np.float32))
+
+        _search_phrases[key] = SearchPhrases(
+            [row["phrase"] for row in rows],
+            normalize_vectors([row["embedding"] for row in rows]),
+        )
+
+    return _search_phrases[key]
+
+
+def forget_search_phrases(table_name: str, search_phrase_tag: str) -> None:
+    """drop cached search phrases of a tag, after they have been rewritten"""
+    _search_phrases.pop((table_name, search_phrase_tag), None)
+
+
+def _numpy_relevance(
+    filings: list[tuple[str, str]],
+    embedding_table_name: str,
+    phrases: SearchPhrases,
+    top_k: int,
+) -> list[dict[str, Any]]:
+    """
+    same rows as relevant_chunks_for_filings, with the distances computed
+    in process from the embeddings of the filings, loaded in one query
+    """
+    result = []
+    rows = get_embeddings(filings, embedding_table_name)
+    for (cik, accession_number), chunks in groupby(
+        rows, key=lambda row: (row["cik"], row["accession_number"])
+    ):
+        chunks = list(chunks)
+        embeddings = np.asarray(
+            [chunk["embedding"] for chunk in chunks], dtype=np.float32
+        )
+        for chunk_idx, phrase_idx, distance in nearest_chunks(
+            embeddings, phrases.vectors, top_k
+        ):
+            result.append(
+                {
+                    "cik": cik,
+                    "accession_number": accession_number,
+                    "phrase": phrases.phrases[phrase_idx],
+                    "chunk_num": chunks[chunk_idx]["chunk_num"],
+                    "distance": distance,
+                }
+            )
+    return result
+
+
+def forget_relevance(cik: str, accession_number: str, relevance_table_name: str) -> None:
+    """delete the relevance saved for a filing, after its embeddings are replaced"""
+    if relevance_table_name and table_exists(relevance_table_name):
+        execute_query(
+            f"DELETE FROM {relevance_table_name}"
+            " WHERE cik = %s AND accession_number = %s",
+            (cik, accession_number),
+        )
+
+
+def _saved_relevance(
+    filings: list[tuple[str, str]],
+    relevance_table_name: str,
+    search_phrase_tag: str,
+) -> list[dict[str, Any]]:
+    if not table_exists(relevance_table_name):
+        return []
+
+    return execute_query(
+        f"""
+        SELECT r.cik, r.accession_number, r.phrase, r.chunk_num, r.distance
+        FROM {relevance_table_name} r
+        JOIN unnest(%s::text[], %s::text[]) AS f(cik, accession_number)
+            ON r.cik = f.cik AND r.accession_number = f.accession_number
+        WHERE %s = ANY(r.tags)
+        ORDER BY r.cik, r.accession_number, r.distance
+        """,
+        (
+            [cik for cik, _ in filings],
+            [accession_number for _, accession_number in filings],
+            search_phrase_tag,
+        ),
+        prepare=True,
+    )
+
+
+def _save_relevance(
+    rows: list[dict[str, Any]],
+    relevance_table_name: str,
+    search_phrase_tag: str,
+) -> None:
+    data = [
+        {
+            "cik": row["cik"],
+            "accession_number": row["accession_number"],
+            "phrase": row["phrase"],
+            "chunk_num": row["chunk_num"],
+            "distance": row["distance"],
+            "tags": [search_phrase_tag],
+        }
+        for row in rows
+    ]
+    execute_insertmany(relevance_table_name, data, create_table=True)
+
+
+def precompute_relevance(
+    filings: Iterable[tuple[str, str]],
+    batch_size: int,
+    embedding_table_name: str,
+    search_phrase_table_name: str,
+    search_phrase_tag: str,
+    relevance_table_name: str = "",
+    retrieval: str = "pgvector",
+) -> Iterator[tuple[str, str, list[dict[str, Any]]]]:
+    """
+    Driver for extraction, yield each filing with its relevance rows, searched
+    batch_size filings at a time, ahead of the LLM calls for those filings.
+    """
+    for batch in batched(filings, batch_size):
+        start_t = datetime.now()
+        relevance = relevance_for_filings(
+            filings=list(batch),
+            embedding_table_name=embedding_table_name,
+            search_phrase_table_name=search_phrase_table_name,
+            search_phrase_tag=search_phrase_tag,
+            relevance_table_name=relevance_table_name,
+            retrieval=retrieval,
+        )
+        elapsed_t = datetime.now() - start_t
+        logger.debug(
+            f"vector search for {len(batch)} filings took {elapsed_t.total_seconds()} seconds"  # noqa E501
+        )
+        for (cik, accession_number), rows in relevance.items():
+            yield cik, accession_number, rows
+
+
+def candidate_chunks(
+    cik: str,
+    accession_number: str,
+    text_table_name: str,
+    n_candidates: int,
+) -> list[int] | None:
+    """
+    chunk_nums of the n_candidates chunks that rank best against
+    TRUSTEE_COMP_KEYWORDS, plus the chunks next to them, so that adjacent
+    chunks selected by top_adjacent_chunks are embedded too.
+    returns None when no chunk matches any keyword at all
+    """
+    ranked = rank_chunks_by_text(
+        cik=cik,
+        accession_number=accession_number,
+        table_name=text_table_name,
+        tsquery=TRUSTEE_COMP_KEYWORDS,
+        limit=n_candidates,
+    )
+    if not any(row["rank"] > 0 for row in ranked):
+        return None
+
+    return sorted(
+        {
+            row["chunk_num"] + offset
+            for row in ranked
+            for offset in (-1, 0, 1)
+            if row["chunk_num"] + offset >= 0
+        }
+    )
+
+
 def extract_trustee_comp(
     cik: str,
     accession_number: str,
@@ -127,6 +436,11 @@ def extract_trustee_comp(
     embedding_table_name: str,
     search_phrase_tag: str,
     model: str,
+    relevance_result: list[dict[str, Any]] | None = None,
+    relevance_table_name: str = "",
+    retrieval: str = "pgvector",
+    result_table_name: str = "",
+    speculation: int = 1,
 ) -> dict[str, Any] | None:
     # the extractino process has 4 steps
     # step 1: chunk the filing
@@ -135,28 +449,83 @@ def extract_trustee_comp(
 
     # step 3: using search phrases to run vector search
     # use scoring alborithm to determine the most relevant text chunks
-    chunks_tried = []
-    result = {
-        "cik": cik,
-        "accession_number": accession_number,
-        "model": model,
-        "response": "",
-        "n_trustee": 0,
-        "selected_chunks": [],
-        "selected_text": "",
-    }
+    candidates = trustee_comp_candidates(
+        cik=cik,
+        accession_number=accession_number,
+        search_phrase_table_name=search_phrase_table_name,
+        text_table_name=text_table_name,
+        embedding_table_name=embedding_table_name,
+        search_phrase_tag=search_phrase_tag,
+        relevance_result=relevance_result,
+        relevance_table_name=relevance_table_name,
+        retrieval=retrieval,
+    )
+    result = _new_result(cik, accession_number, model)
+
+    # step 4: send the relevant text to the LLM model with designed prompt
+    with closing(
+        _responses(candidates, model, result_table_name, speculation)
+    ) as responses:
+        for (
+            relevant_chunks,
+            relevant_text,
+            response,
+            answered_by,
+            reused_from,
+        ) in responses:
+            result["selected_chunks"] = relevant_chunks
+            result["selected_text"] = relevant_text
+            result["text_sha256"] = _text_sha256(relevant_text)
+            result["reused_from"] = reused_from
+            result["answered_by"] = answered_by
+            n_trustee = _n_trustee(response)
+            if n_trustee > 1:
+                result["n_trustee"] = n_trustee
+                result["response"] = response
+                return result
+
+    if len(candidates) > 0:
+        logger.info(
+            f"unable to extract trustee info for {cik},{accession_number} with tags {search_phrase_tag}"  # noqa E501
+        )
+        return result
 
-    for method in ["distance", "appearance", "distance-any3", "appearance-any3"]:
-        relevant_chunks, relevant_text = _find_relevant_text(
-            cik=cik,
-            accession_number=accession_number,
-            text_table_name=text_table_name,
+    return None
+
+
+def trustee_comp_candidates(
+    cik: str,
+    accession_number: str,
+    search_phrase_table_name: str,
+    text_table_name: str,
+    embedding_table_name: str,
+    search_phrase_tag: str,
+    relevance_result: list[dict[str, Any]] | None = None,
+    relevance_table_name: str = "",
+    retrieval: str = "pgvector",
+) -> list[tuple[list[int], str]]:
+    """
+    chunks selected by each of SELECTION_METHODS and their text, in the order
+    they are sent to the model. repeated and too short selections are left out
+    """
+    # the search is done once and its result is scored by every method
+    if relevance_result is None:
+        relevance_result = relevance_for_filings(
+            filings=[(cik, accession_number)],
             embedding_table_name=embedding_table_name,
             search_phrase_table_name=search_phrase_table_name,
             search_phrase_tag=search_phrase_tag,
-            method=method,
-        )
+            relevance_table_name=relevance_table_name,
+            retrieval=retrieval,
+        )[(cik, accession_number)]
 
+    chunks_tried, candidates = [], []
+    for relevant_chunks, relevant_text in _relevant_texts(
+        cik=cik,
+        accession_number=accession_number,
+        text_table_name=text_table_name,
+        relevance_result=relevance_result,
+    ):
         if (
             relevant_chunks in chunks_tried
             or not relevant_text
@@ -165,55 +534,397 @@ def extract_trustee_comp(
             continue
 
         chunks_tried.append(relevant_chunks)
-        result["selected_chunks"] = relevant_chunks
-        result["selected_text"] = relevant_text
-
-        # step 4: send the relevant text to the LLM model with designed prompt
-        response = _ask_model_about_trustee_comp(model, relevant_text)
-        if response:
-            try:
-                comp_info = json.loads(response)
-                n_trustee = len(comp_info["trustees"])
-
-                if n_trustee > 1:
-                    result["n_trustee"] = n_trustee
-                    result["response"] = response
-                    return result
-            except json.JSONDecodeError:
-                pass
-
-    if len(chunks_tried) > 0:
-        logger.info(
-            f"unable to extract trustee info for {cik},{accession_number} with tags {search_phrase_tag}"  # noqa E501
+        candidates.append((relevant_chunks, relevant_text))
+    return candidates
+
+
+def queue_trustee_comp_batch(
+    cik: str,
+    accession_number: str,
+    model: str,
+    candidates: list[tuple[list[int], str]],
+    tags: list[str],
+    attempt: int = 0,
+    result_table_name: str = "",
+) -> dict[str, Any] | None:
+    """
+    queue the prompt of candidate selection attempt for an offline batch,
+    instead of asking the model. like extract_trustee_comp, a selection with
+    the same text as a result in result_table_name, or with its response in
+    the response cache, is answered without the model, trying the next
+    selection when the answer has no trustees.
+
+    returns the result when the filing is answered that way, None when
+    a request is queued
+    """
+    previous = _previous_results(
+        result_table_name, [text for _, text in candidates[attempt:]], model
+    )
+    result = None
+    for attempt in range(attempt, len(candidates)):
+        relevant_chunks, relevant_text = candidates[attempt]
+        prompt = _trustee_comp_prompt(relevant_text)
+        known = previous.get(_text_sha256(relevant_text))
+        if known is None:
+            response = cached_response(model, prompt, STOP_ON_FALSE)
+            if response is None:
+                llm_batch.queue(
+                    custom_id=f"{cik}-{accession_number}-{attempt}",
+                    model=model,
+                    prompt=prompt,
+                    state={
+                        "cik": cik,
+                        "accession_number": accession_number,
+                        "model": model,
+                        "tags": tags,
+                        "attempt": attempt,
+                        "candidates": candidates,
+                    },
+                )
+                return None
+            known = (remove_md_json_wrapper(response), model, None)
+
+        response, answered_by, reused_from = known
+        result = _candidate_result(
+            cik, accession_number, model, candidates[attempt], answered_by, tags
         )
-        return result
+        result["reused_from"] = reused_from
+        n_trustee = _n_trustee(response)
+        if n_trustee > 1:
+            result["n_trustee"] = n_trustee
+            result["response"] = response
+            return result
+
+    logger.info(f"unable to extract trustee info for {cik},{accession_number}")
+    return result
+
+
+def ingest_trustee_comp_batch(
+    batch_file: str,
+    output_file: str,
+    result_table_name: str,
+    followup_file: str,
+) -> tuple[int, int]:
+    """
+    save the results in the output file of a completed batch the same way
+    extract_trustee_comp does. filings without more than 1 trustee found in
+    the response and with candidate selections left are written to
+    followup_file, to try the next selection in another batch.
+
+    returns the number of results saved and of requests in the follow-up batch
+    """
+    responses = llm_batch.read_responses(output_file)
+    results = []
+    for state in llm_batch.read_pending(batch_file):
+        response = responses.get(state["custom_id"])
+        response = remove_md_json_wrapper(response) if response else None
+        candidates = [(chunks, text) for chunks, text in state["candidates"]]
+        attempt = state["attempt"]
+
+        result = _candidate_result(
+            state["cik"],
+            state["accession_number"],
+            state["model"],
+            candidates[attempt],
+            state["model"],
+            state["tags"],
+        )
+        n_trustee = _n_trustee(response)
+        if n_trustee > 1:
+            result["n_trustee"] = n_trustee
+            result["response"] = response
+        elif attempt + 1 < len(candidates):
+            result = queue_trustee_comp_batch(
+                cik=state["cik"],
+                accession_number=state["accession_number"],
+                model=state["model"],
+                candidates=candidates,
+                tags=state["tags"],
+                attempt=attempt + 1,
+                result_table_name=result_table_name,
+            )
+            if result is None:
+                continue
+        else:
+            logger.info(
+                f"unable to extract trustee info for {state['cik']},{state['accession_number']}"  # noqa E501
+            )
+        results.append(result)
+
+    if results:
+        execute_insertmany(result_table_name, results, create_table=True)
+    followups = llm_batch.take()
+    if followups:
+        llm_batch.write_batch(followup_file, followups, append=False)
+    return len(results), len(followups)
+
+
+def _candidate_result(
+    cik: str,
+    accession_number: str,
+    model: str,
+    candidate: tuple[list[int], str],
+    answered_by: str,
+    tags: list[str],
+) -> dict[str, Any]:
+    """result of a batch extraction from candidate, without trustees yet"""
+    relevant_chunks, relevant_text = candidate
+    result = _new_result(cik, accession_number, model)
+    result["selected_chunks"] = relevant_chunks
+    result["selected_text"] = relevant_text
+    result["text_sha256"] = _text_sha256(relevant_text)
+    result["answered_by"] = answered_by
+    result["tags"] = tags
+    return result
+
+
+def _new_result(cik: str, accession_number: str, model: str) -> dict[str, Any]:
+    return {
+        "cik": cik,
+        "accession_number": accession_number,
+        "model": model,
+        "response": "",
+        "n_trustee": 0,
+        "selected_chunks": [],
+        "selected_text": "",
+        "text_sha256": "",
+        "reused_from": None,
+        "answered_by": None,
+    }
+
+
+def _n_trustee(response: str | None) -> int:
+    """number of trustees in a response, 0 when it is not a valid JSON"""
+    if not response:
+        return 0
+    try:
+        return len(json.loads(response).get("trustees", []))
+    except json.JSONDecodeError:
+        return 0
 
-    return None
 
+def _responses(
+    candidates: list[tuple[list[int], str]],
+    model: str,
+    result_table_name: str,
+    speculation: int = 1,
+) -> Iterator[tuple[list[int], str, str | None, str | None, str | None]]:
+    """
+    model response to each candidate selection, in order, along with the
+    model that answered and the accession number of the filing the response
+    was reused from, if any.
+
+    with speculation > 1 up to that many candidates are sent to the model
+    concurrently, ahead of the one being looked at. when the caller stops
+    early the calls not started are cancelled and the running ones ignored.
+    """
+    # sibling funds often share the same text, reuse the response
+    # extracted earlier from another filing if there is one
+    previous = _previous_results(
+        result_table_name, [text for _, text in candidates], model
+    )
+    executor = ThreadPoolExecutor(max_workers=speculation) if speculation > 1 else None
+    candidates_left = iter(candidates)
+    pending = deque()
+    try:
+        while True:
+            for chunks, text in islice(
+                candidates_left, max(speculation, 1) - len(pending)
+            ):
+                pending.append(
+                    (
+                        chunks,
+                        text,
+                        _response_future(
+                            executor, model, text, previous.get(_text_sha256(text))
+                        ),
+                    )
+                )
+            if not pending:
+                return
+            chunks, text, future = pending.popleft()
+            yield chunks, text, *future.result()
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _response_future(
+    executor: ThreadPoolExecutor | None,
+    model: str,
+    text: str,
+    previous: tuple[str, str, str] | None,
+) -> Future:
+    future = Future()
+    if previous:
+        future.set_result(previous)
+    elif executor:
+        return executor.submit(
+            lambda: (*_ask_model_about_trustee_comp(model, text), None)
+        )
+    else:
+        future.set_result((*_ask_model_about_trustee_comp(model, text), None))
+    return future
 
-def _find_relevant_text(
+
+def _text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _previous_results(
+    result_table_name: str, texts: list[str], model: str
+) -> dict[str, tuple[str, str, str]]:
+    """
+    response, the model that answered and accession number of a successful
+    extraction from the same text by the same model, saved with any tag,
+    keyed by the sha256 of each text that has one.
+    the texts are all looked up in a single query
+    """
+    if not result_table_name or not texts:
+        return {}
+
+    hashes = list(dict.fromkeys(_text_sha256(text) for text in texts))
+    try:
+        rows = execute_query(
+            f"""
+            SELECT DISTINCT ON (text_sha256) text_sha256, response,
+                COALESCE(answered_by, model) AS answered_by, accession_number
+            FROM {result_table_name}
+            WHERE text_sha256 = ANY(%s) AND model = %s AND n_trustee > 1
+            ORDER BY text_sha256
+            """,
+            (hashes, model),
+            prepare=True,
+        )
+    except DatabaseException as e:
+        if "does not exist" not in str(e):
+            raise e
+        return {}
+
+    previous = {}
+    for row in rows:
+        logger.debug(f"reusing result of {row['accession_number']} with same text")
+        previous[row["text_sha256"]] = (
+            row["response"],
+            row["answered_by"],
+            row["accession_number"],
+        )
+    return previous
+
+
+def _relevant_texts(
     cik: str,
     accession_number: str,
     text_table_name: str,
-    embedding_table_name: str,
-    search_phrase_table_name: str,
-    search_phrase_tag: str,
-    method: str,
-) -> tuple[list[int], str]:
-    relevance_result = relevant_chunks_with_distances(
+    relevance_result: list[dict[str, Any]],
+) -> list[tuple[list[int], str]]:
+    """
+    selected chunks and their text for each of SELECTION_METHODS, in order.
+    the text of the chunks selected by any method is fetched in one query
+    """
+    if not relevance_result:
+        return []
+
+    chunk_distances = gather_chunk_distances(relevance_result)
+    text_ranking = (
+        _text_ranking(cik, accession_number, text_table_name)
+        if "hybrid" in SELECTION_METHODS
+        else []
+    )
+    selections = [
+        _select_chunks(chunk_distances, method, text_ranking)
+        for method in SELECTION_METHODS
+    ]
+    chunk_nums = sorted(set(chain.from_iterable(selections)))
+    texts = {
+        row["chunk_num"]: row["chunk_text"]
+        for row in get_chunks(
+            table_name=text_table_name,
+            cik=cik,
+            accession_number=accession_number,
+            chunk_nums=chunk_nums,
+        )
+    }
+
+    relevant_texts, tokens_saved = [], {}
+    for selected_chunks in selections:
+        if selected_chunks and all(chunk_num in texts for chunk_num in selected_chunks):
+            key = tuple(selected_chunks)
+            selected_chunks, text, tokens_saved[key] = _selection_text(
+                selected_chunks, texts, chunk_distances
+            )
+            relevant_texts.append((selected_chunks, text))
+        else:
+            relevant_texts.append(([], ""))
+
+    logger.info(
+        f"compacted {len(tokens_saved)} selections of {cik},{accession_number}, saved {sum(tokens_saved.values())} tokens"  # noqa E501
+    )
+    return relevant_texts
+
+
+def _selection_text(
+    selected_chunks: list[int],
+    texts: dict[int, str],
+    chunk_distances: dict,
+) -> tuple[list[int], str, int]:
+    """
+    compacted text of the selected chunks. when it is over PROMPT_TOKEN_BUDGET
+    the chunks farthest from the search phrases are left out.
+    returns the chunks kept, their text and the estimated number of tokens saved
+    """
+    tokens = {
+        chunk_num: estimate_tokens(compact_text(texts[chunk_num]))
+        for chunk_num in selected_chunks
+    }
+    kept = list(selected_chunks)
+    # chunks added only for being adjacent to a close one have no distance
+    by_relevance = sorted(
+        selected_chunks,
+        key=lambda chunk_num: min(chunk_distances.get(chunk_num, [np.inf])),
+    )
+    while (
+        len(kept) > 1
+        and sum(tokens[chunk_num] for chunk_num in kept) > PROMPT_TOKEN_BUDGET
+    ):
+        kept.remove(by_relevance.pop())
+
+    # compacted again together, so that a table split across adjacent chunks
+    # is compacted as one and a header repeated after a page break is dropped
+    text = compact_text(
+        "\n".join(
+            ("\n" if i and chunk_num != kept[i - 1] + 1 else "") + texts[chunk_num]
+            for i, chunk_num in enumerate(kept)
+        )
+    )
+    raw_text = "\n".join(texts[chunk_num] for chunk_num in selected_chunks)
+    return kept, text, estimate_tokens(raw_text) - estimate_tokens(text)
+
+
+def _text_ranking(cik: str, accession_number: str, text_table_name: str) -> list[int]:
+    """chunks of a filing that match TRUSTEE_COMP_KEYWORDS, best first"""
+    ranked = rank_chunks_by_text(
         cik=cik,
         accession_number=accession_number,
-        embedding_table_name=embedding_table_name,
-        search_phrase_table_name=search_phrase_table_name,
-        search_phrase_tag=search_phrase_tag,
-        limit=20,
+        table_name=text_table_name,
+        tsquery=TRUSTEE_COMP_KEYWORDS,
+        limit=SEARCH_LIMIT,
     )
+    return [row["chunk_num"] for row in ranked if row["rank"] > 0]
 
-    if not relevance_result:
-        return [], ""
 
-    chunk_distances = gather_chunk_distances(relevance_result)
-    if method == "distance":
+def _select_chunks(
+    chunk_distances: dict,
+    method: str,
+    text_ranking: list[int] | None = None,
+) -> list[int]:
+    if method == "hybrid":
+        vector_ranking = [
+            chunk_num for chunk_num, _, _, _ in relevance_by_distance(chunk_distances)
+        ]
+        relevance_scores = relevance_by_rank_fusion([vector_ranking, text_ranking or []])
+        selected_chunks = [int(s) for s in top_adjacent_chunks(relevance_scores)]
+    elif method == "distance":
         relevance_scores = relevance_by_distance(chunk_distances)
         selected_chunks = [int(s) for s in top_adjacent_chunks(relevance_scores)]
     elif method == "appearance":
@@ -226,33 +937,30 @@ def _find_relevant_text(
         relevance_scores = relevance_by_appearance(chunk_distances)
         selected_chunks = [int(s) for s in top_3_chunks(relevance_scores)]
     else:
-        return [], ""
+        return []
 
     logger.debug(f"Selected chunks by {method}: {selected_chunks}")
+    return selected_chunks
 
-    results = get_chunks(
-        table_name=text_table_name,
-        cik=cik,
-        accession_number=accession_number,
-        chunk_nums=selected_chunks,
-    )
 
-    if results and len(results) == len(selected_chunks):
-        return selected_chunks, "\n".join([row["chunk_text"] for row in results])
-    else:
-        return [], ""
+def _trustee_comp_prompt(relevant_text: str) -> str:
+    return TRUSTEE_COMP_PROMPT.replace("{SEC_FILING_SNIPPET}", relevant_text)
 
 
-def _ask_model_about_trustee_comp(model: str, relevant_text: str) -> str | None:
+def _ask_model_about_trustee_comp(
+    model: str, relevant_text: str
+) -> tuple[str | None, str]:
+    """response of the model, or of the hedge model if it answered first, and
+    the model that answered"""
     start_t = datetime.now()
-    prompt = TRUSTEE_COMP_PROMPT.replace("{SEC_FILING_SNIPPET}", relevant_text)
-    response = ask_model(model, prompt)
+    prompt = _trustee_comp_prompt(relevant_text)
+    response, answered_by = ask_model_hedged(model, prompt, stop_on_false=STOP_ON_FALSE)
     elapsed_t = datetime.now() - start_t
     logger.debug(
-        f"ask {model} with prompt of {len(prompt)} took {elapsed_t.total_seconds()} seconds"  # noqa E501
+        f"ask {model} with prompt of {len(prompt)} took {elapsed_t.total_seconds()} seconds, answered by {answered_by}"  # noqa E501
     )
 
     if response:
-        return remove_md_json_wrapper(response)
+        return remove_md_json_wrapper(response), answered_by
 
-    return None
+    return None, answered_by
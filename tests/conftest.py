@@ -1,10 +1,11 @@
 import os
+import random
 from pathlib import Path
 
 import pytest
 
 import config
-from sleuth.datastore import execute_query
+from sleuth.datastore import execute_insertmany, execute_query, save_chunks
 
 cache_path = str(Path(__file__).parent / "data/cache")
 config.setv("cache_path", cache_path)
@@ -29,3 +30,55 @@ def clean_db():
             execute_query(f"DROP TABLE IF EXISTS {table["tablename"]} CASCADE;")
     except Exception as e:
         print(f"Error: {e}")
+
+
+# kind of table in tables_map and the prefix of its name
+_TABLE_PREFIXES = {
+    "text": "filing_text_chunks",
+    "embedding": "filing_chunks_embeddings",
+    "search": "search_phrase_embeddings",
+    "result": "trustee_comp_results",
+    "relevance": "filing_chunks_relevance",
+    "fingerprint": "filing_fingerprints",
+}
+
+
+@pytest.fixture
+def filing_tables(clean_db):
+    """
+    factory of a tables_map with the table names ending with suffix.
+    filings get n_chunks random embeddings, and 4 random search phrases
+    are saved with tag when it is given
+    """
+
+    def make(
+        suffix: str,
+        tag: str = "",
+        filings: list[tuple[str, str]] | None = None,
+        n_chunks: int = 30,
+        dimension: int = 16,
+    ) -> dict[str, str]:
+        tables = {kind: f"{prefix}_{suffix}" for kind, prefix in _TABLE_PREFIXES.items()}
+        for cik, accession_number in filings or []:
+            embeddings = [_rand_vec(dimension) for _ in range(n_chunks)]
+            save_chunks(cik, accession_number, embeddings, tables["embedding"], True)
+        if tag:
+            execute_insertmany(
+                tables["search"],
+                [
+                    {
+                        "phrase": f"phrase {i}",
+                        "phrase_embedding": _rand_vec(dimension),
+                        "tags": [tag],
+                    }
+                    for i in range(4)
+                ],
+                create_table=True,
+            )
+        return tables
+
+    return make
+
+
+def _rand_vec(dimension: int) -> list[float]:
+    return [random.uniform(-1, 1) for _ in range(dimension)]
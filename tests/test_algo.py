@@ -0,0 +1,80 @@
+import random
+
+import numpy as np
+import pytest
+
+from sleuth.llm.algo import (
+    gather_chunk_distances,
+    relevance_by_appearance,
+    relevance_by_distance,
+    relevance_by_rank_fusion,
+    score_chunks,
+    top_3_chunks,
+    top_adjacent_chunks,
+    top_ranked,
+)
+
+
+def test_relevance_by_distance():
+    chunk_distances = {159: [0.282, 0.345], 158: [0.291], 444: [0.311, 0.316]}
+    scores = relevance_by_distance(chunk_distances)
+    assert [chunk_num for chunk_num, _, _, _ in scores] == [158, 159, 444]
+    assert scores[0] == pytest.approx((158, 1 / 1.291, 0.291, 0.291))
+    assert top_adjacent_chunks(scores) == [158, 159]
+
+
+def test_relevance_by_appearance():
+    chunk_distances = {158: [0.291], 159: [0.282, 0.345], 444: [0.282, 0.345]}
+    scores = relevance_by_appearance(chunk_distances)
+    # tied chunks keep the order they first appear in
+    assert [chunk_num for chunk_num, _, _, _ in scores] == [159, 444, 158]
+    assert scores[0] == pytest.approx((159, 2, 0.3135, 2 / 1.3135))
+    assert top_3_chunks(scores) == [158, 159, 444]
+
+
+def test_relevance_by_rank_fusion():
+    scores = relevance_by_rank_fusion([[158, 159, 444], [159, 12]])
+    assert [chunk_num for chunk_num, _, _, _ in scores] == [159, 158, 12, 444]
+    assert scores[0] == pytest.approx((159, 1 / 62 + 1 / 61, 2, 1))
+    assert top_adjacent_chunks(scores) == [158, 159]
+    assert relevance_by_rank_fusion([[], []]) == []
+
+
+@pytest.mark.parametrize("method", ["distance", "appearance"])
+def test_score_chunks_for_many_filings(method):
+    relevance_by = {
+        "distance": relevance_by_distance,
+        "appearance": relevance_by_appearance,
+    }
+    filings = {
+        f"filing-{i}": [
+            {"chunk_num": random.randint(0, 30), "distance": random.uniform(0.2, 0.6)}
+            for _ in range(20)
+        ]
+        for i in range(50)
+    }
+    filing_ids = [filing for filing, rows in filings.items() for _ in rows]
+    rows = [row for rows in filings.values() for row in rows]
+
+    scores = score_chunks(
+        [row["chunk_num"] for row in rows],
+        [row["distance"] for row in rows],
+        method=method,
+        filing_ids=filing_ids,
+    )
+    top = top_ranked(scores, 3)
+
+    # same ranking as scoring each filing on its own
+    for filing, filing_rows in filings.items():
+        expected = relevance_by[method](gather_chunk_distances(filing_rows))
+        ranked = scores.chunk_num[scores.filing_id == filing].tolist()
+        assert ranked == [chunk_num for chunk_num, _, _, _ in expected]
+        assert top.chunk_num[top.filing_id == filing].tolist() == ranked[:3]
+
+
+def test_score_chunks_empty():
+    scores = score_chunks([], [])
+    assert len(scores.chunk_num) == 0
+    assert relevance_by_distance({}) == []
+    assert len(top_ranked(scores).chunk_num) == 0
+    assert isinstance(scores.score, np.ndarray)
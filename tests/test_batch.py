@@ -0,0 +1,235 @@
+import json
+
+import pytest
+
+from sleuth.datastore import execute_insertmany, execute_query
+from sleuth.llm import batch as llm_batch
+from sleuth.llm import cache as llm_cache
+from sleuth.llm.extraction import cache_config, remove_md_json_wrapper
+from sleuth.processor import process_filing
+from sleuth.trustee import (
+    STOP_ON_FALSE,
+    _text_sha256,
+    _trustee_comp_prompt,
+    ingest_trustee_comp_batch,
+)
+
+_POSITIVE = '```json\n{"trustees": [{"name": "a"}, {"name": "b"}]}\n```'
+_NEGATIVE = '{"compensation_info_present": false, "trustees": []}'
+
+
+def run_batch(batch_file: str, output_file: str) -> None:
+    # local stand-in for the batch API, answers every request in the file
+    # and writes the output file the way the OpenAI Batch API does
+    with open(batch_file) as f, open(output_file, "w") as out:
+        for line in f:
+            request = json.loads(line)
+            prompt = request["body"]["messages"][0]["content"]
+            content = _POSITIVE if "Compensation Table" in prompt else _NEGATIVE
+            out.write(
+                json.dumps(
+                    {
+                        "id": f"batch_req_{request['custom_id']}",
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "body": {"choices": [{"message": {"content": content}}]},
+                        },
+                        "error": None,
+                    }
+                )
+            )
+            out.write("\n")
+
+
+def test_batch_request():
+    request = llm_batch.batch_request("1-2-0", "gpt-4o-mini", "prompt")
+    assert request["custom_id"] == "1-2-0"
+    assert request["body"]["messages"] == [{"role": "user", "content": "prompt"}]
+
+    request = llm_batch.batch_request("1-2-0", "gemini-1.5-flash-002", "prompt")
+    assert request["request"]["labels"] == {"custom_id": "1-2-0"}
+    assert request["request"]["contents"][0]["parts"] == [{"text": "prompt"}]
+
+    with pytest.raises(ValueError):
+        llm_batch.batch_request("1-2-0", "claude", "prompt")
+
+
+def test_read_gemini_responses(tmp_path):
+    output_file = tmp_path / "output.jsonl"
+    requests = [
+        llm_batch.batch_request(f"1-2-{n}", "gemini-1.5-flash-002", "prompt")
+        for n in range(2)
+    ]
+    output_file.write_text(
+        json.dumps(
+            requests[0]
+            | {
+                "status": "",
+                "response": {
+                    "candidates": [{"content": {"parts": [{"text": "answer"}]}}]
+                },
+            }
+        )
+        + "\n"
+        + json.dumps(requests[1] | {"status": "Quota exceeded"})
+        + "\n"
+    )
+    responses = llm_batch.read_responses(str(output_file))
+    assert responses == {"1-2-0": "answer", "1-2-1": None}
+
+
+def test_batch_extraction(clean_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_cache, "_mode", "off")
+    tables = {
+        "text": "filing_text_chunks_batch",
+        "embedding": "filing_chunks_embeddings_batch",
+        "search": "search_phrase_embeddings_batch",
+        "result": "trustee_comp_results_batch",
+    }
+    table_text = "| Name | Compensation Table |\n" * 10
+    other_text = "| Name | Fees |\n" * 10
+    candidates = {
+        # the table is only found by the second selection
+        "0000000001-24-000007": [([1, 2], other_text), ([5, 6], table_text)],
+        "0000000002-24-000007": [([3], table_text)],
+        "0000000003-24-000007": [([4], other_text)],
+    }
+    monkeypatch.setattr(
+        "sleuth.processor.trustee_comp_candidates",
+        lambda cik, accession_number, **kwargs: candidates[accession_number],
+    )
+
+    batch_file = str(tmp_path / "batch.jsonl")
+    llm_batch.take()
+    for accession_number in candidates:
+        assert process_filing(
+            action="extract",
+            tables_map=tables,
+            cik=accession_number[9],
+            accession_number=accession_number,
+            idx_tag="batch",
+            search_tag="batch",
+            result_tag="batch1",
+            model="gpt-4o-mini",
+            dimension=16,
+            form_type="485BPOS",
+            batch=True,
+        )
+    assert llm_batch.write_batch(batch_file, llm_batch.take(), append=False) == 3
+
+    run_batch(batch_file, str(tmp_path / "output.jsonl"))
+    followup_file = str(tmp_path / "followup.jsonl")
+    n_results, n_followups = ingest_trustee_comp_batch(
+        batch_file=batch_file,
+        output_file=str(tmp_path / "output.jsonl"),
+        result_table_name=tables["result"],
+        followup_file=followup_file,
+    )
+    # the first filing falls through to its next selection,
+    # the last one has no selection left and is saved without trustees
+    assert (n_results, n_followups) == (2, 1)
+
+    run_batch(followup_file, str(tmp_path / "followup_output.jsonl"))
+    n_results, n_followups = ingest_trustee_comp_batch(
+        batch_file=followup_file,
+        output_file=str(tmp_path / "followup_output.jsonl"),
+        result_table_name=tables["result"],
+        followup_file=str(tmp_path / "followup2.jsonl"),
+    )
+    assert (n_results, n_followups) == (1, 0)
+
+    rows = execute_query(
+        f"""
+        SELECT accession_number, n_trustee, selected_chunks, answered_by, tags
+        FROM {tables["result"]} ORDER BY accession_number
+        """
+    )
+    assert [(row["n_trustee"], row["selected_chunks"]) for row in rows] == [
+        (2, [5, 6]),
+        (2, [3]),
+        (0, [4]),
+    ]
+    assert all(row["answered_by"] == "gpt-4o-mini" for row in rows)
+    assert all(row["tags"] == ["batch1"] for row in rows)
+
+
+def test_batch_skips_known_answers(clean_db, tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_PATH", str(tmp_path / "responses.sqlite"))
+    monkeypatch.setattr(llm_cache, "_cache", None)
+    monkeypatch.setattr(llm_cache, "_mode", "readwrite")
+    tables = {
+        "text": "filing_text_chunks_batch_known",
+        "embedding": "filing_chunks_embeddings_batch_known",
+        "search": "search_phrase_embeddings_batch_known",
+        "result": "trustee_comp_results_batch_known",
+    }
+    model = "gpt-4o-mini"
+    table_text = "| Name | Compensation Table |\n" * 10
+    other_text = "| Name | Fees |\n" * 10
+    cached_text = "| Name | Aggregate Compensation |\n" * 10
+    new_text = "| Name | Compensation Table of another fund |\n" * 10
+
+    # a sibling fund with the same text was extracted before
+    execute_insertmany(
+        tables["result"],
+        [
+            {
+                "cik": "9",
+                "accession_number": "0000000009-24-000008",
+                "model": model,
+                "selected_chunks": [1],
+                "selected_text": table_text,
+                "text_sha256": _text_sha256(table_text),
+                "response": remove_md_json_wrapper(_POSITIVE),
+                "n_trustee": 2,
+                "tags": ["batch0"],
+            }
+        ],
+        create_table=True,
+    )
+    cache = llm_cache.response_cache()
+    assert cache is not None
+    for text, response in [(other_text, _NEGATIVE), (cached_text, _POSITIVE)]:
+        config = cache_config(model, STOP_ON_FALSE)
+        cache.put(model, config, _trustee_comp_prompt(text), response)
+
+    candidates = {
+        "0000000001-24-000008": [([1, 2], other_text), ([5, 6], table_text)],
+        "0000000002-24-000008": [([3], cached_text)],
+        "0000000003-24-000008": [([4], other_text), ([7], new_text)],
+    }
+    monkeypatch.setattr(
+        "sleuth.processor.trustee_comp_candidates",
+        lambda cik, accession_number, **kwargs: candidates[accession_number],
+    )
+
+    llm_batch.take()
+    for accession_number in candidates:
+        assert process_filing(
+            action="extract",
+            tables_map=tables,
+            cik=accession_number[9],
+            accession_number=accession_number,
+            idx_tag="batch",
+            search_tag="batch",
+            result_tag="batch1",
+            model=model,
+            dimension=16,
+            form_type="485BPOS",
+            batch=True,
+        )
+
+    # only the selection nobody answered yet goes into the batch
+    queued = llm_batch.take()
+    assert [state["custom_id"] for _, state in queued] == ["3-0000000003-24-000008-1"]
+
+    rows = execute_query(
+        f"""
+        SELECT accession_number, n_trustee, selected_chunks, reused_from
+        FROM {tables["result"]} WHERE 'batch1' = ANY(tags) ORDER BY accession_number
+        """
+    )
+    assert [
+        (row["n_trustee"], row["selected_chunks"], row["reused_from"]) for row in rows
+    ] == [(2, [5, 6], "0000000009-24-000008"), (2, [3], None)]
@@ -0,0 +1,178 @@
+import os
+import random
+import time
+
+import pytest
+
+from sleuth.datastore import (
+    _conn,
+    _create_table,
+    _insert_rows,
+    execute_insertmany,
+    execute_query,
+    get_chunks,
+    migrate_table,
+    save_chunks,
+    search_chunks,
+)
+from sleuth.trustee import _previous_results, _text_sha256
+
+run_benchmarks = os.environ.get("PYTEST_RUN_BENCHMARKS", "0") == "1"
+
+
+@pytest.mark.skipif(not run_benchmarks, reason="benchmarks are slow, run on demand")
+def test_bulk_write_benchmark(clean_db):
+    """compare COPY based save_chunks with row by row INSERT for a 500 chunk filing"""
+    n_chunks, dimension = 500, 768
+    text_chunks = [_rand_text(3500) for _ in range(n_chunks)]
+    embeddings = [_rand_vec(dimension) for _ in range(n_chunks)]
+
+    for table_name, chunks in [
+        ("filing_text_chunks_bench", text_chunks),
+        ("filing_chunks_embeddings_bench", embeddings),
+    ]:
+        col = "embedding" if isinstance(chunks[0], list) else "chunk_text"
+        _create_table(table_name, dimension=dimension)
+
+        start_t = time.perf_counter()
+        _insert_rows(
+            table_name,
+            ["cik", "accession_number", "chunk_num", col],
+            [("1", "0000000001-24-000001", i, c) for i, c in enumerate(chunks)],
+        )
+        _conn().commit()
+        insert_t = time.perf_counter() - start_t
+
+        start_t = time.perf_counter()
+        save_chunks(
+            cik="2",
+            accession_number="0000000002-24-000002",
+            chunks=chunks,
+            table_name=table_name,
+        )
+        copy_t = time.perf_counter() - start_t
+
+        print(f"\n{table_name}: INSERT {insert_t:.3f}s, COPY {copy_t:.3f}s")
+        saved = get_chunks("2", "0000000002-24-000002", table_name)
+        assert len(saved) == n_chunks
+
+
+@pytest.mark.skipif(not run_benchmarks, reason="benchmarks are slow, run on demand")
+def test_search_benchmark(clean_db):
+    """latency and recall of HNSW search against exact search at several ef_search"""
+    n_filings, n_chunks, dimension, top_k = 200, 100, 256, 10
+    embedding_table, idx_table = "filing_chunks_embeddings_ann", "master_idx_ann"
+    _create_table(idx_table)
+    # real embeddings cluster by topic, uniform random vectors would make
+    # every chunk almost equally far from the query
+    topics = [[random.gauss(0, 1) for _ in range(dimension)] for _ in range(50)]
+    for i in range(n_filings):
+        embeddings = [_near(random.choice(topics), 0.5) for _ in range(n_chunks)]
+        save_chunks(str(i), f"{i:010d}-24-000001", embeddings, embedding_table, True)
+    _conn().commit()
+    migrate_table(embedding_table, vector_index="hnsw")
+
+    queries = [_near(random.choice(topics), 0.5) for _ in range(20)]
+    exact_t, expected = _timed_search(queries, embedding_table, idx_table, top_k, True)
+    print(f"\nexact search of {n_filings * n_chunks} chunks: {exact_t * 1000:.1f} ms")
+
+    for ef_search in (10, 40, 100, 200):
+        ann_t, results = _timed_search(
+            queries, embedding_table, idx_table, top_k, False, ef_search
+        )
+        recall = sum(
+            len(_chunk_keys(result) & _chunk_keys(exact))
+            for result, exact in zip(results, expected)
+        ) / (top_k * len(queries))
+        print(
+            f"ef_search={ef_search}: {ann_t * 1000:.1f} ms, recall@{top_k} {recall:.3f}"
+        )
+
+    assert recall >= 0.9
+
+
+@pytest.mark.skipif(not run_benchmarks, reason="benchmarks are slow, run on demand")
+def test_previous_results_benchmark(clean_db):
+    """look up the previous results of every candidate one by one and in a batch"""
+    n_filings, n_candidates, model = 2000, 5, "gpt-4o"
+    table_name = "trustee_comp_results_bench"
+    texts = [_rand_text(2000) for _ in range(n_filings)]
+    execute_insertmany(
+        table_name,
+        [
+            {
+                "cik": str(i),
+                "accession_number": f"{i:010d}-24-000001",
+                "model": model,
+                "response": "{}",
+                "n_trustee": 2,
+                "selected_chunks": [1],
+                "selected_text": text,
+                "text_sha256": _text_sha256(text),
+                "tags": ["bench"],
+            }
+            for i, text in enumerate(texts)
+        ],
+        create_table=True,
+    )
+
+    filings = [random.sample(texts, n_candidates) for _ in range(200)]
+    start_t = time.perf_counter()
+    for candidates in filings:
+        one_by_one = [
+            execute_query(
+                f"SELECT response FROM {table_name}"
+                " WHERE text_sha256 = %s AND model = %s AND n_trustee > 1 LIMIT 1",
+                (_text_sha256(text), model),
+                prepare=True,
+            )
+            for text in candidates
+        ]
+    sequential_t = (time.perf_counter() - start_t) / len(filings)
+
+    start_t = time.perf_counter()
+    for candidates in filings:
+        batched = _previous_results(table_name, candidates, model)
+    batch_t = (time.perf_counter() - start_t) / len(filings)
+
+    print(
+        f"\n{n_candidates} candidates: one by one {sequential_t * 1000:.2f} ms,"
+        f" batched {batch_t * 1000:.2f} ms"
+    )
+    assert len(batched) == len(one_by_one) == n_candidates
+
+
+def _timed_search(queries, embedding_table, idx_table, top_k, exact, ef_search=40):
+    start_t = time.perf_counter()
+    results = [
+        search_chunks(
+            query,
+            embedding_table,
+            idx_table,
+            limit=top_k,
+            ef_search=ef_search,
+            exact=exact,
+        )
+        for query in queries
+    ]
+    return (time.perf_counter() - start_t) / len(queries), results
+
+
+def _chunk_keys(rows: list[dict]) -> set[tuple]:
+    return {(row["cik"], row["accession_number"], row["chunk_num"]) for row in rows}
+
+
+def _near(vector: list[float], noise: float) -> list[float]:
+    return [v + random.gauss(0, noise) for v in vector]
+
+
+def _rand_text(size: int) -> str:
+    words = ["trustee", "compensation", "fund", "aggregate", "board", "pension"]
+    text = ""
+    while len(text) < size:
+        text += random.choice(words) + " "
+    return text
+
+
+def _rand_vec(dimension: int) -> list[float]:
+    return [random.uniform(0.0, 1.0) for _ in range(dimension)]
@@ -0,0 +1,84 @@
+from sleuth.compact import compact_text, estimate_tokens
+from sleuth.trustee import _selection_text
+
+_CHUNK = """The following table shows the   compensation paid, see [the report](https://www.sec.gov/Archives/edgar/data/1/000000000124000001/report.htm).
+
+---
+|  |
+---|---|---
+Name |  |  Aggregate Compensation |  Total Compensation
+---|---|---|---
+|  |  |
+Frank L. Bowman |  |  $2,158 |  $400,000
+Frances L. Cashman |  |  1,806 |  335,000
+
+
+
+
+44
+"""  # noqa: E501
+
+_NEXT_CHUNK = """* * *
+
+Name |  Aggregate Compensation |  Total Compensation
+---|---|---
+Kathleen A. Dennis |  2,077 |  385,000
+"""
+
+
+def test_compact_text():
+    text = compact_text(_CHUNK)
+    assert text == (
+        "The following table shows the compensation paid, see the report.\n"
+        "\n"
+        "Name | Aggregate Compensation | Total Compensation\n"
+        "Frank L. Bowman | $2,158 | $400,000\n"
+        "Frances L. Cashman | 1,806 | 335,000\n"
+        "\n"
+        "44"
+    )
+    assert estimate_tokens(text) < estimate_tokens(_CHUNK) * 0.6
+
+
+def test_repeated_header():
+    text = compact_text(_CHUNK + _NEXT_CHUNK)
+    assert text.endswith("44\n* * *\n\nKathleen A. Dennis | 2,077 | 385,000")
+    # the header stays when seen for the first time
+    assert compact_text(_NEXT_CHUNK).startswith("* * *\n\nName |")
+
+
+def test_text_with_pipe_is_not_a_table():
+    text = "the ratio |x| is small\nnext line"
+    assert compact_text(text) == text
+
+
+def test_table_split_across_chunks():
+    texts = {
+        1: "Name | Fund A | Fund B\n---|---|---\nFrank L. Bowman |  | 100",
+        2: "Frances L. Cashman | 50 | 200",
+    }
+    _, text, _ = _selection_text([1, 2], texts, {})
+    # the column empty in the first chunk is kept for the rows of the second
+    assert text == (
+        "Name | Fund A | Fund B\nFrank L. Bowman |  | 100\nFrances L. Cashman | 50 | 200"
+    )
+
+
+def test_selection_text_budget(monkeypatch):
+    texts = {1: _CHUNK, 2: _NEXT_CHUNK, 3: "Trustee fees " * 200}
+    chunk_distances = {1: [0.21, 0.3], 3: [0.35]}
+
+    chunks, text, tokens_saved = _selection_text([1, 2, 3], texts, chunk_distances)
+    assert chunks == [1, 2, 3]
+    assert "Name |" not in text.split("* * *")[1]
+    assert tokens_saved == estimate_tokens("\n".join(texts.values())) - estimate_tokens(
+        text
+    )
+
+    # chunk 2 has no distance of its own and goes first, then the farthest
+    monkeypatch.setattr("sleuth.trustee.PROMPT_TOKEN_BUDGET", 700)
+    chunks, _, _ = _selection_text([1, 2, 3], texts, chunk_distances)
+    assert chunks == [1, 3]
+    monkeypatch.setattr("sleuth.trustee.PROMPT_TOKEN_BUDGET", 10)
+    chunks, text, _ = _selection_text([1, 2, 3], texts, chunk_distances)
+    assert chunks == [1] and text == compact_text(_CHUNK)
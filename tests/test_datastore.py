@@ -1,10 +1,30 @@
+import asyncio
 import random
 
+import pytest
+
 from sleuth.datastore import (
+    TEXT_SEARCH_VECTOR,
+    DatabaseException,
+    _conn,
+    _filing_year,
+    aclose_pool,
+    aexecute_insertmany,
+    aexecute_query,
+    aget_chunks,
+    asave_chunks,
+    count_chunks,
+    drop_filing_year,
     execute_insertmany,
     execute_query,
     get_chunks,
+    get_embeddings,
+    migrate_table,
+    query_batch,
+    rank_chunks_by_text,
     save_chunks,
+    search_chunks,
+    stream_query,
 )
 
 
@@ -66,6 +86,15 @@ def test_save_embedding_chunks(clean_db):
         create_table=True,
     )
 
+    result = get_chunks(
+        cik="12345678",
+        accession_number="0001111111-88-666666",
+        table_name="filing_chunks_embeddings",
+    )
+    assert len(result) == 3
+    saved = [float(v) for v in result[2]["embedding"].strip("[]").split(",")]
+    assert saved == pytest.approx(embedding_chunks[2], rel=1e-6)
+
 
 def test_execute_insertmany(clean_db):
     table_name = "some_funny_table"
@@ -79,11 +108,407 @@ def test_execute_insertmany(clean_db):
     )
     assert execute_insertmany(table_name=table_name, data=data, create_table=False)
 
+    result = execute_query(f"SELECT * FROM {table_name} ORDER BY n_trustee")
+    assert [row["cik"] for row in result] == ["1343", "1344", "8888"]
+
+
+def test_execute_insertmany_with_vector(clean_db):
+    table_name = "search_phrase_embeddings_tmp"
+    data = [
+        {"phrase": "phrase 1", "phrase_embedding": _rand_vec(16), "tags": ["tmp"]},
+        {"phrase": "phrase 2", "phrase_embedding": _rand_vec(16), "tags": ["tmp"]},
+    ]
+    assert execute_insertmany(table_name=table_name, data=data, create_table=True)
+
+    result = execute_query(f"SELECT * FROM {table_name} WHERE 'tmp' = ANY(tags)")
+    assert len(result) == 2
+
+
+def test_stream_query(clean_db):
+    table_name = "stream_test_table"
+    execute_query(f"create table {table_name} (n int, name text)")
+    data = [{"n": i, "name": f"row {i}"} for i in range(5)]
+    execute_insertmany(table_name=table_name, data=data, create_table=False)
+
+    query = f"SELECT n, name FROM {table_name} ORDER BY n"
+    rows = list(stream_query(query, fetch_size=2))
+    assert rows == data
+
+    rows = list(stream_query(query, fetch_size=2, row_mode="tuple"))
+    assert rows[4] == (4, "row 4")
+
+    batches = list(stream_query(query, fetch_size=2, row_mode="columnar"))
+    assert len(batches) == 3
+    assert batches[0] == {"n": [0, 1], "name": ["row 0", "row 1"]}
+    assert batches[2] == {"n": [4], "name": ["row 4"]}
+
+
+def test_query_batch(clean_db):
+    table_name = "batch_test_table"
+    execute_query(f"create table {table_name} (n int, name text)")
+
+    with query_batch() as batch:
+        for i in range(3):
+            batch.add(f"INSERT INTO {table_name} VALUES (%s, %s)", (i, f"row {i}"))
+    assert batch.results == [[], [], []]
+
+    with query_batch() as batch:
+        count_idx = batch.add(f"SELECT COUNT(*) AS n FROM {table_name}")
+        row_idx = batch.add(f"SELECT name FROM {table_name} WHERE n = %s", (2,))
+    assert batch.results[count_idx] == [{"n": 3}]
+    assert batch.results[row_idx] == [{"name": "row 2"}]
+
+    with pytest.raises(DatabaseException):
+        with query_batch() as batch:
+            batch.add(f"SELECT COUNT(*) FROM {table_name}")
+            batch.add("SELECT * FROM no_such_table")
+    # the connection is usable after a failed batch
+    assert execute_query(f"SELECT COUNT(*) AS n FROM {table_name}") == [{"n": 3}]
+
+
+def test_create_table_with_indexes(clean_db):
+    table_name = "filing_text_chunks_idx_tmp"
+    save_chunks(
+        cik="12345678",
+        accession_number="0001111111-88-666666",
+        chunks=["The quick brown fox jumps over the lazy dog."] * 2,
+        table_name=table_name,
+        create_table=True,
+    )
+    assert f"{table_name}_key" in _index_names(table_name)
+
+
+def test_save_chunks_replaces_filing(clean_db):
+    table_name = "filing_text_chunks_rerun"
+    for chunks in [["first run chunk"] * 3, ["second run chunk"] * 2]:
+        save_chunks(
+            cik="12345678",
+            accession_number="0001111111-88-666666",
+            chunks=chunks,
+            table_name=table_name,
+            create_table=True,
+        )
+
+    result = get_chunks("12345678", "0001111111-88-666666", table_name)
+    assert [row["chunk_text"] for row in result] == ["second run chunk"] * 2
+
+
+def test_execute_insertmany_upsert(clean_db):
+    table_name = "trustee_comp_results_rerun"
+    result = {
+        "cik": "12345678",
+        "accession_number": "0001111111-88-666666",
+        "model": "gemini-1.5-flash-002",
+        "selected_chunks": [1, 2],
+        "selected_text": "some text",
+        "response": "",
+        "n_trustee": 0,
+        "tags": ["batch1"],
+    }
+    for row in [result, result | {"n_trustee": 5}, result | {"tags": ["batch2"]}]:
+        assert execute_insertmany(table_name, [row], create_table=True)
+
+    rows = execute_query(f"SELECT n_trustee, tags FROM {table_name} ORDER BY tags")
+    assert rows == [
+        {"n_trustee": 5, "tags": ["batch1"]},
+        {"n_trustee": 0, "tags": ["batch2"]},
+    ]
+
+
+def test_migrate_table(clean_db):
+    table_name = "filing_chunks_embeddings_legacy"
+    execute_query(f"""
+        CREATE TABLE {table_name} (
+            cik VARCHAR(10) NOT NULL,
+            accession_number VARCHAR(20) NOT NULL,
+            chunk_num INTEGER NOT NULL,
+            embedding VECTOR (3) NOT NULL)
+    """)
+    assert _index_names(table_name) == []
+    for _ in range(2):
+        execute_query(
+            f"INSERT INTO {table_name} VALUES ('1', '0001111111-88-666666', 0, '[1,2,3]')"
+        )
+    # CREATE INDEX CONCURRENTLY waits for open transactions to finish
+    _conn().commit()
+
+    assert migrate_table(table_name, vector_index="hnsw") == 3
+    assert _index_names(table_name) == [
+        f"{table_name}_embedding_hnsw_idx",
+        f"{table_name}_key",
+    ]
+    # running it again is a no-op
+    assert migrate_table(table_name) == 3
+    # duplicates are removed before creating the unique index
+    assert len(execute_query(f"SELECT * FROM {table_name}")) == 1
+    assert migrate_table("filing_text_chunks_not_there") is None
+
+
+def test_migrate_index_merges_tags(clean_db):
+    table_name = "master_idx_legacy"
+    execute_query(f"""
+        CREATE TABLE {table_name} (
+            cik VARCHAR(10) NOT NULL,
+            accession_number VARCHAR(20) NOT NULL,
+            tags TEXT[])
+    """)
+    for tags in ["{a}", "{b,a}", "{c}"]:
+        execute_query(
+            f"INSERT INTO {table_name} VALUES ('1', '0000000001-24-000001', %s)",
+            (tags,),
+        )
+    execute_query(f"INSERT INTO {table_name} VALUES ('2', '0000000002-24-000001', NULL)")
+    _conn().commit()
+
+    assert migrate_table(table_name) == 2
+    rows = execute_query(f"SELECT cik, tags FROM {table_name} ORDER BY cik")
+    assert rows == [{"cik": "1", "tags": ["a", "b", "c"]}, {"cik": "2", "tags": None}]
+
+
+def test_upsert_keeps_last_row_of_batch(clean_db):
+    table_name = "filing_fingerprints_batch"
+    rows = [
+        {"cik": "1", "accession_number": "0000000001-24-000001", "minhash": [n]}
+        for n in range(5)
+    ]
+    assert execute_insertmany(table_name, rows, create_table=True)
+    assert execute_query(f"SELECT minhash FROM {table_name}") == [{"minhash": [4]}]
+
+
+def test_outdated_table_gets_new_columns(clean_db):
+    table_name = "trustee_comp_results_legacy"
+    execute_query(f"""
+        CREATE TABLE {table_name} (
+            cik VARCHAR(10) NOT NULL,
+            accession_number VARCHAR(20) NOT NULL,
+            model VARCHAR(32) NOT NULL,
+            selected_chunks INT[] NOT NULL,
+            selected_text TEXT NOT NULL,
+            response TEXT NOT NULL,
+            comp_info JSONB,
+            n_trustee INTEGER,
+            tags TEXT[])
+    """)
+    _conn().commit()
+
+    result = {
+        "cik": "1",
+        "accession_number": "0000000001-24-000001",
+        "model": "gpt-4o",
+        "selected_chunks": [1],
+        "selected_text": "text",
+        "response": "{}",
+        "n_trustee": 2,
+        "tags": ["legacy"],
+        "text_sha256": "0" * 64,
+        "reused_from": None,
+        "answered_by": "gpt-4o",
+    }
+    assert execute_insertmany(table_name, [result], create_table=True) == 1
+    rows = execute_query(f"SELECT text_sha256, answered_by FROM {table_name}")
+    assert rows == [{"text_sha256": "0" * 64, "answered_by": "gpt-4o"}]
+    # the indexes are still left to migrate
+    assert _index_names(table_name) == []
+    _conn().commit()
+    assert migrate_table(table_name) == 4
+    assert f"{table_name}_text_idx" in _index_names(table_name)
+
+
+def test_rank_chunks_by_text(clean_db):
+    table_name = "filing_text_chunks_rank"
+    filing = ("1", "0000000001-24-000001")
+    chunks = ["trustee compensation " * 5, "nothing here " * 5, "director fees " * 5]
+    save_chunks(*filing, chunks, table_name, create_table=True)
+
+    ranked = rank_chunks_by_text(*filing, table_name, "trustee | director", 10)
+    # chunks that do not match are left out
+    assert [row["chunk_num"] for row in ranked] == [0, 2]
+
+    # only the chunks of the filing, found with the key index, are parsed
+    with _conn().transaction():
+        _conn().execute("SET LOCAL enable_seqscan = off")
+        plan = "\n".join(
+            row[0]
+            for row in _conn().execute(
+                f"""
+                EXPLAIN SELECT chunk_num FROM {table_name},
+                    to_tsquery('english', 'trustee') AS q
+                WHERE cik = '1' AND accession_number = '0000000001-24-000001'
+                AND {TEXT_SEARCH_VECTOR} @@ q
+                """  # pyright: ignore
+            )
+        )
+    assert f"{table_name}_key" in plan
+
+
+@pytest.mark.parametrize("partition", ["hash", "year"])
+def test_partitioned_chunks(clean_db, partition):
+    table_name = f"filing_chunks_embeddings_{partition}"
+    filings = [("1002427", "0001133228-24-004879"), ("275309", "0000275309-23-000546")]
+    for cik, accession_number in filings:
+        save_chunks(
+            cik=cik,
+            accession_number=accession_number,
+            chunks=[_rand_vec(16), _rand_vec(16)],
+            table_name=table_name,
+            create_table=True,
+            partition=partition,
+        )
+
+    # each filing landed in its own partition
+    rows = execute_query(
+        f"SELECT DISTINCT tableoid::regclass::text AS part FROM {table_name}"
+    )
+    assert len(rows) == 2
+
+    result = get_chunks(
+        cik="275309",
+        accession_number="0000275309-23-000546",
+        table_name=table_name,
+        chunk_nums=[1],
+    )
+    assert len(result) == 1 and result[0]["chunk_num"] == 1
+    assert count_chunks("275309", "0000275309-23-000546", table_name) == 2
+    embeddings = get_embeddings(filings, table_name)
+    assert [row["accession_number"] for row in embeddings] == [
+        filings[0][1],
+        filings[0][1],
+        filings[1][1],
+        filings[1][1],
+    ]
+
+    if partition == "year":
+        drop_filing_year(table_name, 2023)
+        assert get_chunks("275309", "0000275309-23-000546", table_name) == []
+        assert len(get_chunks("1002427", "0001133228-24-004879", table_name)) == 2
+
+
+def test_filing_year():
+    assert _filing_year("0001133228-24-004879") == 2024
+    assert _filing_year("0000950109-98-001234") == 1998
+
+
+async def test_async_api(clean_db):
+    dimension = 16
+    embeddings = [_rand_vec(dimension) for _ in range(3)]
+    try:
+        await asave_chunks(
+            cik="12345678",
+            accession_number="0001111111-88-777777",
+            chunks=embeddings,
+            table_name="filing_chunks_embeddings_async",
+            create_table=True,
+        )
+        result = await aget_chunks(
+            cik="12345678",
+            accession_number="0001111111-88-777777",
+            table_name="filing_chunks_embeddings_async",
+            chunk_nums=[1, 2],
+        )
+        assert [row["chunk_num"] for row in result] == [1, 2]
+
+        table_name = "search_phrase_embeddings_async"
+        data = [{"phrase": "phrase 1", "phrase_embedding": _rand_vec(16), "tags": ["a"]}]
+        assert await aexecute_insertmany(table_name, data, create_table=True)
+        # same natural key, so the row is updated instead of duplicated
+        assert await aexecute_insertmany(table_name, data, create_table=True)
+        result = await aexecute_query(f"SELECT phrase FROM {table_name}")
+        assert result == [{"phrase": "phrase 1"}]
+    finally:
+        await aclose_pool()
+
+
+def test_search_chunks(clean_db):
+    tables = {
+        "idx": "master_idx_search",
+        "text": "filing_text_chunks_search",
+        "embedding": "filing_chunks_embeddings_search",
+    }
+    filings = [(str(cik), f"000000000{cik}-24-000005") for cik in range(1, 4)]
+    execute_insertmany(
+        tables["idx"],
+        [
+            {
+                "cik": cik,
+                "accession_number": accession_number,
+                "date_filed": "2024-01-29",
+                "company_name": f"FUND {cik}",
+                "form_type": "485BPOS",
+                "idx_filename": f"{accession_number}.txt",
+                "tags": ["search"],
+            }
+            for cik, accession_number in filings
+        ],
+        create_table=True,
+    )
+    for cik, accession_number in filings:
+        texts = [f"chunk {i} of {cik}" for i in range(20)]
+        save_chunks(cik, accession_number, texts, tables["text"], True)
+        embeddings = [_rand_vec(16) for _ in range(20)]
+        save_chunks(cik, accession_number, embeddings, tables["embedding"], True)
+    _conn().commit()
+    migrate_table(tables["embedding"], vector_index="hnsw")
+
+    query_embedding = _rand_vec(16)
+    exact = search_chunks(
+        query_embedding, tables["embedding"], tables["idx"], tables["text"], exact=True
+    )
+    assert len(exact) == 10
+    assert exact == sorted(exact, key=lambda row: row["distance"])
+    first = exact[0]
+    assert first["company_name"] == f"FUND {first['cik']}"
+    assert first["date_filed"] == "2024-01-29"
+    assert first["chunk_text"] == f"chunk {first['chunk_num']} of {first['cik']}"
+
+    approximate = search_chunks(
+        query_embedding, tables["embedding"], tables["idx"], ef_search=100
+    )
+    assert [row["distance"] for row in approximate] == pytest.approx(
+        [row["distance"] for row in exact]
+    )
+
 
 def test_relevant_chunks_with_distances(clean_db):
     # TODO: implement this, need data in test db to work
     pass
 
 
+def _index_names(table_name: str) -> list[str]:
+    rows = execute_query(
+        "SELECT indexname FROM pg_indexes WHERE tablename = %s ORDER BY indexname",
+        (table_name,),
+    )
+    return [row["indexname"] for row in rows]
+
+
 def _rand_vec(dimension: int) -> list[float]:
     return [random.uniform(0.0, 1.0) for _ in range(dimension)]
+
+
+async def test_async_concurrent_setup(clean_db):
+    # table creation, migration and partitions of a new table
+    # all set up by concurrent calls at once
+    table_name = "filing_text_chunks_async_year"
+    filings = [
+        (str(cik), f"{cik:010}-{year:02}-000001")
+        for cik in range(1, 21)
+        for year in range(15, 25)
+    ]
+    try:
+        await asyncio.gather(
+            *(
+                asave_chunks(
+                    cik=cik,
+                    accession_number=accession_number,
+                    chunks=[f"chunk of {accession_number}"] * 2,
+                    table_name=table_name,
+                    create_table=True,
+                    partition="year",
+                )
+                for cik, accession_number in filings
+            )
+        )
+        rows = await aexecute_query(f"SELECT count(*) AS n FROM {table_name}")
+        assert rows[0]["n"] == 2 * len(filings)
+    finally:
+        await aclose_pool()
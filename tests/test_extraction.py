@@ -0,0 +1,86 @@
+import json
+import threading
+
+import pytest
+
+from sleuth.llm import extraction
+from sleuth.llm.extraction import read_stream, remove_md_json_wrapper
+
+
+def _fragments(text: str, consumed: list[str]):
+    for i in range(0, len(text), 4):
+        consumed.append(text[i : i + 4])
+        yield text[i : i + 4]
+
+
+def test_read_stream_stops_on_false():
+    response = '```json\n{\n "compensation_info_present": false,\n "trustees": []'
+    response += ', "notes": "' + "no table " * 100 + '"}\n```'
+    consumed = []
+
+    text = read_stream(_fragments(response, consumed), "compensation_info_present")
+    assert json.loads(text) == {"compensation_info_present": False}
+    # stopped long before the end of the response
+    assert len("".join(consumed)) < 60
+
+
+def test_read_stream_reads_positive_answer():
+    answer = {
+        "compensation_info_present": True,
+        "trustees": [{"name": "a"}, {"name": "b"}],
+        "notes": "",
+    }
+    response = f"```json\n{json.dumps(answer)}\n```"
+    consumed = []
+
+    text = read_stream(_fragments(response, consumed), "compensation_info_present")
+    assert text == response
+    assert json.loads(remove_md_json_wrapper(text)) == answer
+    # a false value of any other key does not stop reading
+    assert read_stream(iter(['{"a": false, "b": 1}']), "b") == '{"a": false, "b": 1}'
+
+
+def test_ask_model_hedged(monkeypatch):
+    released = threading.Event()
+    answer = '{"compensation_info_present": true, "trustees": []}'
+
+    def ask_model_cached(model, prompt, stop_on_false=None):
+        if model == "gemini-1.5-flash-002":
+            # the primary model is slow this time
+            released.wait(5)
+        return answer if prompt == "json" else "not a json answer"
+
+    monkeypatch.setattr(extraction, "ask_model_cached", ask_model_cached)
+    monkeypatch.setattr(extraction, "hedge_delay", lambda model: 0.05)
+    extraction.set_hedging("gpt-4o-mini")
+    try:
+        response, answered_by = extraction.ask_model_hedged(
+            "gemini-1.5-flash-002", "json"
+        )
+        assert response == answer and answered_by == "gpt-4o-mini"
+
+        # neither gives a JSON answer, the response of the one that finished last
+        released.set()
+        response, _ = extraction.ask_model_hedged("gemini-1.5-flash-002", "text")
+        assert response == "not a json answer"
+
+        # no hedging for the hedge model itself
+        assert extraction.ask_model_hedged("gpt-4o-mini", "json") == (
+            answer,
+            "gpt-4o-mini",
+        )
+    finally:
+        extraction.set_hedging("")
+        released.set()
+
+
+def test_hedge_delay(monkeypatch):
+    monkeypatch.setattr(extraction, "_latencies", {})
+    assert extraction.hedge_delay("gpt-4o") == extraction.HEDGE_DEFAULT_DELAY
+
+    monkeypatch.setattr(extraction, "_latencies", {"gpt-4o": list(range(1, 101))})
+    extraction.set_hedging("gpt-4o-mini", 90.0)
+    try:
+        assert extraction.hedge_delay("gpt-4o") == pytest.approx(90.1)
+    finally:
+        extraction.set_hedging("")
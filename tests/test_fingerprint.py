@@ -0,0 +1,23 @@
+import random
+
+import pytest
+
+from sleuth.fingerprint import NUM_PERMUTATIONS, minhash, similarity
+
+
+def test_minhash_similarity():
+    words = [f"word{random.randint(0, 500)}" for _ in range(5000)]
+    document = "<p>" + " ".join(words) + "</p>"
+    amended = words[:]
+    for i in range(0, len(amended), 1000):
+        amended[i] = "amended"
+
+    signature = minhash(document)
+    assert len(signature) == NUM_PERMUTATIONS
+    # markup does not count
+    assert minhash(" ".join(words)) == signature
+    assert similarity(signature, minhash(" ".join(amended))) == pytest.approx(
+        0.99, abs=0.05
+    )
+    assert similarity(signature, minhash(" ".join(words[:2500]))) < 0.7
+    assert similarity(signature, []) == 0.0
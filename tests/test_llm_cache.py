@@ -0,0 +1,114 @@
+import json
+
+import pytest
+
+from sleuth.llm import cache as llm_cache
+from sleuth.llm import extraction
+from sleuth.llm.cache import ResponseCache
+
+
+@pytest.fixture
+def model_calls(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_PATH", str(tmp_path / "responses.sqlite"))
+    monkeypatch.delenv("SKIP_ASK_MODEL", raising=False)
+    calls = []
+
+    def ask_model(model, prompt, stop_on_false=None):
+        calls.append(prompt)
+        return f"response to {prompt}"
+
+    monkeypatch.setattr(extraction, "ask_model", ask_model)
+    llm_cache.take_stats()
+    yield calls
+    llm_cache.set_mode("readwrite")
+
+
+def test_cached_response(model_calls):
+    llm_cache.set_mode("readwrite")
+    assert extraction.ask_model_cached("gemini-1.5-flash-002", "a") == "response to a"
+    assert extraction.ask_model_cached("gemini-1.5-flash-002", "a") == "response to a"
+    assert extraction.ask_model_cached("gpt-4o", "a") == "response to a"
+    assert model_calls == ["a", "a"]
+
+    # replay never calls the model
+    llm_cache.set_mode("replay")
+    assert extraction.ask_model_cached("gpt-4o", "a") == "response to a"
+    assert extraction.ask_model_cached("gpt-4o", "b") is None
+    assert model_calls == ["a", "a"]
+
+    stats = llm_cache.take_stats()
+    assert (stats["hits"], stats["misses"], stats["writes"]) == (2, 3, 2)
+
+    llm_cache.set_mode("off")
+    extraction.ask_model_cached("gpt-4o", "a")
+    assert model_calls == ["a", "a", "a"]
+
+
+def test_cache_key(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    cache.put("gpt-4o", {"temperature": 0}, "prompt", "response")
+    assert cache.get("gpt-4o", {"temperature": 0}, "prompt") == "response"
+    assert cache.get("gpt-4o", {"temperature": 1}, "prompt") is None
+    assert cache.get("gpt-4o-mini", {"temperature": 0}, "prompt") is None
+
+
+def test_cache_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_mb=0.01)
+    for i in range(10):
+        cache.put("gpt-4o", {}, f"prompt {i}", str(i) * 2048)
+        # keep the first response in use
+        cache.get("gpt-4o", {}, "prompt 0")
+
+    assert cache.size() <= 0.01 * 1024 * 1024
+    assert cache.get("gpt-4o", {}, "prompt 0") is not None
+    assert cache.get("gpt-4o", {}, "prompt 1") is None
+    assert cache.get("gpt-4o", {}, "prompt 9") is not None
+
+
+def test_cache_size_kept_by_writes(tmp_path, monkeypatch):
+    path = str(tmp_path / "responses.sqlite")
+    ResponseCache(path).put("gpt-4o", {}, "earlier", "x" * 100)
+
+    cache = ResponseCache(path, max_mb=0.01)
+    sums = []
+    size = cache.size
+    monkeypatch.setattr(cache, "size", lambda: sums.append(1) or size())
+    for i in range(5):
+        cache.put("gpt-4o", {}, f"prompt {i}", "y" * 100)
+    cache.put("gpt-4o", {}, "prompt 0", "z" * 50)
+    # the table is summed once, then the count follows the writes
+    assert len(sums) == 1
+    assert cache._size == size() == 100 + 4 * 100 + 50
+
+    for i in range(100):
+        cache.put("gpt-4o", {}, f"large {i}", str(i) * 1024)
+    assert cache._size == size() <= 0.01 * 1024 * 1024
+
+
+def test_replay_without_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / "missing.sqlite"), read_only=True)
+    assert cache.get("gpt-4o", {}, "prompt") is None
+    cache.put("gpt-4o", {}, "prompt", "response")
+    assert not (tmp_path / "missing.sqlite").exists()
+
+
+def test_response_stopped_early_cached_apart(model_calls, monkeypatch):
+    llm_cache.set_mode("readwrite")
+
+    def ask_model(model, prompt, stop_on_false=None):
+        model_calls.append(prompt)
+        if stop_on_false:
+            return json.dumps({stop_on_false: False})
+        return '{"compensation_info_present": false, "notes": "no table"}'
+
+    monkeypatch.setattr(extraction, "ask_model", ask_model)
+    key = "compensation_info_present"
+    stub = '{"compensation_info_present": false}'
+    assert extraction.ask_model_cached("gpt-4o", "a", stop_on_false=key) == stub
+    # a rerun with early stop gets the stub without asking the model
+    assert extraction.ask_model_cached("gpt-4o", "a", stop_on_false=key) == stub
+    assert extraction.cached_response("gpt-4o", "a", stop_on_false=key) == stub
+    # without early stop the full response is asked for
+    assert "notes" in extraction.ask_model_cached("gpt-4o", "a")
+    assert model_calls == ["a", "a"]
+    assert llm_cache.take_stats()["writes"] == 2
@@ -12,7 +12,7 @@ from sleuth.llm.algo import (
     relevance_by_distance,
     top_adjacent_chunks,
 )
-from sleuth.trustee import _find_relevant_text
+from sleuth.trustee import trustee_comp_candidates
 
 
 def test_selected_chunks():
@@ -28,16 +28,17 @@ def test_selected_chunks():
         new_chunks = get_relevant_chunk_nums_new(df_phrases, cik, accession_number)
         assert new_chunks
 
-        old_chunks, _ = _find_relevant_text(
+        # the distance selection is the first candidate
+        candidates = trustee_comp_candidates(
             cik=cik,
             accession_number=accession_number,
+            search_phrase_table_name="search_phrase_embeddings",
             text_table_name="filing_text_chunks",
             embedding_table_name="filing_chunks_embeddings",
-            search_phrase_table_name="search_phrase_embeddings",
             search_phrase_tag="group1",
-            method="distance",
         )
-        assert old_chunks
+        assert candidates
+        old_chunks = candidates[0][0]
 
         if new_chunks != old_chunks:
             print(
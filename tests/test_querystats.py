@@ -0,0 +1,57 @@
+from sleuth import querystats
+from sleuth.datastore import execute_query
+
+
+def test_normalize_query():
+    template = querystats.normalize_query("""
+        SELECT * FROM master_idx_2024
+        WHERE cik = '1234' AND n IN (1, 2, 3) LIMIT 10
+    """)
+    assert template == (
+        "SELECT * FROM master_idx_2024 WHERE cik = ? AND n IN (?, ...) LIMIT ?"
+    )
+
+
+def test_take_and_merge():
+    querystats.take()
+    querystats.record("SELECT 1", 2.0, rows=1, nbytes=8)
+    querystats.record("SELECT  2", 2000.0, rows=1, nbytes=8)
+    snapshot = querystats.take()
+    assert querystats.take() == {}
+
+    stats = snapshot["SELECT ?"]
+    assert stats["calls"] == 2
+    assert stats["rows"] == 2
+
+    # as if the same statistics came from two workers
+    querystats.merge(snapshot)
+    querystats.merge(snapshot)
+    merged = querystats.take()["SELECT ?"]
+    assert merged["calls"] == 4
+    assert merged["max_ms"] == 2000.0
+    assert sum(merged["histogram"]) == 4
+
+
+def test_slow_query_plan(clean_db):
+    querystats.take()
+    querystats.set_slow_query_threshold(0.000001)
+    try:
+        execute_query("SELECT relname FROM pg_class WHERE relname = %s", ("pg_proc",))
+        execute_query("CREATE TABLE IF NOT EXISTS querystats_test (n INT)")
+    finally:
+        querystats.set_slow_query_threshold(0)
+
+    assert "SELECT relname" in querystats.summary()
+    snapshot = querystats.take()
+    select = snapshot["SELECT relname FROM pg_class WHERE relname = %s"]
+    assert select["slow_calls"] == 1
+    assert "actual time" in select["slow_plan"]
+    # statements that change data are never run again to explain them
+    create = snapshot["CREATE TABLE IF NOT EXISTS querystats_test (n INT)"]
+    assert create["slow_plan"] == ""
+
+
+def test_estimate_size_counts_vectors_by_length():
+    params = ("abc", [0.1] * 768, None)
+    rows = [{"chunk_text": "hello", "embedding": [0.2] * 768}]
+    assert querystats.estimate_size(params, rows) == 3 + 768 * 8 + 5 + 768 * 8
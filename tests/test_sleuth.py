@@ -1,17 +1,44 @@
 import os
+import random
 import shlex
+import threading
 
 import pytest
 from click.testing import CliRunner
 
-from sleuth.__main__ import main
-from sleuth.datastore import execute_insertmany, execute_query
+from sleuth.__main__ import main, plan_filings
+from sleuth.datastore import (
+    execute_insertmany,
+    execute_query,
+    relevant_chunks_with_distances,
+    save_chunks,
+    table_exists,
+)
+from sleuth.llm.algo import gather_chunk_distances
 from sleuth.llm.embedding import GEMINI_EMBEDDING_MODEL
-from sleuth.processor import process_filing
+from sleuth.processor import (
+    _reuse_near_duplicate_chunks,
+    candidate_coverage,
+    process_filing,
+    reuse_near_duplicate_result,
+    save_filing_embeddings,
+    save_fingerprint,
+)
 from sleuth.trustee import (
+    SELECTION_METHODS,
     TRUSTEE_COMP_SEARCH_PHRASES,
+    _previous_results,
+    _relevant_texts,
+    _responses,
+    _select_chunks,
+    _text_ranking,
     create_search_phrase_embeddings,
     delete_search_pharses,
+    extract_trustee_comp,
+    forget_search_phrases,
+    relevance_for_filings,
+    search_phrases,
+    trustee_comp_candidates,
 )
 
 run_models = os.environ.get("PYTEST_RUN_MODELS", "0") == "1"
@@ -203,3 +230,479 @@ def test_load_index(clean_db):
 
     result = execute_query("SELECT COUNT(*) FROM master_idx_pytest_2")
     assert result and result[0]["count"] == 1824
+
+
+def test_plan_filings(clean_db):
+    tables_map = {
+        "idx": "master_idx_plan",
+        "text": "filing_text_chunks_plan",
+        "embedding": "filing_chunks_embeddings_plan",
+        "result": "trustee_comp_results_plan",
+    }
+    filings = [(str(cik), f"000000000{cik}-24-000001") for cik in range(1, 5)]
+    execute_insertmany(
+        tables_map["idx"],
+        [
+            {
+                "cik": cik,
+                "accession_number": accession_number,
+                "date_filed": "2024-01-29",
+                "company_name": "SOME FUND",
+                "form_type": "485BPOS",
+                "idx_filename": f"{accession_number}.txt",
+                "tags": ["plan"],
+            }
+            for cik, accession_number in filings
+        ],
+        create_table=True,
+    )
+
+    def plan(action: str) -> list[tuple[str, str]]:
+        return sorted(
+            plan_filings(
+                action=action,
+                tag="plan",
+                batch_limit=0,
+                tables_map=tables_map,
+                result_tag="result-plan",
+                model="gpt-4o-mini",
+            )
+        )
+
+    # nothing processed yet
+    assert plan("chunk") == filings
+    assert plan("embedding") == []
+    assert plan("extract") == filings
+
+    for cik, accession_number in filings[:3]:
+        save_chunks(cik, accession_number, ["chunk text"], tables_map["text"], True)
+    save_chunks(*filings[0], [[0.1] * 16], tables_map["embedding"], True)
+    execute_insertmany(
+        tables_map["result"],
+        [
+            {
+                "cik": filings[1][0],
+                "accession_number": filings[1][1],
+                "model": "gpt-4o-mini",
+                "selected_chunks": [0],
+                "selected_text": "chunk text",
+                "response": "",
+                "n_trustee": 0,
+                "tags": ["result-plan"],
+            }
+        ],
+        create_table=True,
+    )
+
+    assert plan("chunk") == filings[3:]
+    assert plan("embedding") == filings[1:3]
+    assert plan("extract") == [filings[0]] + filings[2:]
+
+
+def test_relevance_for_filings(filing_tables):
+    filings = [(str(cik), f"000000000{cik}-24-000002") for cik in range(1, 5)]
+    tables = filing_tables("batch", tag="batch", filings=filings[:3])
+    embedding_table, search_table = tables["embedding"], tables["search"]
+
+    relevance = relevance_for_filings(
+        filings=filings,
+        embedding_table_name=embedding_table,
+        search_phrase_table_name=search_table,
+        search_phrase_tag="batch",
+        limit=10,
+    )
+
+    # same chunks as searching each filing separately
+    for cik, accession_number in filings:
+        expected = relevant_chunks_with_distances(
+            cik=cik,
+            accession_number=accession_number,
+            embedding_table_name=embedding_table,
+            search_phrase_table_name=search_table,
+            search_phrase_tag="batch",
+            limit=10,
+        )
+        rows = relevance[(cik, accession_number)]
+        assert [(r["phrase"], r["chunk_num"]) for r in rows] == [
+            (r["phrase"], r["chunk_num"]) for r in expected
+        ]
+    assert relevance[filings[3]] == []
+
+
+def test_relevance_reused(filing_tables, monkeypatch):
+    filing = ("1", "0000000001-24-000003")
+    tables = filing_tables("reuse", tag="reuse", filings=[filing])
+    save_chunks(*filing, [f"chunk {i} " * 20 for i in range(30)], tables["text"], True)
+
+    def relevance() -> list[dict]:
+        return relevance_for_filings(
+            filings=[filing],
+            embedding_table_name=tables["embedding"],
+            search_phrase_table_name=tables["search"],
+            search_phrase_tag="reuse",
+            relevance_table_name=tables["relevance"],
+        )[filing]
+
+    searched = relevance()
+    assert len(searched) == 20
+    # the second time the saved result is used without searching
+    execute_query(f"DELETE FROM {tables['embedding']}")
+    assert relevance() == searched
+
+    # one text fetch gives the text of the chunks selected by each method
+    relevant_texts = _relevant_texts(*filing, tables["text"], searched)
+    chunk_distances = gather_chunk_distances(searched)
+    text_ranking = _text_ranking(*filing, tables["text"])
+    for method, (chunks, text) in zip(SELECTION_METHODS, relevant_texts):
+        selected = _select_chunks(chunk_distances, method, text_ranking)
+        assert set(chunks) <= set(selected) and bool(text) == bool(selected)
+        assert all(f"chunk {chunk_num} " in text for chunk_num in chunks)
+
+    # the candidates sent to the model are the distinct selections, in order
+    candidates = trustee_comp_candidates(
+        *filing,
+        search_phrase_table_name=tables["search"],
+        text_table_name=tables["text"],
+        embedding_table_name=tables["embedding"],
+        search_phrase_tag="reuse",
+        relevance_result=searched,
+    )
+    assert candidates and all(c in relevant_texts for c in candidates)
+    assert len({tuple(chunks) for chunks, _ in candidates}) == len(candidates)
+
+    def saved() -> list[dict]:
+        return execute_query(f"SELECT * FROM {tables['relevance']}")
+
+    # new embeddings of the filing make the saved relevance stale
+    monkeypatch.setattr(
+        "sleuth.processor.batch_embedding",
+        lambda chunks, **_: [[random.uniform(-1, 1) for _ in range(16)] for _ in chunks],
+    )
+    assert saved()
+    save_filing_embeddings(
+        tables["text"],
+        *filing,
+        16,
+        tables["embedding"],
+        relevance_table_name=tables["relevance"],
+    )
+    assert saved() == []
+    # so do new search phrases of the tag
+    assert relevance() and saved()
+    delete_search_pharses(tables["search"], "reuse", tables["relevance"])
+    assert saved() == []
+
+
+def test_numpy_retrieval(filing_tables):
+    filings = [(str(cik), f"000000000{cik}-24-000004") for cik in range(1, 4)]
+    tables = filing_tables(
+        "numpy", tag="numpy", filings=filings[:2], n_chunks=50, dimension=32
+    )
+    embedding_table, search_table = tables["embedding"], tables["search"]
+
+    def relevance(retrieval: str) -> dict:
+        return relevance_for_filings(
+            filings=filings,
+            embedding_table_name=embedding_table,
+            search_phrase_table_name=search_table,
+            search_phrase_tag="numpy",
+            retrieval=retrieval,
+        )
+
+    expected, result = relevance("pgvector"), relevance("numpy")
+    for filing in filings:
+        assert [(r["phrase"], r["chunk_num"]) for r in result[filing]] == [
+            (r["phrase"], r["chunk_num"]) for r in expected[filing]
+        ]
+        assert [r["distance"] for r in result[filing]] == pytest.approx(
+            [r["distance"] for r in expected[filing]], abs=1e-5
+        )
+    assert result[filings[2]] == []
+
+
+def test_search_phrases_cache(clean_db):
+    table_name = "search_phrase_embeddings_cache"
+    data = [
+        {"phrase": f"phrase {i}", "phrase_embedding": [3.0] * 16, "tags": ["cache"]}
+        for i in range(2)
+    ]
+    execute_insertmany(table_name, data, create_table=True)
+
+    phrases = search_phrases(table_name, "cache")
+    assert phrases.phrases == ["phrase 0", "phrase 1"]
+    assert phrases.vectors.shape == (2, 16)
+    assert float((phrases.vectors[0] ** 2).sum()) == pytest.approx(1.0)
+
+    # loaded once, until the tag is rewritten
+    execute_query(f"DELETE FROM {table_name} WHERE phrase = 'phrase 1'")
+    assert search_phrases(table_name, "cache") is phrases
+    forget_search_phrases(table_name, "cache")
+    assert search_phrases(table_name, "cache").phrases == ["phrase 0"]
+
+
+def test_embed_candidates(filing_tables, monkeypatch):
+    tables = filing_tables("candidates")
+    filings = [(str(cik), f"000000000{cik}-24-000005") for cik in range(1, 4)]
+    chunks = [f"fund expenses and fees {i} " * 10 for i in range(30)]
+    chunks[10] = "the trustee compensation table " * 5
+    chunks[20] = "aggregate compensation paid to each director"
+    for filing in filings[:2]:
+        save_chunks(*filing, chunks, tables["text"], True)
+    save_chunks(*filings[2], chunks[:5], tables["text"], True)
+    monkeypatch.setattr(
+        "sleuth.processor.batch_embedding",
+        lambda chunks, **_: [[0.5] * 16 for _ in chunks],
+    )
+
+    n_embeddings = save_filing_embeddings(
+        tables["text"], *filings[0], 16, tables["embedding"], n_candidates=2
+    )
+    assert n_embeddings == 6
+    saved = execute_query(
+        f"SELECT chunk_num FROM {tables['embedding']} ORDER BY chunk_num"
+    )
+    assert [row["chunk_num"] for row in saved] == [9, 10, 11, 19, 20, 21]
+    # every chunk is embedded when none matches the keywords
+    assert (
+        save_filing_embeddings(
+            tables["text"], *filings[2], 16, tables["embedding"], n_candidates=2
+        )
+        == 5
+    )
+
+    execute_insertmany(
+        tables["result"],
+        [
+            {
+                "cik": cik,
+                "accession_number": accession_number,
+                "model": "test",
+                "selected_chunks": selected_chunks,
+                "selected_text": "",
+                "response": "",
+                "n_trustee": 0,
+                "tags": ["candidates"],
+            }
+            for (cik, accession_number), selected_chunks in zip(
+                filings, [[10, 11], [11, 12], [3, 4]]
+            )
+        ],
+        create_table=True,
+    )
+    coverage = candidate_coverage(
+        tables["text"], tables["result"], "candidates", n_candidates=2
+    )
+    assert coverage == {"n_filings": 3, "n_outside": 1}
+
+    # with more candidates than matching chunks, only the matching ones count
+    execute_insertmany(
+        tables["result"],
+        [
+            {
+                "cik": filings[0][0],
+                "accession_number": filings[0][1],
+                "model": "test",
+                "selected_chunks": [1, 2],
+                "selected_text": "",
+                "response": "",
+                "n_trustee": 0,
+                "tags": ["candidates5"],
+            }
+        ],
+        create_table=True,
+    )
+    coverage = candidate_coverage(
+        tables["text"], tables["result"], "candidates5", n_candidates=5
+    )
+    assert coverage == {"n_filings": 1, "n_outside": 1}
+
+
+def test_hybrid_selection():
+    chunk_distances = {3: [0.28], 4: [0.30, 0.31], 17: [0.29], 18: [0.33]}
+    assert _select_chunks(chunk_distances, "distance") == [3, 4]
+    # chunks the full text search ranks high as well move ahead
+    assert _select_chunks(chunk_distances, "hybrid", [18, 17, 40]) == [17, 18]
+    assert _select_chunks(chunk_distances, "hybrid", []) == [3, 4]
+
+
+def test_reuse_result_for_same_text(filing_tables, monkeypatch):
+    # sibling funds with the same statement of additional information
+    filings = [("1", "0000000001-24-000006"), ("2", "0000000002-24-000006")]
+    tables = filing_tables("same_text", tag="same_text")
+    chunks = [f"trustee compensation of fund {i} " * 10 for i in range(10)]
+    embeddings = [[random.uniform(-1, 1) for _ in range(16)] for _ in range(10)]
+    for filing in filings:
+        save_chunks(*filing, chunks, tables["text"], True)
+        save_chunks(*filing, embeddings, tables["embedding"], True)
+
+    calls = []
+    response = '{"trustees": [{"name": "a"}, {"name": "b"}]}'
+    monkeypatch.setattr(
+        "sleuth.trustee._ask_model_about_trustee_comp",
+        lambda model, text: (calls.append(text) or response, model),
+    )
+
+    def extract(filing, tag):
+        result = extract_trustee_comp(
+            *filing,
+            search_phrase_table_name=tables["search"],
+            text_table_name=tables["text"],
+            embedding_table_name=tables["embedding"],
+            search_phrase_tag="same_text",
+            model="gpt-4o",
+            result_table_name=tables["result"],
+        )
+        assert result is not None
+        result["tags"] = [tag]
+        execute_insertmany(tables["result"], [result], create_table=True)
+        return result
+
+    first = extract(filings[0], "batch1")
+    assert first["reused_from"] is None
+    second = extract(filings[1], "batch2")
+    assert len(calls) == 1
+    assert second["reused_from"] == filings[0][1]
+    assert second["response"] == response and second["n_trustee"] == 2
+    assert second["text_sha256"] == first["text_sha256"]
+
+    previous = _previous_results(
+        tables["result"], [first["selected_text"], "other text"], "gpt-4o"
+    )
+    assert list(previous) == [first["text_sha256"]]
+    assert previous[first["text_sha256"]] == (response, "gpt-4o", filings[0][1])
+    assert _previous_results("trustee_comp_results_missing", ["text"], "gpt-4o") == {}
+
+
+def test_reuse_near_duplicate_filing(filing_tables, monkeypatch):
+    original = ("1", "0000000001-23-000007")
+    amendment = ("1", "0000000001-24-000007")
+    tables = filing_tables("near_dup", filings=[original], n_chunks=10)
+    document = " ".join(f"word{random.randint(0, 500)}" for _ in range(5000))
+    chunks = [f"chunk {i} " * 20 for i in range(10)]
+    save_chunks(*original, chunks, tables["text"], True)
+
+    dates = {original: "2023-04-28", amendment: "2024-04-29"}
+
+    def reuse_chunks(filing, document, threshold, table_name=tables["text"]):
+        return _reuse_near_duplicate_chunks(
+            *filing,
+            dates[filing],
+            document,
+            table_name,
+            tables["fingerprint"],
+            threshold,
+        )
+
+    # a dry run saves no fingerprint
+    assert reuse_chunks(original, document, 0.9, table_name="") is None
+    assert not table_exists(tables["fingerprint"])
+    # the first filing of a cik has nothing to compare with
+    assert reuse_chunks(original, document, 0.9) is None
+    # below the threshold the document is chunked again
+    assert reuse_chunks(amendment, document[:10000], 0.9) is None
+    assert reuse_chunks(amendment, document + " amended", 0.9) == chunks
+    reused = execute_query(
+        f"SELECT DISTINCT reused_from FROM {tables['text']}"
+        " WHERE accession_number = %s",
+        (amendment[1],),
+    )
+    assert reused == [{"reused_from": original[1]}]
+
+    def no_embedding(*args, **kwargs):
+        raise AssertionError("embeddings should be copied")
+
+    monkeypatch.setattr("sleuth.processor.batch_embedding", no_embedding)
+    n_embeddings = save_filing_embeddings(
+        tables["text"],
+        *amendment,
+        16,
+        tables["embedding"],
+        reuse_near_duplicates=True,
+    )
+    assert n_embeddings == 10
+
+    execute_insertmany(
+        tables["result"],
+        [
+            {
+                "cik": original[0],
+                "accession_number": original[1],
+                "model": "gpt-4o",
+                "selected_chunks": [1, 2],
+                "selected_text": "text",
+                "response": "{}",
+                "n_trustee": 5,
+                "tags": ["near_dup"],
+            }
+        ],
+        create_table=True,
+    )
+
+    def reuse_result(threshold):
+        return reuse_near_duplicate_result(
+            *amendment,
+            "gpt-4o",
+            tables["fingerprint"],
+            tables["result"],
+            threshold,
+        )
+
+    result = reuse_result(0.9)
+    assert result is not None
+    assert result["accession_number"] == amendment[1]
+    assert result["reused_from"] == original[1]
+    assert result["n_trustee"] == 5
+    assert "selected_text" not in result
+    assert reuse_result(1.01) is None
+
+
+def test_fingerprint_earlier_filings_only(filing_tables):
+    table_name = filing_tables("order")["fingerprint"]
+    document = " ".join(f"word{random.randint(0, 500)}" for _ in range(5000))
+    later = ("1", "0000000001-24-000009", "2024-04-29")
+    earlier = ("1", "0000000001-23-000009", "2023-04-28")
+    same_day = ("1", "0000000001-24-000010", "2024-04-29")
+
+    # the later filing is fingerprinted first,
+    # the earlier one must not be matched with it
+    assert save_fingerprint(*later, document, table_name) == (None, 0.0)
+    assert save_fingerprint(*earlier, document, table_name) == (None, 0.0)
+    similar_to, score = save_fingerprint(*same_day, document, table_name)
+    assert similar_to == later[1] and score == 1.0
+    # processed again, the later filing finds the earlier one
+    assert save_fingerprint(*later, document, table_name)[0] == earlier[1]
+    # without a filing date there is nothing to compare with
+    assert save_fingerprint(*later[:2], "", document, table_name) == (None, 0.0)
+
+
+@pytest.mark.parametrize("speculation", [1, 3])
+def test_speculative_responses(monkeypatch, speculation):
+    candidates = [([i], f"selection {i}") for i in range(4)]
+    second_asked = threading.Event()
+    calls = []
+
+    def ask_model(model, text):
+        calls.append(text)
+        if text == "selection 0":
+            # with speculation the next selection is asked before this returns
+            assert second_asked.wait(5) == (speculation > 1)
+            return '{"trustees": []}', model
+        second_asked.set()
+        return '{"trustees": [{"name": "a"}, {"name": "b"}]}', model
+
+    monkeypatch.setattr("sleuth.trustee._ask_model_about_trustee_comp", ask_model)
+    if speculation == 1:
+        monkeypatch.setattr(second_asked, "wait", lambda timeout: second_asked.is_set())
+
+    responses = _responses(candidates, "gpt-4o", "", speculation)
+    chunks, _, response, answered_by, _ = next(responses)
+    assert chunks == [0] and response == '{"trustees": []}' and answered_by == "gpt-4o"
+    # responses come back in the order of the selections
+    chunks, _, response, _, reused_from = next(responses)
+    assert chunks == [1] and "trustees" in response and reused_from is None
+    responses.close()
+    if speculation == 1:
+        assert calls == ["selection 0", "selection 1"]
+    else:
+        # selections asked ahead are ignored once a response is taken
+        assert {"selection 0", "selection 1"} <= set(calls)